@@ -0,0 +1,204 @@
+'''
+Writers for the on-disk layouts of the tokenized Arrow files.
+
+MAINTENANCE: The layouts written here are read by
+``./training/dataset.py``. Make sure to keep both sides in sync.
+'''
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+
+# NOTE: Needs to be kept in sync with the training code.
+IGNORE_INDEX = -100
+
+
+def smallest_token_dtype(vocab_size: int) -> np.dtype:
+    '''The smallest integer type that can hold every token ID of a vocabulary of `vocab_size` tokens.'''
+    if vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+class FixedLengthChunkWriter:
+    '''
+    Writes UFT chunks as rows of a single fixed-size list column, `rows_per_batch`
+    rows per record batch:
+
+    - `input_ids`: `fixed_size_list<token_dtype>[max_length]`
+    - `length`: `int32`, the amount of real tokens in the row
+
+    Rows shorter than `max_length` (e.g. the last chunk of a file) are
+    right-padded with zeros, which is what `length` is for. Since every row has
+    the same width, a whole record batch can be read back as one 2-D array
+    without copying anything.
+    '''
+    def __init__(
+        self,
+        output_file: str,
+        max_length: int,
+        token_dtype: np.dtype = np.dtype(np.int32),
+        rows_per_batch: int = 1024,
+    ) -> None:
+        self.max_length = max_length
+        self.token_dtype = np.dtype(token_dtype)
+        self.num_rows = 0
+        self.schema = pa.schema([
+            pa.field("input_ids", pa.list_(pa.from_numpy_dtype(self.token_dtype), max_length)),
+            pa.field("length", pa.int32()),
+        ])
+
+        self._tokens = np.zeros((rows_per_batch, max_length), dtype=self.token_dtype)
+        self._lengths = np.zeros(rows_per_batch, dtype=np.int32)
+        self._num_buffered = 0
+
+        self._sink = pa.OSFile(output_file, "wb")
+        self._writer: Optional[pa.ipc.RecordBatchFileWriter] = pa.ipc.new_file(self._sink, schema=self.schema)
+
+    def __enter__(self) -> "FixedLengthChunkWriter":
+        return self
+
+    def __exit__(self, *_exc_info) -> None:
+        self.close()
+
+    def write(self, chunk: np.ndarray) -> None:
+        assert len(chunk) <= self.max_length, \
+            f"Got a chunk of {len(chunk)} tokens, but rows only hold {self.max_length}."
+        row = self._tokens[self._num_buffered]
+        row[:len(chunk)] = chunk
+        row[len(chunk):] = 0
+        self._lengths[self._num_buffered] = len(chunk)
+        self._num_buffered += 1
+        self.num_rows += 1
+
+        if self._num_buffered == len(self._tokens):
+            self._flush()
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._flush()
+        self._writer.close()
+        self._sink.close()
+        self._writer = None
+
+    def _flush(self) -> None:
+        if self._num_buffered == 0:
+            return
+        num_rows = self._num_buffered
+        input_ids = pa.FixedSizeListArray.from_arrays(
+            pa.array(self._tokens[:num_rows].reshape(-1)), self.max_length)
+        lengths = pa.array(self._lengths[:num_rows])
+        self._writer.write(pa.record_batch([input_ids, lengths], schema=self.schema))
+        self._num_buffered = 0
+
+
+class ChunkPerBatchWriter:
+    '''
+    Writes UFT chunks in the original layout: every chunk is a record batch of
+    its own, holding a flat int64 `input_ids` column. Only kept around for
+    compatibility, `FixedLengthChunkWriter` is a lot smaller and faster to load.
+    '''
+    def __init__(self, output_file: str) -> None:
+        self.num_rows = 0
+        self.schema = pa.schema([pa.field("input_ids", pa.int64())])
+        self._sink = pa.OSFile(output_file, "wb")
+        self._writer: Optional[pa.ipc.RecordBatchFileWriter] = pa.ipc.new_file(self._sink, schema=self.schema)
+
+    def __enter__(self) -> "ChunkPerBatchWriter":
+        return self
+
+    def __exit__(self, *_exc_info) -> None:
+        self.close()
+
+    def write(self, chunk: np.ndarray) -> None:
+        self._writer.write(pa.record_batch([pa.array(chunk, type=pa.int64())], schema=self.schema))
+        self.num_rows += 1
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._sink.close()
+        self._writer = None
+
+
+def compact_sft_schema(token_dtype: np.dtype, packed: bool) -> pa.Schema:
+    '''
+    Schema of the compact SFT layout. Instead of an int64 `labels` column,
+    every row only stores how many of its leading tokens are prompt tokens,
+    and labels are rebuilt at training time. Packed rows store that for each of
+    their examples, next to `seq_lens`.
+    '''
+    fields = [pa.field("input_ids", pa.list_(pa.from_numpy_dtype(np.dtype(token_dtype))))]
+    if packed:
+        fields += [
+            pa.field("seq_lens", pa.list_(pa.int32())),
+            pa.field("prompt_lengths", pa.list_(pa.int32())),
+        ]
+    else:
+        fields.append(pa.field("prompt_length", pa.int32()))
+    return pa.schema(fields)
+
+
+def compact_sft_record_batch(
+    input_ids: np.ndarray,
+    labels: np.ndarray,
+    row_lengths: np.ndarray,
+    schema: pa.Schema,
+    seq_lens: Optional[np.ndarray] = None,
+    examples_per_row: Optional[np.ndarray] = None,
+) -> pa.RecordBatch:
+    '''
+    Builds a record batch in the compact SFT layout out of rows in the original
+    one, given as flat int64 `input_ids`/`labels` of all rows laid out back to
+    back, plus the length of every row. For packed rows, `seq_lens` holds the
+    length of every example (flattened over all rows) and `examples_per_row`
+    how many of them are in each row.
+
+    Raises a `ValueError` if the labels can't be rebuilt from the prompt
+    lengths, i.e. if they are anything other than IGNORE_INDEX for the prompt
+    followed by a copy of the response tokens.
+    '''
+    packed = seq_lens is not None
+    prompt_lengths = _prompt_lengths_from_labels(input_ids, labels, seq_lens if packed else row_lengths)
+
+    token_dtype = np.dtype(schema.field("input_ids").type.value_type.to_pandas_dtype())
+    if input_ids.max() > np.iinfo(token_dtype).max:
+        raise ValueError(f"Token IDs go up to {input_ids.max()}, which doesn't fit into {token_dtype}.")
+
+    columns = [pa.ListArray.from_arrays(_offsets(row_lengths), pa.array(input_ids.astype(token_dtype)))]
+    if packed:
+        example_offsets = _offsets(examples_per_row)
+        columns += [
+            pa.ListArray.from_arrays(example_offsets, pa.array(seq_lens.astype(np.int32))),
+            pa.ListArray.from_arrays(example_offsets, pa.array(prompt_lengths.astype(np.int32))),
+        ]
+    else:
+        columns.append(pa.array(prompt_lengths.astype(np.int32)))
+    return pa.record_batch(columns, schema=schema)
+
+
+def _prompt_lengths_from_labels(input_ids: np.ndarray, labels: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''
+    Counts the leading IGNORE_INDEX labels of every example, and checks that the
+    rest of the labels are a copy of the input IDs.
+
+    MAINTENANCE: Labels are rebuilt from these in ``./training/dataset.py``.
+    Make sure to keep both in sync.
+    '''
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(len(input_ids)) - np.repeat(starts, lengths)
+    is_ignored = labels == IGNORE_INDEX
+
+    # The first label which isn't ignored marks the end of the prompt.
+    prompt_lengths = np.minimum.reduceat(np.where(is_ignored, np.repeat(lengths, lengths), positions), starts)
+
+    is_prompt = positions < np.repeat(prompt_lengths, lengths)
+    if not (np.array_equal(is_prompt, is_ignored) and np.array_equal(labels[~is_ignored], input_ids[~is_ignored])):
+        raise ValueError("Labels can't be rebuilt from prompt lengths, so they can't be stored in the compact layout.")
+    return prompt_lengths
+
+
+def _offsets(lengths: np.ndarray) -> pa.Array:
+    return pa.array(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32))
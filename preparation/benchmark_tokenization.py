@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the preparation scripts. Everything runs offline: the input
+corpora are synthetic and, unless `--tokenizer-path` is given, a small BPE
+tokenizer is trained on the spot.
+
+Example: python preparation/benchmark_tokenization.py scaling --workers 1,2,4,8
+         python preparation/benchmark_tokenization.py stages --profile --output stages.json
+'''
+import argparse
+import cProfile
+import csv
+import functools
+import json
+import os
+import pstats
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from preprocessing_utils import setup_logging
+
+LOG = setup_logging("logs/benchmark--tokenization.log")
+
+PREPARATION_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_WORDS = [
+    "the", "a", "model", "user", "file", "lines", "shell", "command", "output",
+    "training", "data", "is", "are", "was", "not", "with", "from", "into",
+    "한국어", "데이터", "문장", "모델", "학습", "그리고", "하지만", "있다", "없다",
+]
+
+
+def main() -> None:
+    args = _parse_args_from_argv()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        tokenizer_path = args.tokenizer_path
+        if tokenizer_path is None:
+            tokenizer_path = os.path.join(tmp_dir, "tokenizer")
+            build_fixture_tokenizer(tokenizer_path, seed=args.seed)
+        args.func(args, tmp_dir, tokenizer_path)
+
+
+def benchmark_scaling(args: argparse.Namespace, tmp_dir: str, tokenizer_path: str) -> None:
+    '''Wall-clock time of both tokenization scripts with an increasing amount of worker processes.'''
+    sft_file = os.path.join(tmp_dir, "sft.jsonl")
+    uft_dir = os.path.join(tmp_dir, "uft")
+    write_synthetic_sft_jsonl(sft_file, args.num_rows, seed=args.seed)
+    write_synthetic_uft_jsonl_dir(uft_dir, args.num_files, args.num_rows // args.num_files, seed=args.seed)
+
+    workers = [int(w) for w in args.workers.split(",")]
+    runs = {
+        "sft": ["tokenize_data_sft.py", "-i", sft_file],
+        "sft --streaming": ["tokenize_data_sft.py", "-i", sft_file, "--streaming"],
+        "uft": ["tokenize_data_uft.py", "-i", uft_dir],
+    }
+    for name, command in runs.items():
+        baseline: Optional[float] = None
+        for num_workers in workers:
+            elapsed = _time_script([
+                *command,
+                "-o", os.path.join(tmp_dir, "out.arrow"),
+                "-t", tokenizer_path,
+                "-w", str(num_workers),
+            ])
+            baseline = baseline or elapsed
+            LOG.info("%s, %s worker(s): %.2fs (%.2fx speedup)", name, num_workers, elapsed, baseline / elapsed)
+
+
+def benchmark_stages(args: argparse.Namespace, tmp_dir: str, tokenizer_path: str) -> None:
+    '''
+    Times every stage of the SFT (CSV -> JSONL -> Arrow) and UFT (JSON -> JSONL
+    -> Arrow) pipelines on its own, in this process, by calling into the
+    preparation scripts: rows/s, tokens/s, peak RSS and, with `--profile`, the
+    functions that most of the time went into. Tokenization is run once per
+    `--workers` count. Afterwards, the tokenization scripts are run end to end
+    with all of their backends, so those can be compared too.
+    '''
+    workers = [int(w) for w in args.workers.split(",")]
+    report: Dict[str, Any] = dict(
+        config=dict(num_rows=args.num_rows, num_files=args.num_files, duplicate_ratio=args.duplicate_ratio,
+                    max_length=args.max_length, workers=workers, profile=args.profile,
+                    tokenizer=args.tokenizer_path or "fixture", seed=args.seed),
+        environment=dict(python=sys.version.split()[0], cpu_count=os.cpu_count()),
+        pipelines=dict(
+            sft=_benchmark_sft_stages(args, tmp_dir, tokenizer_path, workers),
+            uft=_benchmark_uft_stages(args, tmp_dir, tokenizer_path, workers),
+        ),
+        backends=[],
+    )
+
+    # The stages above left the tokenization scripts' inputs behind.
+    runs = {
+        "sft": ["tokenize_data_sft.py", "-i", os.path.join(tmp_dir, "sft.jsonl")],
+        "sft --streaming": ["tokenize_data_sft.py", "-i", os.path.join(tmp_dir, "sft.jsonl"), "--streaming"],
+        "uft": ["tokenize_data_uft.py", "-i", os.path.join(tmp_dir, "uft_jsonl")],
+        "uft --streaming": ["tokenize_data_uft.py", "-i", os.path.join(tmp_dir, "uft_jsonl"), "--streaming"],
+    }
+    for name, command in runs.items():
+        for num_workers in workers:
+            elapsed, peak_rss_kb = _run_script([
+                *command,
+                "-o", os.path.join(tmp_dir, "out.arrow"),
+                "-t", tokenizer_path,
+                "-l", str(args.max_length),
+                "-w", str(num_workers),
+            ])
+            LOG.info("End to end, %s, %s worker(s): %.2fs, peak RSS %.1f MiB",
+                     name, num_workers, elapsed, peak_rss_kb / 1024)
+            report["backends"].append(dict(backend=name, workers=num_workers, seconds=elapsed,
+                                           peak_rss_kb=peak_rss_kb))
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+        LOG.info("Wrote results to %s", args.output)
+    print(output)
+
+
+def _benchmark_sft_stages(
+    args: argparse.Namespace,
+    tmp_dir: str,
+    tokenizer_path: str,
+    workers: List[int],
+) -> List[Dict[str, Any]]:
+    import pandas as pd
+    import pyarrow as pa
+    from arrow_formats import compact_sft_schema, smallest_token_dtype
+    from dataset_index import DatasetIndexWriter
+    from parallel_tokenization import TokenizerPool, load_tokenizer
+    from reformat_sft_data import process_data
+    from tokenize_data_sft import _add_to_index, _process_training_examples_shard, _to_compact_record_batch
+
+    csv_file = os.path.join(tmp_dir, "sft.csv")
+    jsonl_file = os.path.join(tmp_dir, "sft.jsonl")
+    write_synthetic_sft_csv(csv_file, args.num_rows, seed=args.seed)
+    stages = []
+
+    def reformat():
+        return None, process_data(csv_file, jsonl_file, LOG), None
+    _, stats = _run_stage("sft", "reformat (CSV -> JSONL)", reformat, args)
+    stages.append(stats)
+
+    def read():
+        df = pd.read_json(jsonl_file, lines=True)
+        return df, len(df), None
+    df, stats = _run_stage("sft", "read", read, args)
+    stages.append(stats)
+
+    for num_workers in workers:
+        def tokenize():
+            with TokenizerPool(tokenizer_path, None, num_workers) as pool:
+                shards = [df.iloc[start:start + args.chunk_size] for start in range(0, len(df), args.chunk_size)]
+                tokenized = pd.concat(list(pool.imap(_process_training_examples_shard, shards)))
+            tokenized = tokenized.loc[tokenized["input_ids"].map(len) <= args.max_length]
+            return tokenized, len(df), int(tokenized["input_ids"].map(len).sum())
+        tokenized, stats = _run_stage("sft", f"tokenize ({num_workers} worker(s))", tokenize, args)
+        stages.append(stats)
+
+    def write():
+        tokenizer = load_tokenizer(tokenizer_path)
+        schema = compact_sft_schema(smallest_token_dtype(len(tokenizer)), packed=False)
+        table = pa.Table.from_batches([
+            _to_compact_record_batch(tokenized.iloc[start:start + args.chunk_size], schema)
+            for start in range(0, len(tokenized), args.chunk_size)
+        ], schema=schema)
+        output_file = os.path.join(tmp_dir, "sft.arrow")
+        with pa.OSFile(output_file, 'wb') as sink:
+            with pa.RecordBatchFileWriter(sink, table.schema) as writer:
+                writer.write_table(table)
+        index = DatasetIndexWriter(tokenizer, layout="compact")
+        _add_to_index(index, tokenized)
+        index.write(output_file)
+        return None, len(tokenized), int(tokenized["input_ids"].map(len).sum())
+    _, stats = _run_stage("sft", "arrow write", write, args)
+    stages.append(stats)
+
+    return stages
+
+
+def _benchmark_uft_stages(
+    args: argparse.Namespace,
+    tmp_dir: str,
+    tokenizer_path: str,
+    workers: List[int],
+) -> List[Dict[str, Any]]:
+    from arrow_formats import FixedLengthChunkWriter, smallest_token_dtype
+    from dataset_index import DatasetIndexWriter
+    from parallel_tokenization import TokenizerPool, load_tokenizer
+    from reformat_uft_data import HashDeduplicator, normalize_records, write_to_multiple_jsonl_files
+    from tokenize_data_uft import _tokenize_file
+
+    json_dir = os.path.join(tmp_dir, "uft_json")
+    jsonl_dir = os.path.join(tmp_dir, "uft_jsonl")
+    write_synthetic_uft_json_dir(json_dir, args.num_files, args.num_rows // args.num_files,
+                                 duplicate_ratio=args.duplicate_ratio, seed=args.seed)
+    json_files = sorted(os.path.join(json_dir, name) for name in os.listdir(json_dir))
+    stages = []
+
+    def read():
+        data = []
+        for json_file in json_files:
+            with open(json_file, 'r', encoding='utf-8-sig') as file:
+                data.append(json.load(file))
+        return data, sum(len(file_data["data"]) for file_data in data), None
+    data, stats = _run_stage("uft", "read", read, args)
+    stages.append(stats)
+
+    def normalize():
+        records = [normalize_records(file_data) for file_data in data]
+        return records, sum(len(file_records) for file_records in records), None
+    records, stats = _run_stage("uft", "normalize", normalize, args)
+    stages.append(stats)
+
+    def dedup():
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+            deduplicator = HashDeduplicator(spill_dir, args.memory_budget_mb * 2**20)
+            for file_records in records:
+                deduplicator.add(file_records)
+            sorted_file = os.path.join(spill_dir, "sorted.jsonl")
+            offsets, _ = deduplicator.write_sorted_unique(sorted_file)
+            num_unique = len(offsets) - 1
+
+            # Same as what reformat_uft_data.py does with the unique sentences
+            # afterwards, minus the shuffle.
+            os.makedirs(jsonl_dir, exist_ok=True)
+            with open(sorted_file, 'rb') as file:
+                write_to_multiple_jsonl_files(file, os.path.join(jsonl_dir, "unique"), args.max_line)
+        LOG.info("Kept %s of %s sentences.", num_unique, sum(len(file_records) for file_records in records))
+        return None, sum(len(file_records) for file_records in records), None
+    _, stats = _run_stage("uft", "dedup", dedup, args)
+    stages.append(stats)
+    jsonl_files = sorted(os.path.join(jsonl_dir, name) for name in os.listdir(jsonl_dir))
+
+    for num_workers in workers:
+        def tokenize():
+            tokenize_fn = functools.partial(_tokenize_file, max_length=args.max_length)
+            with TokenizerPool(tokenizer_path, None, num_workers) as pool:
+                results = list(pool.imap(tokenize_fn, jsonl_files))
+            return results, sum(num_sents for _, _, num_sents in results), \
+                sum(num_tokens for _, num_tokens, _ in results)
+        results, stats = _run_stage("uft", f"tokenize ({num_workers} worker(s))", tokenize, args)
+        stages.append(stats)
+
+    def write():
+        tokenizer = load_tokenizer(tokenizer_path)
+        index = DatasetIndexWriter(tokenizer, layout="fixed")
+        output_file = os.path.join(tmp_dir, "uft.arrow")
+        with FixedLengthChunkWriter(output_file, args.max_length, smallest_token_dtype(len(tokenizer))) as writer:
+            for file_tokens, _, _ in results:
+                for chunk in file_tokens:
+                    writer.write(chunk)
+                index.add([len(chunk) for chunk in file_tokens])
+        index.write(output_file)
+        return None, writer.num_rows, sum(num_tokens for _, num_tokens, _ in results)
+    _, stats = _run_stage("uft", "arrow write", write, args)
+    stages.append(stats)
+
+    return stages
+
+
+def _run_stage(
+    pipeline: str,
+    name: str,
+    fn: Callable[[], Tuple[Any, int, Optional[int]]],
+    args: argparse.Namespace,
+) -> Tuple[Any, Dict[str, Any]]:
+    '''
+    Runs a single stage, which returns `(result, rows processed, tokens
+    processed or None)`, and measures it. Returns `result`, so the next stage
+    can pick it up, and the measurements.
+
+    Peak RSS is this process' own: worker processes aren't included, which
+    is what the end-to-end runs are for.
+    '''
+    peak_rss_is_per_stage = _reset_peak_rss()
+    rss_before = _read_proc_status_kb(("VmRSS",))["VmRSS"]
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        result, num_rows, num_tokens = profiler.runcall(fn)
+    else:
+        result, num_rows, num_tokens = fn()
+    elapsed = time.perf_counter() - start
+
+    memory = _read_proc_status_kb(("VmRSS", "VmHWM"))
+    stats: Dict[str, Any] = dict(
+        stage=name,
+        seconds=elapsed,
+        rows=num_rows,
+        rows_per_s=num_rows / elapsed,
+        tokens=num_tokens,
+        tokens_per_s=num_tokens / elapsed if num_tokens is not None else None,
+        # If the peak couldn't be reset, this is the peak since the process started.
+        peak_rss_kb=memory["VmHWM"],
+        peak_rss_is_per_stage=peak_rss_is_per_stage,
+        rss_growth_kb=memory["VmRSS"] - rss_before,
+    )
+    LOG.info("%s, %s: %.2fs, %.0f rows/s%s, peak RSS %.1f MiB", pipeline, name, elapsed, stats["rows_per_s"],
+             f", {stats['tokens_per_s']:.0f} tokens/s" if num_tokens is not None else "", memory["VmHWM"] / 1024)
+
+    if profiler is not None:
+        stats["hotspots"] = _hotspots(profiler, args.top_functions)
+        for hotspot in stats["hotspots"]:
+            LOG.info("    %6.2fs own / %6.2fs total in %s calls of %s",
+                     hotspot["own_seconds"], hotspot["total_seconds"], hotspot["calls"], hotspot["function"])
+    return result, stats
+
+
+def _hotspots(profiler: cProfile.Profile, top_n: int) -> List[Dict[str, Any]]:
+    '''The `top_n` functions that the most time was spent in (not counting the functions they called).'''
+    hotspots = []
+    for (filename, line, function), (_, num_calls, own_time, total_time, _) in pstats.Stats(profiler).stats.items():
+        hotspots.append(dict(
+            function=f"{os.path.basename(filename)}:{line}({function})",
+            calls=num_calls,
+            own_seconds=own_time,
+            total_seconds=total_time,
+        ))
+    return sorted(hotspots, key=lambda hotspot: -hotspot["own_seconds"])[:top_n]
+
+
+def _reset_peak_rss() -> bool:
+    '''Resets this process' peak RSS (`VmHWM`), if the kernel lets us. Returns whether it did.'''
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _read_proc_status_kb(keys: Iterable[str]) -> Dict[str, int]:
+    '''Reads memory stats (in KiB) for the current process from /proc/self/status.'''
+    stats = {}
+    with open("/proc/self/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in keys:
+                stats[key] = int(value.split()[0])
+    return stats
+
+
+def verify_sft_batching(args: argparse.Namespace, tmp_dir: str, tokenizer_path: str) -> None:
+    '''
+    Checks that the batched SFT example processing produces byte-identical
+    arrays to the original row-by-row function. Unless a tokenizer is given,
+    this runs against a GPT-style and a LLaMA-style fixture tokenizer, so both
+    of the EOS/BOS code paths get exercised.
+    '''
+    import pandas as pd
+    from parallel_tokenization import load_tokenizer
+    from tokenize_data_sft import _process_training_example, _process_training_examples
+
+    tokenizer_paths = {"tokenizer": tokenizer_path}
+    if args.tokenizer_path is None:
+        tokenizer_paths["llama-style tokenizer"] = os.path.join(tmp_dir, "llama_tokenizer")
+        build_fixture_tokenizer(tokenizer_paths["llama-style tokenizer"], seed=args.seed, llama_style=True)
+
+    sft_file = os.path.join(tmp_dir, "sft.jsonl")
+    write_synthetic_sft_jsonl(sft_file, args.num_rows, seed=args.seed)
+    df = pd.read_json(sft_file, lines=True)
+
+    for name, path in tokenizer_paths.items():
+        tokenizer = load_tokenizer(path)
+        reference = df.apply(lambda x: _process_training_example(tokenizer, x), axis=1)
+        batched = _process_training_examples(tokenizer,
+                                             df["prompt"].to_list(),
+                                             df["generation"].to_list(),
+                                             index=df.index)
+
+        for column in ("input_ids", "labels"):
+            for expected, actual in zip(reference[column], batched[column]):
+                assert expected.dtype == actual.dtype and expected.tobytes() == actual.tobytes(), \
+                    f"Batched processing produced different `{column}` with the {name}."
+        LOG.info("%s: batched processing is byte-identical on %s examples.", name, len(df))
+
+
+def build_fixture_tokenizer(output_dir: str, vocab_size: int = 2000, seed: int = 42, llama_style: bool = False) -> None:
+    '''
+    Trains a small byte-level BPE tokenizer on synthetic text, so benchmarks
+    don't need network access. With `llama_style`, it uses `<s>`/`</s>` and
+    prepends BOS like the LLaMA tokenizer does.
+    '''
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    rng = random.Random(seed)
+    texts = [_random_text(rng, 64) for _ in range(5000)]
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    special_tokens = ["<s>", "</s>"] if llama_style else ["<|endoftext|>"]
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=special_tokens,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    ))
+
+    if llama_style:
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="<s> $A", special_tokens=[("<s>", tokenizer.token_to_id("<s>"))])
+        fast_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>")
+    else:
+        fast_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>")
+    fast_tokenizer.save_pretrained(output_dir)
+
+
+def write_synthetic_sft_jsonl(filepath: str, num_rows: int, seed: int = 42) -> None:
+    '''Writes `prompt`/`generation` pairs of widely varying lengths.'''
+    rng = random.Random(seed)
+    with open(filepath, "w", encoding="utf-8") as file:
+        for _ in range(num_rows):
+            file.write(json.dumps({
+                "prompt": f"<|user|>{_random_text(rng, rng.randint(4, 200))}<|model|>",
+                "generation": _random_text(rng, rng.randint(4, 600)),
+            }, ensure_ascii=False) + "\n")
+
+
+def write_synthetic_sft_csv(filepath: str, num_rows: int, seed: int = 42) -> None:
+    '''Writes prompts and generations in the CSV format that reformat_sft_data.py reads (`ID`/`ans_ID`).'''
+    rng = random.Random(seed)
+    with open(filepath, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["ID", "ans_ID"])
+        for _ in range(num_rows):
+            writer.writerow([f"<|user|>{_random_text(rng, rng.randint(4, 200))}<|model|>",
+                             _random_text(rng, rng.randint(4, 600))])
+
+
+def write_synthetic_uft_json_dir(
+    output_dir: str,
+    num_files: int,
+    rows_per_file: int,
+    duplicate_ratio: float = 0.1,
+    seed: int = 42,
+) -> None:
+    '''
+    Writes raw files in the format that reformat_uft_data.py reads. About
+    `duplicate_ratio` of the sentences are copies of earlier ones, with
+    different whitespace, so both normalization and deduplication have
+    something to do.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    sentences: List[Tuple[str, str]] = []
+    for file_idx in range(num_files):
+        data = []
+        for row_idx in range(rows_per_file):
+            if sentences and rng.random() < duplicate_ratio:
+                sen_id, text = rng.choice(sentences)
+                text = text.replace(" ", rng.choice(["  ", " \n", "\t"]), 1)
+            else:
+                sen_id, text = f"{file_idx}-{row_idx}", _random_text(rng, rng.randint(4, 120))
+                sentences.append((sen_id, text))
+            data.append({"Sen_ID": sen_id, "Raw_data": f" {text} "})
+        with open(os.path.join(output_dir, f"synthetic_{file_idx}.json"), "w", encoding="utf-8") as file:
+            json.dump({"data": data}, file, ensure_ascii=False)
+
+
+def write_synthetic_uft_jsonl_dir(output_dir: str, num_files: int, rows_per_file: int, seed: int = 42) -> None:
+    '''Writes files in the format produced by reformat_uft_data.py.'''
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    for file_idx in range(num_files):
+        with open(os.path.join(output_dir, f"synthetic_{file_idx}.jsonl"), "w", encoding="utf-8") as file:
+            for row_idx in range(rows_per_file):
+                file.write(json.dumps({
+                    "Sen_ID": f"{file_idx}-{row_idx}",
+                    "Sentence": _random_text(rng, rng.randint(4, 120)),
+                }, ensure_ascii=False) + "\n")
+
+
+def _random_text(rng: random.Random, num_words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(num_words))
+
+
+def _time_script(argv: List[str]) -> float:
+    return _run_script(argv)[0]
+
+
+def _run_script(argv: List[str]) -> Tuple[float, int]:
+    '''Runs one of the preparation scripts, and returns how long it took and its peak RSS (in KiB).'''
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(PREPARATION_DIR, argv[0]), *argv[1:]],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # NOTE: `ru_maxrss` is the biggest of the script's and its worker
+    # processes' peaks, not their sum.
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    return elapsed, rusage.ru_maxrss
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Tokenization benchmarks.")
+    parser.add_argument("--tokenizer-path", default=None,
+                        help="HF tokenizer to benchmark with. Defaults to a small tokenizer trained on the spot.")
+    parser.add_argument("--tmp-dir", default=None, help="Where to write the synthetic corpora and outputs.")
+    parser.add_argument("--seed", type=int, default=42)
+    subparsers = parser.add_subparsers(required=True)
+
+    scaling = subparsers.add_parser("scaling", help="Scaling of the tokenization scripts from 1 to N worker processes.")
+    scaling.add_argument("--workers", default=f"1,2,4,{os.cpu_count()}",
+                         help="Comma-separated worker counts to try.")
+    scaling.add_argument("--num-rows", type=int, default=50000)
+    scaling.add_argument("--num-files", type=int, default=64, help="Number of UFT input files.")
+    scaling.set_defaults(func=benchmark_scaling)
+
+    stages = subparsers.add_parser("stages", help="Per-stage throughput, memory and profile of the preparation pipelines.")
+    stages.add_argument("--workers", default="1,4", help="Comma-separated worker counts to tokenize with.")
+    stages.add_argument("--num-rows", type=int, default=20000)
+    stages.add_argument("--num-files", type=int, default=32, help="Number of raw UFT input files.")
+    stages.add_argument("--duplicate-ratio", type=float, default=0.1,
+                        help="Fraction of UFT sentences that are (whitespace-mangled) copies of others.")
+    stages.add_argument("--max-length", type=int, default=2048)
+    stages.add_argument("--chunk-size", type=int, default=1000, help="Examples per SFT tokenization shard.")
+    stages.add_argument("--max-line", type=int, default=1000, help="Lines per deduplicated UFT file.")
+    stages.add_argument("--memory-budget-mb", type=int, default=4096, help="Before deduplication spills to disk.")
+    stages.add_argument("--profile", action="store_true",
+                        help="Run every stage under cProfile and report hotspots. Slows everything down, and only "
+                             "sees what happens in this process.")
+    stages.add_argument("--top-functions", type=int, default=10, help="How many hotspots to report per stage.")
+    stages.add_argument("--output", default=None, help="Also write the JSON results to this file.")
+    stages.set_defaults(func=benchmark_stages)
+
+    verify_sft = subparsers.add_parser("verify-sft", help="Check batched SFT processing against the row-by-row function.")
+    verify_sft.add_argument("--num-rows", type=int, default=2000)
+    verify_sft.set_defaults(func=verify_sft_batching)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
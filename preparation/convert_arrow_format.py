@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''
+Converts tokenized Arrow files written in an older layout into the current one,
+without having to tokenize everything again.
+
+- UFT: one int64 record batch per chunk -> fixed-width rows (see `FixedLengthChunkWriter`)
+- SFT: int64 `input_ids` and `labels` -> compact layout (see `compact_sft_schema`)
+
+Example: python preparation/convert_arrow_format.py uft -i train.arrow -o train.fixed.arrow
+'''
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from arrow_formats import FixedLengthChunkWriter, compact_sft_record_batch, compact_sft_schema, smallest_token_dtype
+from preprocessing_utils import setup_logging
+
+LOG = setup_logging("logs/preprocessing--convert_arrow_format.log")
+
+from tqdm_logging import logging_tqdm
+
+
+def main() -> None:
+    args = _parse_args_from_argv()
+    args.func(args)
+    LOG.info("Done! %s (%.1f MiB) -> %s (%.1f MiB)",
+             args.input_file, os.path.getsize(args.input_file) / 2**20,
+             args.output_file, os.path.getsize(args.output_file) / 2**20)
+
+
+def convert_uft(args: argparse.Namespace) -> None:
+    reader = pa.ipc.RecordBatchFileReader(pa.memory_map(args.input_file, "r"))
+    assert not pa.types.is_fixed_size_list(reader.schema.field("input_ids").type), \
+        f"{args.input_file} already uses the fixed-width layout."
+
+    # One pass over the file to find out the row width and token dtype...
+    max_length, max_token_id = 0, 0
+    for i in range(reader.num_record_batches):
+        chunk = reader.get_batch(i).column("input_ids")
+        max_length = max(max_length, len(chunk))
+        max_token_id = max(max_token_id, pc.max(chunk).as_py() or 0)
+    token_dtype = smallest_token_dtype(args.vocab_size or max_token_id + 1)
+    LOG.info(f"{reader.num_record_batches:,} chunks of up to {max_length:,} tokens, storing token IDs as {token_dtype}.")
+
+    # ...and another one to actually write them out.
+    with FixedLengthChunkWriter(args.output_file, max_length, token_dtype, args.rows_per_batch) as writer:
+        for i in logging_tqdm(range(reader.num_record_batches), desc="Converting"):
+            writer.write(reader.get_batch(i).column("input_ids").to_numpy())
+
+
+def convert_sft(args: argparse.Namespace) -> None:
+    reader = pa.ipc.RecordBatchFileReader(pa.memory_map(args.input_file, "r"))
+    assert "labels" in reader.schema.names, f"{args.input_file} already uses the compact layout."
+    packed = "seq_lens" in reader.schema.names
+
+    vocab_size = args.vocab_size
+    if vocab_size is None:
+        vocab_size = 1 + max((pc.max(reader.get_batch(i).column("input_ids").flatten()).as_py() or 0)
+                             for i in range(reader.num_record_batches))
+    schema = compact_sft_schema(smallest_token_dtype(vocab_size), packed=packed)
+    LOG.info(f"Storing token IDs as {schema.field('input_ids').type.value_type}.")
+
+    with pa.OSFile(args.output_file, "wb") as sink, pa.ipc.new_file(sink, schema=schema) as writer:
+        for i in logging_tqdm(range(reader.num_record_batches), desc="Converting"):
+            batch = reader.get_batch(i)
+            if batch.num_rows == 0:
+                continue
+            seq_lens, examples_per_row = None, None
+            if packed:
+                seq_lens = batch.column("seq_lens").flatten().to_numpy()
+                examples_per_row = pc.list_value_length(batch.column("seq_lens")).to_numpy()
+            writer.write(compact_sft_record_batch(
+                batch.column("input_ids").flatten().to_numpy(),
+                batch.column("labels").flatten().to_numpy(),
+                pc.list_value_length(batch.column("input_ids")).to_numpy(),
+                schema,
+                seq_lens=seq_lens,
+                examples_per_row=examples_per_row,
+            ))
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Converts tokenized Arrow files into the current layout.")
+    subparsers = parser.add_subparsers(required=True)
+
+    uft = subparsers.add_parser("uft", help="One record batch per chunk -> fixed-width rows.")
+    uft.add_argument("-i", "--input-file", required=True, help="Tokenized file in the old layout.")
+    uft.add_argument("-o", "--output-file", required=True, help="Where to write the converted file.")
+    uft.add_argument("--vocab-size", type=int, default=None,
+                     help="Tokenizer vocabulary size, used to pick the token dtype. Defaults to the highest token ID in the file + 1.")
+    uft.add_argument("--rows-per-batch", type=int, default=1024, help="How many chunks to put into each record batch.")
+    uft.set_defaults(func=convert_uft)
+
+    sft = subparsers.add_parser("sft", help="int64 input_ids/labels -> compact token dtype and prompt lengths.")
+    sft.add_argument("-i", "--input-file", required=True, help="Tokenized file in the old layout.")
+    sft.add_argument("-o", "--output-file", required=True, help="Where to write the converted file.")
+    sft.add_argument("--vocab-size", type=int, default=None,
+                     help="Tokenizer vocabulary size, used to pick the token dtype. Defaults to the highest token ID in the file + 1.")
+    sft.set_defaults(func=convert_sft)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+'''
+Sidecar index files with per-row statistics of a tokenized Arrow file.
+
+The index is written next to the dataset as `<output file>.idx`, so the
+training code can get at row lengths (for length grouping, packing, ETAs...)
+without scanning the whole dataset. It's a small Arrow file itself:
+
+- `length`: `int32`, the amount of tokens in every row
+- `prompt_tokens`: `int32`, how many of them aren't trained on (always 0 for UFT)
+
+Its schema metadata holds a JSON summary: totals, a length histogram, a
+fingerprint of the tokenizer and the size of the dataset file it describes.
+
+MAINTENANCE: This is read by ``./training/dataset.py``. Make sure to keep
+both sides in sync.
+'''
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+from transformers import PreTrainedTokenizer
+
+INDEX_FORMAT_VERSION = 1
+HISTOGRAM_BIN_WIDTH = 64
+
+
+def index_path_for(arrow_file: str) -> str:
+    return f"{arrow_file}.idx"
+
+
+def vocab_fingerprint(tokenizer: PreTrainedTokenizer) -> str:
+    '''
+    Hash of a tokenizer's vocabulary (added tokens included) and special
+    tokens, which is all the training code needs to agree on with the data.
+    Goes into the index, so training can check that a dataset's token IDs mean
+    the same to its tokenizer.
+
+    This is the vocabulary-only part of `shard_cache.tokenizer_fingerprint`,
+    which adds the rest of what changes the tokens for its cache keys. Don't
+    use that one here: e.g. the slow and fast versions of a tokenizer get
+    different cache keys, but token IDs mean the same thing to both.
+
+    MAINTENANCE: This is copy-pasted into ``./training/dataset.py``. Keep
+    both implementations in sync.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class DatasetIndexWriter:
+    '''Collects per-row statistics while a dataset is being written, then writes them out as its index.'''
+    def __init__(self, tokenizer: PreTrainedTokenizer, layout: str) -> None:
+        self.metadata: Dict[str, Any] = {
+            "version": INDEX_FORMAT_VERSION,
+            "layout": layout,
+            "tokenizer_fingerprint": vocab_fingerprint(tokenizer),
+            "vocab_size": len(tokenizer),
+        }
+        self._lengths: List[np.ndarray] = []
+        self._prompt_tokens: List[np.ndarray] = []
+
+    def add(self, lengths: np.ndarray, prompt_tokens: Optional[np.ndarray] = None) -> None:
+        '''Adds the next rows' lengths and (for SFT) how many of their tokens are prompt tokens.'''
+        lengths = np.asarray(lengths, dtype=np.int32)
+        self._lengths.append(lengths)
+        if prompt_tokens is None:
+            prompt_tokens = np.zeros_like(lengths)
+        self._prompt_tokens.append(np.asarray(prompt_tokens, dtype=np.int32))
+
+    def write(self, arrow_file: str) -> str:
+        '''Writes the index for the (already written) `arrow_file`, and returns its path.'''
+        lengths = np.concatenate(self._lengths) if self._lengths else np.empty(0, dtype=np.int32)
+        prompt_tokens = np.concatenate(self._prompt_tokens) if self._prompt_tokens else np.empty(0, dtype=np.int32)
+
+        num_tokens = int(lengths.sum(dtype=np.int64))
+        num_prompt_tokens = int(prompt_tokens.sum(dtype=np.int64))
+        max_length = int(lengths.max()) if len(lengths) else 0
+        bin_edges = np.arange(0, max_length + HISTOGRAM_BIN_WIDTH + 1, HISTOGRAM_BIN_WIDTH)
+        counts, _ = np.histogram(lengths, bins=bin_edges)
+
+        metadata = dict(
+            self.metadata,
+            arrow_file_size=os.path.getsize(arrow_file),
+            num_rows=len(lengths),
+            num_tokens=num_tokens,
+            num_prompt_tokens=num_prompt_tokens,
+            num_response_tokens=num_tokens - num_prompt_tokens,
+            max_length=max_length,
+            histogram=dict(bin_edges=bin_edges.tolist(), counts=counts.tolist()),
+        )
+        table = pa.table(
+            {"length": pa.array(lengths), "prompt_tokens": pa.array(prompt_tokens)},
+        ).replace_schema_metadata({"dataset_index": json.dumps(metadata)})
+
+        index_path = index_path_for(arrow_file)
+        with pa.OSFile(index_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        return index_path
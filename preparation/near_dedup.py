@@ -0,0 +1,189 @@
+'''
+Near-duplicate detection with MinHash signatures and LSH banding.
+
+Every sentence is turned into a set of character n-grams, which is summarized
+by a MinHash signature: the fraction of positions at which two signatures agree
+estimates the Jaccard similarity of the two sets. Signatures are then cut into
+bands, and sentences which share a whole band with another one become
+candidates. Candidates whose estimated similarity reaches the threshold end up
+in the same cluster, of which only one sentence is kept.
+'''
+import json
+import logging
+import mmap
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_SHINGLE_BASE = np.uint64(1_000_003)
+
+
+def make_permutations(num_perm: int, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    '''Random `(a, b)` coefficients of the `num_perm` hash functions `(a * x + b) mod p`.'''
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(text: str, ngram_size: int) -> np.ndarray:
+    '''32-bit hashes of all the character n-grams of `text` (or of `text` itself, if it's shorter than that).'''
+    codepoints = np.frombuffer(text.lower().encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codepoints) == 0:
+        return np.zeros(1, dtype=np.uint64)
+
+    ngram_size = min(ngram_size, len(codepoints))
+    num_shingles = len(codepoints) - ngram_size + 1
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    for offset in range(ngram_size):
+        # Overflowing is fine here, it's all modulo 2**64.
+        hashes = hashes * _SHINGLE_BASE + codepoints[offset:offset + num_shingles]
+    return np.unique((hashes ^ (hashes >> np.uint64(32))) & _MAX_HASH)
+
+
+def minhash_signature(text: str, permutations: Tuple[np.ndarray, np.ndarray], ngram_size: int) -> np.ndarray:
+    a, b = permutations
+    hashes = shingle_hashes(text, ngram_size)
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(a, hashes) + b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def signatures_for_lines(task: Tuple[str, np.ndarray, int, int, int]) -> np.ndarray:
+    '''
+    MinHash signatures for a run of lines of a JSONL file of sentences, given
+    as `(file name, line offsets, num_perm, ngram_size, seed)`. Runs in the
+    worker processes, which is why it reads the lines itself.
+    '''
+    file_name, offsets, num_perm, ngram_size, seed = task
+    permutations = make_permutations(num_perm, seed)
+    signatures = np.empty((len(offsets) - 1, num_perm), dtype=np.uint32)
+    with open(file_name, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as lines:
+        for idx in range(len(offsets) - 1):
+            sentence = json.loads(lines[offsets[idx]:offsets[idx + 1]])["Sentence"]
+            signatures[idx] = minhash_signature(sentence, permutations, ngram_size)
+    return signatures
+
+
+def optimal_lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    '''
+    Number of bands and rows per band which minimize the (equally weighted)
+    probabilities of false positives and false negatives around `threshold`.
+    '''
+    num_steps = 1000
+    similarities = (np.arange(num_steps) + 0.5) / num_steps
+    below = similarities < threshold
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        candidate_probability = 1 - (1 - similarities ** rows) ** bands
+        false_positives = candidate_probability[below].sum() / num_steps
+        false_negatives = (1 - candidate_probability[~below]).sum() / num_steps
+        if false_positives + false_negatives < best_error:
+            best, best_error = (bands, rows), false_positives + false_negatives
+    return best
+
+
+def find_near_duplicates(
+    signatures: np.ndarray,
+    threshold: float,
+    bands: Optional[int] = None,
+    rows: Optional[int] = None,
+) -> Tuple[np.ndarray, Dict[str, float]]:
+    '''
+    Clusters near-duplicate sentences. Returns which sentences to keep (the
+    first one of every cluster) and some statistics about the clusters.
+    '''
+    num_sentences, num_perm = signatures.shape
+    if bands is None or rows is None:
+        bands, rows = optimal_lsh_params(threshold, num_perm)
+
+    # Bands are hashed into a single number each. Collisions only add
+    # candidates, which then get filtered out by the similarity check anyway.
+    multipliers = make_permutations(rows, seed=0)[0]
+    parents = list(range(num_sentences))
+    for band in range(bands):
+        with np.errstate(over="ignore"):
+            keys = (signatures[:, band * rows:(band + 1) * rows].astype(np.uint64) * multipliers).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        # Within each bucket, compare everything to the bucket's first member.
+        is_bucket_start = np.ones(num_sentences, dtype=bool)
+        is_bucket_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        bucket_heads = order[np.maximum.accumulate(np.where(is_bucket_start, np.arange(num_sentences), 0))]
+        candidates = np.flatnonzero(~is_bucket_start)
+        heads, members = bucket_heads[candidates], order[candidates]
+        similar = np.mean(signatures[heads] == signatures[members], axis=1) >= threshold
+        for head, member in zip(heads[similar].tolist(), members[similar].tolist()):
+            _union(parents, head, member)
+
+    roots = np.array([_find(parents, idx) for idx in range(num_sentences)], dtype=np.int64)
+    keep = roots == np.arange(num_sentences)
+    cluster_sizes = np.bincount(roots, minlength=num_sentences)
+    cluster_sizes = cluster_sizes[cluster_sizes > 1]
+    stats = {
+        "sentences": num_sentences,
+        "bands": bands,
+        "rows_per_band": rows,
+        "clusters": len(cluster_sizes),
+        "sentences_in_clusters": int(cluster_sizes.sum()),
+        "dropped": int(num_sentences - keep.sum()),
+        "max_cluster_size": int(cluster_sizes.max()) if len(cluster_sizes) else 0,
+        "mean_cluster_size": float(cluster_sizes.mean()) if len(cluster_sizes) else 0.0,
+    }
+    return keep, stats
+
+
+def near_dedup_file(
+    pool,
+    file_name: str,
+    offsets: np.ndarray,
+    threshold: float,
+    num_perm: int = 128,
+    ngram_size: int = 5,
+    seed: int = 42,
+    lines_per_task: int = 10000,
+) -> np.ndarray:
+    '''
+    Near-deduplicates the sentences of a JSONL file, whose lines start at
+    `offsets`. Signatures are computed on `pool`. Returns a mask of the lines
+    to keep.
+    '''
+    num_lines = len(offsets) - 1
+    if num_lines == 0:
+        return np.ones(0, dtype=bool)
+
+    tasks = [
+        (file_name, offsets[start:min(start + lines_per_task, num_lines) + 1], num_perm, ngram_size, seed)
+        for start in range(0, num_lines, lines_per_task)
+    ]
+    signatures = np.concatenate(pool.map(signatures_for_lines, tasks))
+
+    keep, stats = find_near_duplicates(signatures, threshold)
+    LOG.info("Near-dedup (Jaccard >= %s, %s bands of %s rows): %s sentences in %s clusters "
+             "(largest: %s, mean size: %.2f), dropped %s of %s sentences (%.2f%%).",
+             threshold, stats["bands"], stats["rows_per_band"], stats["sentences_in_clusters"],
+             stats["clusters"], stats["max_cluster_size"], stats["mean_cluster_size"],
+             stats["dropped"], stats["sentences"], 100 * stats["dropped"] / stats["sentences"])
+    return keep
+
+
+def _find(parents: List[int], idx: int) -> int:
+    root = idx
+    while parents[root] != root:
+        root = parents[root]
+    while parents[idx] != root:
+        parents[idx], idx = root, parents[idx]
+    return root
+
+
+def _union(parents: List[int], a: int, b: int) -> None:
+    # The smaller index becomes the root, so the first sentence of a cluster is the one that's kept.
+    root_a, root_b = _find(parents, a), _find(parents, b)
+    if root_a != root_b:
+        parents[max(root_a, root_b)] = min(root_a, root_b)
@@ -0,0 +1,121 @@
+import collections
+import multiprocessing
+import multiprocessing.pool
+import os
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from transformers import AddedToken, AutoTokenizer, PreTrainedTokenizer
+
+# Tokenizer loaded by each worker process, see `_init_worker`.
+_WORKER_TOKENIZER: Optional[PreTrainedTokenizer] = None
+
+
+def load_tokenizer(tokenizer_path: str, add_special_tokens: Optional[str] = None) -> PreTrainedTokenizer:
+    '''Loads the tokenizer the same way for every tokenization script and worker.'''
+    # OpenLLaMA's fast tokenizer is broken on the stable release of transformers.
+    # TODO(TG): When newest transformers version which has fixed tokenizer is released,
+    # do a version check.
+    is_openllama = 'open_llama' in tokenizer_path or 'open-llama' in tokenizer_path
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_fast=not is_openllama)
+
+    if add_special_tokens is not None:
+        # MAINTENANCE(11b): Big fat warning: the snippet below is copy-pasted
+        # into ``./training/hf_trainer.py``. Make sure to always keep both
+        # implementations in sync.
+        special_token_contents = add_special_tokens.split(",")
+        special_tokens = [
+            AddedToken(
+                # Heads up: this is very poorly documented in HuggingFace and
+                # some old forum discussions mention that it's apparently
+                # exclusive to the Rust-based tokenizers? If anything seems
+                # funky about the special token behavior, this is a good place
+                # to look.
+                content, lstrip=True, rstrip=True)
+            for content in special_token_contents
+        ]
+
+        tokenizer.add_special_tokens(
+            {"additional_special_tokens": special_tokens})
+
+    return tokenizer
+
+
+class TokenizerPool:
+    '''
+    Runs `fn(tokenizer, shard)` over shards of the input on a pool of worker
+    processes, each of which loads the tokenizer once when it starts up.
+
+    Results are yielded in the same order as the shards, and only a bounded
+    amount of shards is in flight at any time, so the input can be a lazy
+    iterator over a file that doesn't fit into memory. `fn` must be a
+    module-level function (or a `functools.partial` of one) so it can be
+    pickled over to the workers.
+
+    With `num_workers <= 1`, everything runs in the current process instead,
+    with `tokenizer` if the caller already loaded it.
+    '''
+
+    def __init__(
+        self,
+        tokenizer_path: str,
+        add_special_tokens: Optional[str] = None,
+        num_workers: int = 1,
+        max_shards_in_flight: Optional[int] = None,
+        tokenizer: Optional[PreTrainedTokenizer] = None,
+    ) -> None:
+        self.num_workers = num_workers
+        self.max_shards_in_flight = max_shards_in_flight or 2 * num_workers
+
+        self.tokenizer: Optional[PreTrainedTokenizer] = None
+        self._pool: Optional[multiprocessing.pool.Pool] = None
+        if num_workers <= 1:
+            self.tokenizer = tokenizer if tokenizer is not None else load_tokenizer(tokenizer_path, add_special_tokens)
+        else:
+            self._pool = multiprocessing.Pool(
+                processes=num_workers,
+                initializer=_init_worker,
+                initargs=(tokenizer_path, add_special_tokens),
+            )
+
+    def __enter__(self) -> "TokenizerPool":
+        return self
+
+    def __exit__(self, exc_type, *_exc_info) -> None:
+        if exc_type is not None and self._pool is not None:
+            # Don't wait around for the remaining shards if something broke.
+            self._pool.terminate()
+        self.close()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def imap(self, fn: Callable[[PreTrainedTokenizer, Any], Any], shards: Iterable[Any]) -> Iterator[Any]:
+        if self._pool is None:
+            for shard in shards:
+                yield fn(self.tokenizer, shard)
+            return
+
+        # NOTE: `Pool.imap` would eagerly pull every shard out of `shards`,
+        # which defeats the point of streaming the input.
+        in_flight = collections.deque()
+        for shard in shards:
+            in_flight.append(self._pool.apply_async(_run_in_worker, (fn, shard)))
+            if len(in_flight) >= self.max_shards_in_flight:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+
+
+def _init_worker(tokenizer_path: str, add_special_tokens: Optional[str]) -> None:
+    global _WORKER_TOKENIZER
+    # Every worker already gets its own core, so don't have the Rust
+    # tokenizers oversubscribe them with their own thread pools.
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _WORKER_TOKENIZER = load_tokenizer(tokenizer_path, add_special_tokens)
+
+
+def _run_in_worker(fn: Callable[[PreTrainedTokenizer, Any], Any], shard: Any) -> Any:
+    return fn(_WORKER_TOKENIZER, shard)
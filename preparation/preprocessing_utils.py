@@ -25,8 +25,11 @@ def setup_logging(log_path):
     c_handler.setFormatter(all_format)
     f_handler.setFormatter(all_format)
 
-    # Add handlers to the logger
-    logger.addHandler(c_handler)
+    # Add handlers to the logger. Only one console handler though, in case
+    # more than one script sets up logging in the same process (e.g. when
+    # benchmarking).
+    if not any(type(handler) is logging.StreamHandler for handler in logger.handlers):
+        logger.addHandler(c_handler)
     logger.addHandler(f_handler)
 
     return logger
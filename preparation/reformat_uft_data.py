@@ -1,7 +1,16 @@
 import argparse
+import functools
+import hashlib
 import json
-import random
+import mmap
+import multiprocessing
+import os
+import tempfile
 from pathlib import Path
+
+import numpy as np
+
+from near_dedup import near_dedup_file
 from preprocessing_utils import setup_logging, reconstruct_command
 
 LOG_FILENAME = "logs/preprocessing--reformat_uft_data.log"
@@ -9,39 +18,271 @@ logger = setup_logging(LOG_FILENAME)
 
 from tqdm_logging import logging_tqdm
 
+# Spilled sentences are partitioned by the top bits of their hash, so going
+# through the partitions in order also goes through the hashes in order.
+SPILL_PARTITION_BITS = 8
+
+# Rough per-sentence overhead of keeping it in a dict, on top of its JSON line.
+BYTES_PER_SENTENCE_OVERHEAD = 100
+
 
 def list_json_files(directory):
     json_files = []
     path = Path(directory)
     for file in path.rglob('*.json'):
         json_files.append(str(file))
-    return json_files
+    return sorted(json_files)
+
+
+def content_hash(sent_item):
+    '''64-bit hash of a sentence's `(Sen_ID, Sentence)`, which is what sentences are deduplicated on.'''
+    key = json.dumps([sent_item['Sen_ID'], sent_item['Sentence']], ensure_ascii=False)
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def split_hash(sent_item, split_key, seed):
+    '''
+    Stable hash of a sentence's content (or only its `Sen_ID`) as a number in
+    [0, 1), salted with `seed`. Decides which split the sentence ends up in.
+    '''
+    key = [sent_item['Sen_ID'], sent_item['Sentence']] if split_key == 'content' else sent_item['Sen_ID']
+    digest = hashlib.blake2b(json.dumps(key, ensure_ascii=False).encode('utf-8'),
+                             digest_size=8, key=str(seed).encode('utf-8')).digest()
+    return int.from_bytes(digest, 'little') / 2**64
+
+
+def read_json_file(file_name, split_args=None):
+    '''
+    Parses a single json file into `(hash, in_eval, json line)` tuples, one per
+    sentence. `in_eval` is only worked out when splitting by hash, i.e. when
+    `split_args` holds `(split_key, seed, eval_ratio)`. Runs in the worker
+    processes.
+    '''
+    with open(file_name, 'r', encoding='utf-8-sig') as file:
+        data = json.load(file)
+    return normalize_records(data, split_args)
+
+
+def normalize_records(data, split_args=None):
+    '''The part of `read_json_file` after parsing: normalizes whitespace and hashes every sentence.'''
+    records = []
+    for text in data['data']:
+        if 'Raw_data' in text and isinstance(text['Raw_data'], str):
+            text_clean = ' '.join(text['Raw_data'].split())
+            sent_item = {
+                'Sen_ID': text['Sen_ID'],
+                'Sentence': text_clean
+            }
+            in_eval = False
+            if split_args is not None:
+                split_key, seed, eval_ratio = split_args
+                in_eval = split_hash(sent_item, split_key, seed) < eval_ratio
+            records.append((content_hash(sent_item), in_eval, json.dumps(sent_item)))
+    return records
+
+
+class HashDeduplicator:
+    '''
+    Exact deduplication on 64-bit content hashes. Sentences are kept in memory
+    until they take up about `memory_budget` bytes, after which everything is
+    hash-partitioned into files under `spill_dir` and each partition gets
+    deduplicated on its own at the end.
+
+    When a hash is already taken, the sentences' json lines (i.e. their
+    normalized `(Sen_ID, Sentence)`) are compared too, so a different sentence
+    which happens to collide with it is kept rather than dropped.
+    '''
+    def __init__(self, spill_dir, memory_budget):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.sentences = {}
+        # Sentences whose hash collides with a different one in `sentences`,
+        # keyed on `(hash, json line)`. Practically always empty.
+        self.collisions = {}
+        self.memory_used = 0
+        self.partition_files = None
+
+    def add(self, records):
+        if self.partition_files is not None:
+            self._spill(records)
+            return
 
+        for sent_hash, in_eval, line in records:
+            if self._add_unique(self.sentences, self.collisions, sent_hash, in_eval, line):
+                self.memory_used += len(line) + BYTES_PER_SENTENCE_OVERHEAD
 
-def write_to_multiple_jsonl_files(texts, base_file_name, max_lines_per_file):
+        if self.memory_used > self.memory_budget:
+            logger.info(f"Over the memory budget, spilling sentences to {self.spill_dir}...")
+            self.partition_files = [
+                open(os.path.join(self.spill_dir, f"partition_{idx}.tsv"), 'w', encoding='utf-8')
+                for idx in range(2 ** SPILL_PARTITION_BITS)
+            ]
+            self._spill((sent_hash, in_eval, line) for sent_hash, (in_eval, line) in self.sentences.items())
+            self._spill((sent_hash, in_eval, line) for (sent_hash, line), in_eval in self.collisions.items())
+            self.sentences, self.collisions = {}, {}
+
+    def write_sorted_unique(self, output_file):
+        '''
+        Writes out the unique sentences' json lines, sorted by hash (and then
+        by json line, for colliding hashes). Returns the byte offset where each
+        line starts (plus the end of the file), and which lines go into the
+        eval split when splitting by hash.
+        '''
+        line_lengths, in_eval_flags = [], []
+        with open(output_file, 'wb') as file:
+            if self.partition_files is None:
+                partitions = [(self.sentences, self.collisions)]
+            else:
+                for partition_file in self.partition_files:
+                    partition_file.close()
+                partitions = (self._read_partition(p.name) for p in self.partition_files)
+
+            for sentences, collisions in partitions:
+                for in_eval, line in self._sorted_by_hash(sentences, collisions):
+                    line = (line + "\n").encode('utf-8')
+                    file.write(line)
+                    line_lengths.append(len(line))
+                    in_eval_flags.append(in_eval)
+
+        offsets = np.concatenate([[0], np.cumsum(line_lengths, dtype=np.int64)])
+        return offsets, np.array(in_eval_flags, dtype=bool)
+
+    def _spill(self, records):
+        for sent_hash, in_eval, line in records:
+            partition = sent_hash >> (64 - SPILL_PARTITION_BITS)
+            self.partition_files[partition].write(f"{sent_hash:016x}\t{int(in_eval)}\t{line}\n")
+
+    @classmethod
+    def _read_partition(cls, file_name):
+        sentences, collisions = {}, {}
+        with open(file_name, 'r', encoding='utf-8') as file:
+            for row in file:
+                sent_hash, in_eval, line = row.rstrip("\n").split("\t", 2)
+                cls._add_unique(sentences, collisions, int(sent_hash, 16), in_eval == "1", line)
+        return sentences, collisions
+
+    @staticmethod
+    def _add_unique(sentences, collisions, sent_hash, in_eval, line):
+        '''Adds a sentence unless it's already there, and returns whether it was added.'''
+        existing = sentences.get(sent_hash)
+        if existing is None:
+            sentences[sent_hash] = (in_eval, line)
+            return True
+        if existing[1] == line or (sent_hash, line) in collisions:
+            return False
+
+        logger.warning(f"Different sentences share the hash {sent_hash:016x}, keeping both: {existing[1]} {line}")
+        collisions[sent_hash, line] = in_eval
+        return True
+
+    @staticmethod
+    def _sorted_by_hash(sentences, collisions):
+        '''Yields `(in_eval, json line)` of every sentence, by hash and then by json line.'''
+        colliding = {}
+        for (sent_hash, line), in_eval in collisions.items():
+            colliding.setdefault(sent_hash, []).append((line, in_eval))
+
+        for sent_hash in sorted(sentences):
+            in_eval, line = sentences[sent_hash]
+            if sent_hash not in colliding:
+                yield in_eval, line
+                continue
+            for line, in_eval in sorted(colliding[sent_hash] + [(line, in_eval)]):
+                yield in_eval, line
+
+
+def write_to_multiple_jsonl_files(lines, base_file_name, max_lines_per_file):
+    '''Writes already JSON-encoded lines (as bytes) into files of up to `max_lines_per_file` lines each.'''
     file_count = 1
     current_line = 0
-    current_file = open(f"{base_file_name}_{file_count}.jsonl", 'w', encoding='utf-8')
-
-    for text in logging_tqdm(texts, desc="Writing text"):
-        try:
-            # Ensure the text is a valid JSON object, typically a dictionary.
-            # If 'text' is not already a dictionary, convert or adjust it accordingly.
-            json_line = json.dumps(text) + "\n"
-            current_file.write(json_line)
-            current_line += 1
-            if current_line >= max_lines_per_file:
-                current_file.close()
-                file_count += 1
-                current_file = open(f"{base_file_name}_{file_count}.jsonl", 'w', encoding='utf-8')
-                current_line = 0
-        except TypeError:
-            logger.info(f"Skip writing for {text}")
+    current_file = open(f"{base_file_name}_{file_count}.jsonl", 'wb')
+
+    for line in lines:
+        current_file.write(line)
+        current_line += 1
+        if current_line >= max_lines_per_file:
+            current_file.close()
+            file_count += 1
+            current_file = open(f"{base_file_name}_{file_count}.jsonl", 'wb')
+            current_line = 0
 
     current_file.close()
     logger.info(f"Files saved in {base_file_name}_*.jsonl")
 
 
+def read_lines(sorted_file, offsets, indices, desc):
+    '''Reads the `indices`-th lines of `sorted_file` (memory-mapped) in the given order.'''
+    with open(sorted_file, 'rb') as file:
+        if offsets[-1] == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as lines:
+            for idx in logging_tqdm(indices, desc=desc):
+                yield lines[offsets[idx]:offsets[idx + 1]]
+
+
+def process_group(group_path, pool, args):
+    '''
+    Reads, deduplicates (and, optionally, near-deduplicates), shuffles and
+    splits a single group. Returns the number
+    of train and eval sentences.
+
+    Files are parsed in parallel. Sentences are put into a canonical order (by
+    hash) before shuffling them with `--seed`, so the output only depends on
+    the input and the seed, and not on the amount of workers or whether
+    sentences got spilled to disk.
+
+    With `--split hash`, there's no shuffle: every sentence goes into the eval
+    split if its `split_hash` is below `--eval_ratio`, so it always ends up in
+    the same split no matter what else is in the input. Sentences are written
+    in hash order, which only takes a single sequential pass.
+    '''
+    logger.info(f"Reading {group_path}...")
+    all_json_files = list_json_files(group_path)
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        deduplicator = HashDeduplicator(tmp_dir, args.memory_budget_mb * 2**20)
+        split_args = (args.split_key, args.seed, args.eval_ratio) if args.split == 'hash' else None
+        read_fn = functools.partial(read_json_file, split_args=split_args)
+        for records in logging_tqdm(pool.imap(read_fn, all_json_files, chunksize=4),
+                                    total=len(all_json_files), desc="Read file"):
+            deduplicator.add(records)
+
+        sorted_file = os.path.join(tmp_dir, "sorted.jsonl")
+        offsets, in_eval = deduplicator.write_sorted_unique(sorted_file)
+        num_sentences = len(offsets) - 1
+        logger.info(f"Found {num_sentences} unique sentences.")
+
+        # Near-duplicates are dropped before splitting, so that no copies of
+        # training sentences end up in eval.
+        kept = np.arange(num_sentences)
+        if args.near_dedup_threshold is not None:
+            logger.info("Looking for near-duplicates...")
+            kept = np.flatnonzero(near_dedup_file(pool, sorted_file, offsets, args.near_dedup_threshold,
+                                                  num_perm=args.near_dedup_num_perm,
+                                                  ngram_size=args.near_dedup_ngram_size,
+                                                  seed=args.seed))
+
+        # Split the data in each folder to train & eval
+        logger.info("Split train & eval...")
+        if args.split == 'hash':
+            order = np.concatenate([kept[~in_eval[kept]], kept[in_eval[kept]]])
+            split_idx = int((~in_eval[kept]).sum())
+        else:
+            order = kept[np.random.default_rng(args.seed).permutation(len(kept))]
+            split_idx = int(len(kept) * (1 - args.eval_ratio))
+
+        # Write training and eval text to multiple jsonl files
+        dir_names = [i for i in group_path.split("/") if i != ""]
+        train_file_base = f"{args.out_parent_path}/train/" + dir_names[-1]
+        write_to_multiple_jsonl_files(read_lines(sorted_file, offsets, order[:split_idx], "Writing train text"),
+                                      train_file_base, args.max_line)
+        eval_file_base = f"{args.out_parent_path}/eval/" + dir_names[-1]
+        write_to_multiple_jsonl_files(read_lines(sorted_file, offsets, order[split_idx:], "Writing eval text"),
+                                      eval_file_base, args.max_line)
+
+    return split_idx, len(kept) - split_idx
+
+
 if __name__ == "__main__":
     """
     Example: python preparation/reformat_uft_data.py \
@@ -54,21 +295,42 @@ if __name__ == "__main__":
     parser.add_argument('--in_parent_path', type=str, help='Parent path of the json files directory')
     parser.add_argument('--out_parent_path', type=str, help='Parent path of the jsonl files directory')
     parser.add_argument('--max_line', type=int, help='Max line per jsonl file', default=1000)
+    parser.add_argument('--seed', type=int, help='Seed for shuffling (or, with --split hash, hashing) sentences', default=42)
+    parser.add_argument('--split', choices=('shuffle', 'hash'), default='shuffle',
+                        help='`shuffle` shuffles each group and cuts it at the eval ratio. `hash` assigns every sentence '
+                             'to a split from a stable hash, so the split never changes when data gets added')
+    parser.add_argument('--split_key', choices=('content', 'sen_id'), default='content',
+                        help='What to hash with --split hash: the whole sentence, or only its Sen_ID')
+    parser.add_argument('--eval_ratio', type=float, default=0.2, help='Fraction of sentences that go into eval')
+    parser.add_argument('--near_dedup_threshold', type=float, default=None,
+                        help='Drop near-duplicate sentences with an estimated Jaccard similarity (of their character '
+                             'n-grams) of at least this much. Disabled by default')
+    parser.add_argument('--near_dedup_num_perm', type=int, default=128, help='Size of the MinHash signatures')
+    parser.add_argument('--near_dedup_ngram_size', type=int, default=5, help='Length of the character n-grams')
+    parser.add_argument('--groups', type=str, default=None,
+                        help='Comma-separated names of the groups to process, e.g. to spread them over machines. '
+                             'Defaults to all of them')
+    parser.add_argument('--num_workers', type=int, help='Number of processes parsing json files',
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--memory_budget_mb', type=int, default=4096,
+                        help='Roughly how much memory deduplication may use before spilling to disk')
+    parser.add_argument('--tmp_dir', type=str, default=None,
+                        help='Where to spill sentences to. Defaults to the system temporary directory')
 
     args = parser.parse_args()
 
     # Reconstruct and log the run command
     run_command = reconstruct_command(args, "python preparation/reformat_sft_data.py")
     logger.info(f'Run command: {run_command}')
-    
+
     # Initialize ouput directory
     logger.info('Setting up output directory...')
     train_path = Path(f"{args.out_parent_path}/train/")
     eval_path = Path(f"{args.out_parent_path}/eval/")
-    
+
     if not train_path.exists():
         train_path.mkdir(parents=True)
-    
+
     if not eval_path.exists():
         eval_path.mkdir(parents=True)
 
@@ -83,71 +345,17 @@ if __name__ == "__main__":
         f"{args.in_parent_path}/02.Twitter_2",
         f"{args.in_parent_path}/03.Extra"
     ]
-    
+    if args.groups is not None:
+        group_names = args.groups.split(",")
+        group_paths = [p for p in group_paths if Path(p).name in group_names]
+
     logger.info('Start splitting data.')
     len_train, len_eval = 0, 0
-    for group_path in group_paths:
-        logger.info(f"Reading {group_path}...")
-        all_json_files = list_json_files(group_path)
-
-        # # Read sentences
-        # sent_items = []
-        # for file_name in logging_tqdm(all_json_files, desc="Read file"):
-        #     with open(file_name, 'r', encoding='utf-8-sig') as file:
-        #         data = json.load(file)
-        #         for text in data['data']:
-        #             if 'Raw_data' not in text or not isinstance(text['Raw_data'], str):
-        #                 continue
-
-        #             text_clean = ' '.join(text['Raw_data'].split())
-        #             sent_item = {
-        #                 'Sen_ID': text['Sen_ID'],
-        #                 'Sentence': text_clean
-        #             }
-        #             if sent_item not in sent_items:  # avoid duplicates
-        #                 sent_items.append(sent_item)
-        
-        # sent_items_list = list(sent_items)
-        
-        # BY using set optimize the avoiding duplicates process
-        sent_items = set()  # 빈 세트 생성
-        for file_name in logging_tqdm(all_json_files, desc="Read file"):
-            with open(file_name, 'r', encoding='utf-8-sig') as file:
-                data = json.load(file)
-                for text in data['data']:
-                    if 'Raw_data' in text and isinstance(text['Raw_data'], str):
-                        text_clean = ' '.join(text['Raw_data'].split())
-                        sent_item = {
-                            'Sen_ID': text['Sen_ID'],
-                            'Sentence': text_clean
-                        }
-                        sent_items.add(tuple(sent_item.items()))  # 튜플로 변환하여 세트에 추가
-        sent_items = [dict(item) for item in sent_items]  # 다시 딕셔너리로 변환
-
-        sent_items_list = list(sent_items)
-
-
-
-
-
-        # Split the data in each folder to train & eval
-        logger.info("Split train & eval...")
-        random.shuffle(sent_items_list)
-        split_idx = int(len(sent_items_list) * 0.8)
-        list_train = sent_items_list[:split_idx]
-        list_eval = sent_items_list[split_idx:]
-
-        len_train += len(list_train)
-        len_eval += len(list_eval)
-
-        # Write training text to multiple jsonl files
-        dir_names = [i for i in group_path.split("/") if i != ""]
-        train_file_base = f"{args.out_parent_path}/train/" + dir_names[-1]
-        write_to_multiple_jsonl_files(list_train, train_file_base, args.max_line)
-
-        # Write eval text to multiple jsonl files
-        eval_file_base = f"{args.out_parent_path}/eval/" + dir_names[-1]
-        write_to_multiple_jsonl_files(list_eval, eval_file_base, args.max_line)
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for group_path in group_paths:
+            group_len_train, group_len_eval = process_group(group_path, pool, args)
+            len_train += group_len_train
+            len_eval += group_len_eval
 
     logger.info('Finish preprocessing.')
 
@@ -158,5 +366,5 @@ if __name__ == "__main__":
     logger.info('2. Evaluation Data')
     logger.info(f'Files path: {args.out_parent_path}/eval/')
     logger.info(f'Sentence num: {len_eval}')
-    
+
     logger.info(f'Log saved in {LOG_FILENAME}')
@@ -0,0 +1,90 @@
+'''
+Content-addressed cache of tokenized shards.
+
+Shards are stored as small Arrow files named after a hash of everything their
+contents depend on: the input data, the tokenizer and the tokenization
+settings. So when rerunning a tokenization script, only inputs which actually
+changed need to be tokenized again.
+'''
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import pyarrow as pa
+from transformers import PreTrainedTokenizer
+
+from dataset_index import vocab_fingerprint
+
+# Bump this whenever the tokenization output changes in a way the cache keys
+# don't capture, so stale shards stop being picked up.
+CACHE_FORMAT_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizer) -> str:
+    '''
+    Hash of everything about a tokenizer that affects its output, for cache
+    keys: `dataset_index.vocab_fingerprint` (its vocabulary and special
+    tokens), plus its class, normalization/pre-tokenization rules and added
+    tokens.
+
+    To check whether tokenized data goes with a tokenizer, use
+    `vocab_fingerprint` instead, which only covers what token IDs mean.
+    '''
+    digest = hashlib.sha256(vocab_fingerprint(tokenizer).encode("utf-8"))
+    digest.update(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        digest.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    digest.update(json.dumps(sorted(str(token) for token in tokenizer.get_added_vocab())).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def file_digest(filepath: str, block_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ShardCache:
+    '''
+    Stores Arrow tables (plus a bit of JSON metadata) under keys derived from
+    arbitrary JSON-serializable parts. Writes are atomic, so several processes
+    can share a cache directory.
+    '''
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        parts["cache_format_version"] = CACHE_FORMAT_VERSION
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load(self, key: str) -> Optional[Tuple[pa.Table, Dict[str, Any]]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with pa.memory_map(path, "r") as source:
+            table = pa.ipc.RecordBatchFileReader(source).read_all()
+        metadata = json.loads(table.schema.metadata[b"shard_cache"])
+        return table, metadata
+
+    def store(self, key: str, table: pa.Table, metadata: Dict[str, Any]) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = table.replace_schema_metadata({"shard_cache": json.dumps(metadata)})
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.arrow")
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import pandas as pd
 import pyarrow as pa
 import numpy as np
-from parallel_pandas import ParallelPandas
-from transformers import AddedToken, AutoTokenizer
 from transformers.tokenization_utils import PreTrainedTokenizer
+from arrow_formats import compact_sft_record_batch, compact_sft_schema, smallest_token_dtype
+from dataset_index import DatasetIndexWriter
+from parallel_tokenization import TokenizerPool, load_tokenizer
+from shard_cache import ShardCache, tokenizer_fingerprint
 from preprocessing_utils import setup_logging, reconstruct_command
 
 LOG = setup_logging("logs/preprocessing--tokenize_data_sft.log")
 
+from tqdm_logging import logging_tqdm
+
 IGNORE_INDEX = -100
 
 # When appending EOS to the generations, append this many times. Seems helpful
@@ -26,39 +35,14 @@ def main() -> None:
     run_command = reconstruct_command(args, "python preparation/tokenize_data_sft.py")
     LOG.info(f'Run command: {run_command}')
 
-    cpu_count = multiprocessing.cpu_count()
-    LOG.info("Preparing to use %s CPU cores...", cpu_count)
-    ParallelPandas.initialize(
-        n_cpu=cpu_count,
-        split_factor=4,
-        disable_pr_bar=False,
-    )
+    LOG.info("Preparing to use %s CPU cores...", args.num_workers)
 
     LOG.info("Loading tokenizer...")
-    # OpenLLaMA's fast tokenizer is broken on the stable release of transformers.
-    # TODO(TG): When newest transformers version which has fixed tokenizer is released,
-    # do a version check.
-    is_openllama = 'open_llama' in args.tokenizer_path or 'open-llama' in args.tokenizer_path
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, use_fast=not is_openllama)
-
-    if args.add_special_tokens is not None:
-        # MAINTENANCE(11b): Big fat warning: the snippet below is copy-pasted
-        # into ``./training/hf_trainer.py``. Make sure to always keep both
-        # implementations in sync.
-        special_token_contents = args.add_special_tokens.split(",")
-        special_tokens = [
-            AddedToken(
-                # Heads up: this is very poorly documented in HuggingFace and
-                # some old forum discussions mention that it's apparently
-                # exclusive to the Rust-based tokenizers? If anything seems
-                # funky about the special token behavior, this is a good place
-                # to look.
-                content, lstrip=True, rstrip=True)
-            for content in special_token_contents
-        ]
-
-        tokenizer.add_special_tokens(
-            {"additional_special_tokens": special_tokens})
+    tokenizer = load_tokenizer(args.tokenizer_path, args.add_special_tokens)
+
+    if args.streaming:
+        _tokenize_in_chunks(args, tokenizer)
+        return
 
     # Load the entire dataset into memory. Hopefully we won't be working with
     # huge files anytime soon! If this becomes a problem we can use Dask.
@@ -71,14 +55,16 @@ def main() -> None:
     logging.getLogger("transformers.tokenization_utils_base").setLevel(
         logging.ERROR)
 
-    # `executor=threads` drastically slows down the tokenization, but
-    # it's a necessary evil. parallel_pandas seems to leak file descriptors when
-    # used in multiprocessing mode, and pandarallel deadlocks.
-    df = df.p_apply(
-        lambda x: _process_training_example(tokenizer, x),
-        axis=1,
-        executor="threads",
-    )
+    with TokenizerPool(args.tokenizer_path, args.add_special_tokens, args.num_workers, tokenizer=tokenizer) as pool:
+        shards = [df.iloc[start:start + args.chunk_size] for start in range(0, len(df), args.chunk_size)]
+        tokenized_shards, num_cached = [], 0
+        for shard, cache_hit in logging_tqdm(pool.imap(_with_shard_cache(args, tokenizer), shards),
+                                             total=len(shards), desc="Tokenizing: "):
+            tokenized_shards.append(shard)
+            num_cached += cache_hit
+        df = pd.concat(tokenized_shards)
+        if args.cache_dir is not None:
+            LOG.info(f"Reused cached tokens for {num_cached:,} of {len(shards):,} chunks.")
 
     logging.getLogger("transformers.tokenization_utils_base").setLevel(
         logging.WARNING)
@@ -90,21 +76,38 @@ def main() -> None:
 
     df = df.loc[df["input_ids"].map(len) <= args.max_length]
 
+    num_examples = len(df)
     num_tokens = df["input_ids"].map(len).sum()
 
+    if args.pack:
+        LOG.info("Packing examples into rows of up to %s tokens...", args.max_length)
+        df = _pack_examples(df, args.max_length)
+        LOG.info("Done! Packed %s examples into %s rows.", num_examples, len(df))
+
     LOG.info("Done! Converting into an Apache Arrow table...")
 
     # Convert the DataFrame of the training set into an Apache Arrow table and
     # write out as a file that can be mmapped at training time.
-    table = pa.Table.from_pandas(df)
+    if args.layout == "compact":
+        schema = compact_sft_schema(_token_dtype(tokenizer), packed=args.pack)
+        table = pa.Table.from_batches([
+            _to_compact_record_batch(df.iloc[start:start + args.chunk_size], schema)
+            for start in range(0, len(df), args.chunk_size)
+        ], schema=schema)
+    else:
+        table = pa.Table.from_pandas(df)
 
     LOG.info("Writing out tokenized dataset...")
     with pa.OSFile(args.output_file, 'wb') as sink:
         with pa.RecordBatchFileWriter(sink, table.schema) as writer:
             writer.write_table(table)
 
+    index = DatasetIndexWriter(tokenizer, layout=args.layout)
+    _add_to_index(index, df)
+    LOG.info(f"Wrote dataset index to {index.write(args.output_file)}.")
+
     LOG.info(f"Done! Output file saved to {args.output_file}.")
-    LOG.info(f"Dataset contains {len(df):,} sentences and {num_tokens:,} tokens.")
+    LOG.info(f"Dataset contains {num_examples:,} sentences and {num_tokens:,} tokens.")
 
 
 def _parse_args_from_argv() -> argparse.Namespace:
@@ -142,10 +145,285 @@ def _parse_args_from_argv() -> argparse.Namespace:
         default=None,
         help="Extra special tokens to add to the tokenizer before tokenizing. Comma-separated."
     )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Bin-pack several examples into each row of up to --max-length tokens."
+    )
+    parser.add_argument(
+        "--layout",
+        choices=("compact", "full"),
+        default="compact",
+        help="On-disk layout of the output file. `compact` stores token IDs in the smallest dtype that fits the vocabulary\
+        and only the prompt length of each example instead of a labels column. `full` is the original layout with int64\
+        `input_ids` and `labels`. Defaults to `compact`."
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read, tokenize and write the dataset in chunks instead of loading it all into memory."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="How many lines to hand to a tokenization worker (and, when --streaming, to read) at a time. Defaults to 10000."
+    )
+    parser.add_argument(
+        "-w",
+        "--num-workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of tokenization worker processes. Defaults to the number of CPU cores."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache tokenized chunks of --chunk-size lines in. Chunks whose contents, tokenizer and\
+        tokenization settings haven't changed since a previous run are loaded from there instead of being tokenized again."
+    )
 
     return parser.parse_args()
 
 
+def _tokenize_in_chunks(args: argparse.Namespace, tokenizer: PreTrainedTokenizer) -> None:
+    '''
+    Streaming version of `main`: reads the input `--chunk-size` lines at a
+    time, tokenizes each chunk with batched tokenizer calls and appends it to
+    the output file as a record batch of its own. Peak memory usage depends on
+    the chunk size rather than on the size of the dataset.
+
+    When packing, examples are only packed together with others from the same
+    chunk.
+    '''
+    # Length warning messes up progress bars, so we silence temporarily.
+    # https://github.com/huggingface/transformers/issues/991
+    logging.getLogger("transformers.tokenization_utils_base").setLevel(
+        logging.ERROR)
+
+    if args.layout == "compact":
+        schema = compact_sft_schema(_token_dtype(tokenizer), packed=args.pack)
+    else:
+        schema = _output_schema(packed=args.pack)
+    num_examples, num_tokens, num_trimmed = 0, 0, 0
+
+    num_chunks, num_cached = 0, 0
+    index = DatasetIndexWriter(tokenizer, layout=args.layout)
+
+    LOG.info("Tokenizing %s in chunks of %s lines...", args.input_file, args.chunk_size)
+    with TokenizerPool(args.tokenizer_path, args.add_special_tokens, args.num_workers, tokenizer=tokenizer) as pool, \
+         pa.OSFile(args.output_file, 'wb') as sink, \
+         pa.RecordBatchFileWriter(sink, schema) as writer, \
+         pd.read_json(args.input_file, lines=True, chunksize=args.chunk_size) as reader:
+        for df, cache_hit in logging_tqdm(pool.imap(_with_shard_cache(args, tokenizer), reader), desc="Tokenizing chunks: "):
+            num_chunks += 1
+            num_cached += cache_hit
+
+            # Trim out anything bigger than our max length to avoid problems
+            # at training time.
+            lengths = df["input_ids"].map(len)
+            keep = lengths <= args.max_length
+            num_trimmed += int((~keep).sum())
+            df = df.loc[keep]
+            if df.empty:
+                continue
+
+            num_examples += len(df)
+            num_tokens += int(lengths[keep].sum())
+
+            if args.pack:
+                df = _pack_examples(df, args.max_length)
+            if args.layout == "compact":
+                writer.write_batch(_to_compact_record_batch(df, schema))
+            else:
+                writer.write_batch(pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False))
+            _add_to_index(index, df)
+
+    logging.getLogger("transformers.tokenization_utils_base").setLevel(
+        logging.WARNING)
+
+    if args.cache_dir is not None:
+        LOG.info(f"Reused cached tokens for {num_cached:,} of {num_chunks:,} chunks.")
+    LOG.info("Trimmed out %s examples longer than %s tokens.", num_trimmed, args.max_length)
+    LOG.info(f"Done! Output file saved to {args.output_file}.")
+    LOG.info(f"Wrote dataset index to {index.write(args.output_file)}.")
+    LOG.info(f"Dataset contains {num_examples:,} sentences and {num_tokens:,} tokens.")
+
+
+def _output_schema(packed: bool) -> pa.Schema:
+    fields = [
+        pa.field("input_ids", pa.list_(pa.int64())),
+        pa.field("labels", pa.list_(pa.int64())),
+    ]
+    if packed:
+        fields.append(pa.field("seq_lens", pa.list_(pa.int32())))
+    return pa.schema(fields)
+
+
+def _token_dtype(tokenizer: PreTrainedTokenizer) -> np.dtype:
+    vocab_size = len(tokenizer)
+    token_dtype = smallest_token_dtype(vocab_size)
+    LOG.info(f"Storing token IDs as {token_dtype} for a vocabulary of {vocab_size:,} tokens.")
+    return token_dtype
+
+
+def _add_to_index(index: DatasetIndexWriter, df: pd.DataFrame) -> None:
+    '''Adds the lengths of the rows of `df`, and how many of their tokens are masked out of the labels, to the index.'''
+    lengths = df["input_ids"].map(len).to_numpy()
+    if len(lengths) == 0:
+        return
+    ignored_so_far = np.concatenate([[0], np.cumsum(np.concatenate(df["labels"].to_list()) == IGNORE_INDEX)])
+    ends = np.cumsum(lengths)
+    index.add(lengths, ignored_so_far[ends] - ignored_so_far[ends - lengths])
+
+
+def _to_compact_record_batch(df: pd.DataFrame, schema: pa.Schema) -> pa.RecordBatch:
+    '''Converts tokenized (and possibly packed) examples into a record batch in the compact layout.'''
+    input_ids = df["input_ids"].to_list()
+    seq_lens, examples_per_row = None, None
+    if "seq_lens" in df.columns:
+        seq_lens = np.concatenate(df["seq_lens"].to_list())
+        examples_per_row = df["seq_lens"].map(len).to_numpy()
+
+    return compact_sft_record_batch(np.concatenate(input_ids),
+                                    np.concatenate(df["labels"].to_list()),
+                                    np.array([len(tokens) for tokens in input_ids]),
+                                    schema,
+                                    seq_lens=seq_lens,
+                                    examples_per_row=examples_per_row)
+
+
+def _process_training_examples_shard(tokenizer: PreTrainedTokenizer, df: pd.DataFrame) -> pd.DataFrame:
+    '''Runs `_process_training_examples` over a shard of the dataset. Meant to be used with a `TokenizerPool`.'''
+    return _process_training_examples(tokenizer,
+                                      df["prompt"].to_list(),
+                                      df["generation"].to_list(),
+                                      index=df.index)
+
+
+def _with_shard_cache(args: argparse.Namespace, tokenizer: PreTrainedTokenizer) -> Callable[[PreTrainedTokenizer, pd.DataFrame], Tuple[pd.DataFrame, bool]]:
+    '''
+    `_process_training_examples_shard`, but returning `(df, cache_hit)` and
+    only tokenizing shards which aren't in `--cache-dir` yet.
+    '''
+    if args.cache_dir is None:
+        return _process_training_examples_shard_uncached
+
+    # Everything other than the shard itself that the tokens depend on.
+    # Trimming and packing happen afterwards, so `--max-length` isn't part of it.
+    key_parts = {
+        "script": "tokenize_data_sft",
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "append_eos": True,
+        "num_of_eos_tokens": NUM_OF_EOS_TOKENS,
+    }
+    return functools.partial(_process_training_examples_shard_cached, cache_dir=args.cache_dir, key_parts=key_parts)
+
+
+def _process_training_examples_shard_uncached(tokenizer: PreTrainedTokenizer, df: pd.DataFrame) -> Tuple[pd.DataFrame, bool]:
+    return _process_training_examples_shard(tokenizer, df), False
+
+
+def _process_training_examples_shard_cached(
+    tokenizer: PreTrainedTokenizer,
+    df: pd.DataFrame,
+    cache_dir: str,
+    key_parts: Dict[str, Any],
+) -> Tuple[pd.DataFrame, bool]:
+    '''
+    Looks up the tokenized examples of a shard in the shard cache, keyed on the
+    shard's prompts and generations, and only tokenizes it on a miss. Since the
+    key only depends on the contents of the shard, appending new data to the
+    end of the input file keeps all the shards before it cached.
+    '''
+    cache = ShardCache(cache_dir)
+    contents = json.dumps([df["prompt"].to_list(), df["generation"].to_list()])
+    key = cache.key(shard=hashlib.sha256(contents.encode("utf-8")).hexdigest(), **key_parts)
+
+    cached = cache.load(key)
+    if cached is not None:
+        table, _metadata = cached
+        columns = {}
+        for name in ("input_ids", "labels"):
+            column = table.column(name).combine_chunks()
+            values = column.flatten().to_numpy().astype(np.int64)
+            columns[name] = np.split(values, column.offsets.to_numpy()[1:-1])
+        return pd.DataFrame(columns, columns=["input_ids", "labels"], index=df.index), True
+
+    tokenized = _process_training_examples_shard(tokenizer, df)
+    table = pa.table({
+        name: pa.array(tokenized[name].to_list(), type=pa.list_(pa.int32()))
+        for name in ("input_ids", "labels")
+    })
+    cache.store(key, table, {"num_examples": len(tokenized)})
+    return tokenized, False
+
+
+def _is_llama_tokenizer(tokenizer: PreTrainedTokenizer) -> bool:
+    '''Whether EOS needs a space in front of it, and responses need BOS turned off (see `_process_training_example`).'''
+    # TODO(11b): Do a more robust check here.
+    return tokenizer.eos_token == "</s>"
+
+
+def _process_training_examples(
+    tokenizer: PreTrainedTokenizer,
+    prompts: List[str],
+    generations: List[str],
+    append_eos: bool = True,
+    index: Optional[pd.Index] = None,
+) -> pd.DataFrame:
+    '''
+    Batched version of `_process_training_example`, which produces the exact
+    same tokens. All prompts are tokenized in one tokenizer call and all
+    generations in another, so fast tokenizers can parallelize the work
+    internally, and labels are built for the whole batch at once.
+    '''
+    if len(prompts) == 0:
+        return pd.DataFrame(columns=["input_ids", "labels"], index=index)
+
+    is_llama = _is_llama_tokenizer(tokenizer)
+
+    if append_eos:
+        # See `_process_training_example` for why LLaMA needs the space.
+        eos = f" {tokenizer.eos_token}" if is_llama else tokenizer.eos_token
+        generations = [generation + eos * NUM_OF_EOS_TOKENS for generation in generations]
+
+    all_prompt_tokens = tokenizer(prompts).input_ids
+
+    # No BOS on the response segment, see `_process_training_example`.
+    response_tokenizer_kwargs = {"add_special_tokens": False} if is_llama else {}
+    all_response_tokens = tokenizer(generations, **response_tokenizer_kwargs).input_ids
+
+    prompt_lengths = np.array([len(tokens) for tokens in all_prompt_tokens], dtype=np.int64)
+    lengths = prompt_lengths + np.array([len(tokens) for tokens in all_response_tokens], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    # Lay every example out back to back in a single flat array...
+    input_ids = np.fromiter(
+        itertools.chain.from_iterable(
+            itertools.chain(prompt_tokens, response_tokens)
+            for prompt_tokens, response_tokens in zip(all_prompt_tokens, all_response_tokens)),
+        dtype=np.int64,
+        count=int(ends[-1]),
+    )
+
+    # Let's not waste any more GPU time thanks to this.
+    if append_eos:
+        assert np.all(input_ids[ends - 1] == tokenizer.eos_token_id), \
+            "EOS was not correctly appended to the end of the response tokens."
+
+    # ...so the prompt tokens of all examples can be masked out in one go.
+    is_prompt_token = np.arange(len(input_ids)) < np.repeat(starts + prompt_lengths, lengths)
+    labels = np.where(is_prompt_token, IGNORE_INDEX, input_ids)
+
+    return pd.DataFrame({
+        "input_ids": np.split(input_ids, ends[:-1]),
+        "labels": np.split(labels, ends[:-1]),
+    }, columns=["input_ids", "labels"], index=index)
+
+
 def _process_training_example(
     tokenizer: PreTrainedTokenizer,
     series: pd.Series,
@@ -156,8 +434,7 @@ def _process_training_example(
     # https://pandas.pydata.org/pandas-docs/stable/user_guide/indexing.html#returning-a-view-versus-a-copy
     generation = series.loc["generation"]
 
-    # TODO(11b): Do a more robust check here.
-    is_llama = tokenizer.eos_token == "</s>"
+    is_llama = _is_llama_tokenizer(tokenizer)
 
     if append_eos:
         for _ in range(NUM_OF_EOS_TOKENS):
@@ -206,5 +483,62 @@ def _process_training_example(
         "labels": labels,
     })
 
+
+def _pack_examples(df: pd.DataFrame, max_length: int) -> pd.DataFrame:
+    '''
+    Packs tokenized examples into rows of up to `max_length` tokens. Each row
+    also gets a `seq_lens` column, so that at training time position IDs can be
+    reset and attention can be kept from crossing example boundaries.
+    '''
+    lengths = df["input_ids"].map(len).to_numpy()
+    all_input_ids = df["input_ids"].to_list()
+    all_labels = df["labels"].to_list()
+
+    rows = []
+    for row_indices in _pack_sequences(lengths, max_length):
+        seq_lens = lengths[row_indices]
+        labels = np.concatenate([all_labels[idx] for idx in row_indices])
+        # Don't train the last token of an example to predict the first token
+        # of the next one.
+        labels[np.cumsum(seq_lens) - seq_lens] = IGNORE_INDEX
+        rows.append({
+            "input_ids": np.concatenate([all_input_ids[idx] for idx in row_indices]),
+            "labels": labels,
+            "seq_lens": seq_lens.astype(np.int32),
+        })
+
+    return pd.DataFrame(rows)
+
+
+def _pack_sequences(lengths: np.ndarray, max_length: int) -> List[List[int]]:
+    '''
+    Bin-packs rows into bins of at most `max_length` tokens (best-fit
+    decreasing) and returns the row indices that go into each bin. Rows longer
+    than `max_length` get a bin to themselves.
+
+    MAINTENANCE: This is copy-pasted from ``./training/dataset.py``. Keep
+    both implementations in sync.
+    '''
+    bins: List[List[int]] = []
+    # bins_by_free_space[n] holds the bins which have exactly `n` tokens left.
+    bins_by_free_space: List[List[int]] = [[] for _ in range(max_length + 1)]
+
+    for row_idx in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[row_idx])
+        bin_idx, free_space = None, max_length - length
+        for space in range(length, max_length + 1):
+            if bins_by_free_space[space]:
+                bin_idx, free_space = bins_by_free_space[space].pop(), space - length
+                break
+        if bin_idx is None:
+            bin_idx = len(bins)
+            bins.append([])
+
+        bins[bin_idx].append(int(row_idx))
+        if free_space > 0:
+            bins_by_free_space[free_space].append(bin_idx)
+
+    return bins
+
 if __name__ == "__main__":
     main()
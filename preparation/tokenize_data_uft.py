@@ -1,5 +1,8 @@
 import argparse
+import functools
+import itertools
 import logging
+import multiprocessing
 import os
 import pandas as pd
 
@@ -7,10 +10,14 @@ import numpy as np
 import pyarrow as pa
 
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Callable, Dict, List, Tuple, Union
 from tqdm import tqdm
-from transformers import AddedToken, AutoTokenizer, PreTrainedTokenizer
+from transformers import PreTrainedTokenizer
 
+from arrow_formats import ChunkPerBatchWriter, FixedLengthChunkWriter, smallest_token_dtype
+from dataset_index import DatasetIndexWriter
+from parallel_tokenization import TokenizerPool, load_tokenizer
+from shard_cache import ShardCache, file_digest, tokenizer_fingerprint
 from preprocessing_utils import setup_logging, reconstruct_command
 
 LOG = setup_logging("logs/preprocessing--tokenize_data_uft.log")
@@ -27,57 +34,51 @@ def main() -> None:
     
     assert os.path.isfile(args.input_path) or os.path.isdir(args.input_path), f'File or directory \"{args.input_path}\" not found!'
 
-    LOG.info("Loading tokenizer...")
-    # OpenLLaMA's fast tokenizer is broken on the stable release of transformers.
-    # TODO(TG): When newest transformers version which has fixed tokenizer is released,
-    # do a version check.
-    is_openllama = 'open_llama' in args.tokenizer_path or 'open-llama' in args.tokenizer_path
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, use_fast=not is_openllama)
-
-    if args.add_special_tokens is not None:
-        # MAINTENANCE(11b): Big fat warning: the snippet below is copy-pasted
-        # into ``./training/hf_trainer.py``. Make sure to always keep both
-        # implementations in sync.
-        special_token_contents = args.add_special_tokens.split(",")
-        special_tokens = [
-            AddedToken(
-                # Heads up: this is very poorly documented in HuggingFace and
-                # some old forum discussions mention that it's apparently
-                # exclusive to the Rust-based tokenizers? If anything seems
-                # funky about the special token behavior, this is a good place
-                # to look.
-                content, lstrip=True, rstrip=True)
-            for content in special_token_contents
-        ]
-
-        tokenizer.add_special_tokens(
-            {"additional_special_tokens": special_tokens})
-        
     # Check if it's a directory of .txt files or a specific file
-    LOG.info("Done! About to tokenize file(s)...")
-
     if os.path.isfile(args.input_path):
-        all_file_tokens, total_num_tokens, total_num_sents = _tokenize_file(tokenizer, args.input_path, args.max_length)
+        txt_files = [args.input_path]
     # Runs this if and only if args.input_path is a directory
     else:
-        all_file_tokens: list[np.array] = []
-        total_num_tokens, total_num_sents = 0, 0
         # Find all .txt files from a directory which could potentially
         # contain other files.
         LOG.info("Listing files...")
         input_path = Path(args.input_path)
         txt_files = [file for file in input_path.glob("*.jsonl")]
 
-        # Obtain the list of token arrays
-        for file in logging_tqdm(txt_files, desc="Tokenizing"):
-            file_tokens, num_tokens, num_sents = _tokenize_file(tokenizer, file, args.max_length)
-            all_file_tokens += file_tokens
+    LOG.info("Preparing to use %s CPU cores...", args.num_workers)
+
+    LOG.info("Loading tokenizer...")
+    tokenizer = load_tokenizer(args.tokenizer_path, args.add_special_tokens)
+
+    if args.streaming:
+        _tokenize_files_streaming(txt_files, args, tokenizer)
+        return
+
+    total_num_tokens, total_num_sents = 0, 0
+    index = DatasetIndexWriter(tokenizer, layout=args.layout)
+    with TokenizerPool(args.tokenizer_path, args.add_special_tokens, args.num_workers, tokenizer=tokenizer) as pool, \
+         _open_chunk_writer(args, tokenizer) as writer:
+        LOG.info("Done! About to tokenize file(s)...")
+
+        # Files are tokenized in parallel, but come back in order. Their
+        # chunks are written out right away.
+        tokenize_fn = _with_shard_cache(
+            functools.partial(_tokenize_file, max_length=args.max_length), args, tokenizer, mode="whole-file")
+        num_cached = 0
+        for (file_tokens, num_tokens, num_sents), cache_hit in logging_tqdm(pool.imap(tokenize_fn, txt_files),
+                                                                            total=len(txt_files), desc="Tokenizing"):
+            for chunk in file_tokens:
+                writer.write(chunk)
+            index.add([len(chunk) for chunk in file_tokens])
             total_num_tokens += num_tokens
             total_num_sents += num_sents
+            num_cached += cache_hit
 
-    _save_as_arrow_file(all_file_tokens, args.output_file)
+    if args.cache_dir is not None:
+        LOG.info(f"Reused cached tokens for {num_cached:,} of {len(txt_files):,} files.")
     LOG.info(f"Done! Output file saved to {args.output_file}.")
-    LOG.info(f"Dataset contains {total_num_sents:,} sentences and {total_num_tokens:,} tokens.")
+    LOG.info(f"Wrote dataset index to {index.write(args.output_file)}.")
+    LOG.info(f"Dataset contains {total_num_sents:,} sentences and {total_num_tokens:,} tokens in {writer.num_rows:,} chunks.")
 
 def _parse_args_from_argv() -> argparse.Namespace:
     '''Parses arguments.'''
@@ -107,6 +108,13 @@ def _parse_args_from_argv() -> argparse.Namespace:
         default=None,
         help="Extra special tokens to add to the tokenizer before tokenizing. Comma-separated."
     )
+    parser.add_argument(
+        "-w",
+        "--num-workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of tokenization worker processes. Defaults to the number of CPU cores."
+    )
     parser.add_argument(
         "-l",
         "--max-length",
@@ -118,9 +126,196 @@ def _parse_args_from_argv() -> argparse.Namespace:
         In that case, an extra chunk will be added in with the remaining tokens.\
         Defaults to 2048.",
     )
+    parser.add_argument(
+        "--layout",
+        choices=("fixed", "chunked"),
+        default="fixed",
+        help="On-disk layout of the output file. `fixed` stores all chunks as rows of a single fixed-width column,\
+        using the smallest token dtype that fits the vocabulary. `chunked` is the original layout of one int64\
+        record batch per chunk. Defaults to `fixed`.",
+    )
+    parser.add_argument(
+        "--rows-per-batch",
+        type=int,
+        default=1024,
+        help="How many chunks to put into each record batch with `--layout fixed`. Defaults to 1024.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Tokenize sentences in batches and fill chunks across file boundaries, writing them out as they fill up.\
+        Only full --max-length chunks are emitted, unless --keep-remainder is given.",
+    )
+    parser.add_argument(
+        "--keep-remainder",
+        action="store_true",
+        help="When --streaming, also write out the final, partially filled chunk.",
+    )
+    parser.add_argument(
+        "--sentence-batch-size",
+        type=int,
+        default=1024,
+        help="How many sentences to tokenize per tokenizer call when --streaming. Defaults to 1024.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache the tokens of every input file in. Files whose contents, tokenizer and tokenization\
+        settings haven't changed since a previous run are loaded from there instead of being tokenized again.",
+    )
 
     return parser.parse_args()
 
+def _tokenize_files_streaming(files: List[str], args: argparse.Namespace, tokenizer: PreTrainedTokenizer) -> None:
+    '''
+    Tokenizes `files` in order and cuts the resulting token stream into chunks
+    of `max_length` tokens. A token buffer is carried over from one file to the
+    next, so chunks are filled across file boundaries instead of leaving a
+    short chunk at the end of every file. Chunks are written out as soon as
+    they are full.
+    '''
+    max_length = args.max_length
+    total_num_tokens, total_num_sents = 0, 0
+    buffer = np.empty(0, dtype=np.int64)
+    index = DatasetIndexWriter(tokenizer, layout=args.layout)
+
+    with TokenizerPool(args.tokenizer_path, args.add_special_tokens, args.num_workers, tokenizer=tokenizer) as pool, \
+         _open_chunk_writer(args, tokenizer) as writer:
+        LOG.info("Done! About to tokenize file(s)...")
+
+        # NOTE: The sentence batch size doesn't change the tokens, so it's not
+        # part of the cache key.
+        tokenize_fn = _with_shard_cache(
+            functools.partial(_tokenize_file_in_batches, batch_size=args.sentence_batch_size), args, tokenizer, mode="sentences")
+        num_cached = 0
+        for (file_tokens, num_sents), cache_hit in logging_tqdm(pool.imap(tokenize_fn, files),
+                                                                total=len(files), desc="Tokenizing"):
+            total_num_tokens += len(file_tokens)
+            total_num_sents += num_sents
+            num_cached += cache_hit
+
+            buffer = np.concatenate([buffer, file_tokens])
+            num_full_chunks = len(buffer) // max_length
+            for chunk in buffer[:num_full_chunks * max_length].reshape(num_full_chunks, max_length):
+                writer.write(chunk)
+            index.add(np.full(num_full_chunks, max_length))
+            buffer = buffer[num_full_chunks * max_length:]
+
+        if len(buffer) > 0:
+            if args.keep_remainder:
+                writer.write(buffer)
+                index.add([len(buffer)])
+            else:
+                LOG.info(f"Dropping the last {len(buffer):,} tokens, which don't fill up a whole chunk.")
+
+    if args.cache_dir is not None:
+        LOG.info(f"Reused cached tokens for {num_cached:,} of {len(files):,} files.")
+    LOG.info(f"Done! Output file saved to {args.output_file}.")
+    LOG.info(f"Wrote dataset index to {index.write(args.output_file)}.")
+    LOG.info(f"Dataset contains {total_num_sents:,} sentences and {total_num_tokens:,} tokens in {writer.num_rows:,} chunks.")
+
+def _open_chunk_writer(args: argparse.Namespace, tokenizer: PreTrainedTokenizer) -> Union[FixedLengthChunkWriter, ChunkPerBatchWriter]:
+    if args.layout == "chunked":
+        return ChunkPerBatchWriter(args.output_file)
+
+    vocab_size = len(tokenizer)
+    token_dtype = smallest_token_dtype(vocab_size)
+    LOG.info(f"Storing token IDs as {token_dtype} for a vocabulary of {vocab_size:,} tokens.")
+    return FixedLengthChunkWriter(args.output_file, args.max_length, token_dtype, args.rows_per_batch)
+
+def _with_shard_cache(tokenize_fn: Callable, args: argparse.Namespace, tokenizer: PreTrainedTokenizer, mode: str) -> Callable:
+    '''
+    Wraps a per-file tokenization function so it returns `(result, cache_hit)`,
+    and only actually tokenizes files which aren't in `--cache-dir` yet.
+    '''
+    if args.cache_dir is None:
+        return functools.partial(_tokenize_file_uncached, tokenize_fn=tokenize_fn)
+
+    # Everything other than the file itself that the tokens depend on.
+    key_parts = {
+        "script": "tokenize_data_uft",
+        "mode": mode,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "append_eos": True,
+    }
+    if mode == "whole-file":
+        # Files are only cut into chunks up front when tokenized whole.
+        key_parts["max_length"] = args.max_length
+    return functools.partial(_tokenize_file_cached, tokenize_fn=tokenize_fn,
+                             cache_dir=args.cache_dir, key_parts=key_parts)
+
+def _tokenize_file_uncached(tokenizer: PreTrainedTokenizer, filepath: str, tokenize_fn: Callable) -> Tuple[tuple, bool]:
+    return tokenize_fn(tokenizer, filepath), False
+
+def _tokenize_file_cached(
+    tokenizer: PreTrainedTokenizer,
+    filepath: str,
+    tokenize_fn: Callable,
+    cache_dir: str,
+    key_parts: Dict[str, Any],
+) -> Tuple[tuple, bool]:
+    '''
+    Looks up the tokens of `filepath` in the shard cache, and only calls
+    `tokenize_fn` (and stores its result) on a miss. `tokenize_fn` returns
+    either a single token array or a list of chunks, followed by some counts.
+    '''
+    cache = ShardCache(cache_dir)
+    key = cache.key(file=file_digest(filepath), **key_parts)
+
+    cached = cache.load(key)
+    if cached is not None:
+        table, metadata = cached
+        chunks = [chunk.values.to_numpy().astype(np.int64) for chunk in table.column("input_ids").combine_chunks()]
+        tokens = chunks if metadata["is_list"] else chunks[0]
+        return (tokens, *metadata["counts"]), True
+
+    tokens, *counts = tokenize_fn(tokenizer, filepath)
+    is_list = isinstance(tokens, list)
+    chunks = tokens if is_list else [tokens]
+    table = pa.table({"input_ids": pa.array(chunks, type=pa.list_(pa.int32()))})
+    cache.store(key, table, {"is_list": is_list, "counts": [int(count) for count in counts]})
+    return (tokens, *counts), False
+
+def _tokenize_file_in_batches(tokenizer: PreTrainedTokenizer, filepath: str, batch_size: int, append_eos: bool = True) -> Tuple[np.ndarray, int]:
+    '''
+    Tokenizes a file's sentences `batch_size` at a time instead of joining the
+    whole file into a single string first, which avoids huge memory spikes in
+    the tokenizer on big files.
+
+    Sentences are still separated by newlines and followed by EOS at the end of
+    the file, like in `_tokenize_file`. Since each sentence is tokenized on its
+    own, tokens right at sentence boundaries can come out slightly differently
+    than when tokenizing the whole file at once.
+
+    Params:
+    tokenizer: The specific tokenizer used to tokenize the file.
+    filepath: The path to the JSONL document that will be tokenized.
+    batch_size: How many sentences to hand to the tokenizer at a time.
+    '''
+    is_llama = tokenizer.eos_token == "</s>"
+
+    sentences = pd.read_json(filepath, lines=True)['Sentence'].to_list()
+    if len(sentences) == 0:
+        return np.empty(0, dtype=np.int64), 0
+
+    texts = [sentence + '\n' for sentence in sentences[:-1]] + [sentences[-1]]
+    if append_eos:
+        if is_llama:
+            texts[-1] += f" {tokenizer.eos_token}"
+        else:
+            texts[-1] += tokenizer.eos_token
+
+    # Whatever the tokenizer adds to the start of a text (e.g. BOS for LLaMA)
+    # only goes at the start of the file, same as when tokenizing it whole.
+    prefix_tokens = tokenizer("").input_ids
+    token_batches = [np.array(prefix_tokens, dtype=np.int64)]
+    for start in range(0, len(texts), batch_size):
+        input_ids = tokenizer(texts[start:start + batch_size], add_special_tokens=False).input_ids
+        token_batches.append(np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int64))
+
+    return np.concatenate(token_batches), len(sentences)
+
 def _tokenize_file(tokenizer: PreTrainedTokenizer, filepath: str, max_length: int, append_eos: bool = True) -> Tuple[List[np.array], int]:
     '''
     Opens a singular text document and converts its contents into a large array of tokens.
@@ -170,23 +365,5 @@ def _tokenize_file(tokenizer: PreTrainedTokenizer, filepath: str, max_length: in
 
     return tokenized_contents, num_tokens, num_sentences
 
-def _save_as_arrow_file(tokens: List[np.array], output_file: str) -> None:
-    '''
-    Saves a list of arrays with `context_length` length (unless it is not)
-
-    Params:
-    tokens: A list of numpy arrays containing tokens, each with a length of the model's context size.
-    output_file: The path of the file which will be saved.
-    '''
-    LOG.info(f"Writing to arrow file and saving...")
-    pa_arrays = [pa.array(t) for t in tokens]
-    schema = pa.schema([pa.field('input_ids', pa_arrays[0].type)])
-
-    with pa.OSFile(output_file, 'wb') as sink:
-        with pa.ipc.new_file(sink, schema=schema) as writer:
-            for chunk in pa_arrays:
-                batch = pa.record_batch([chunk], schema=schema)
-                writer.write(batch)
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''
+Attention latency and peak memory of every attention backend (see
+./monkeypatches/backends.py) at increasing sequence lengths, with random
+inputs. "eager" is HF's own attention: keys/values repeated for every query
+head and the full score matrix materialized.
+
+Outputs of every backend are compared against eager (or against the first
+backend, if eager isn't benchmarked) at each length. Peak memory is the CUDA
+allocator's on GPU, and the growth of the process' peak RSS on CPU.
+
+Example: python training/benchmark_attention.py --seq-lens 512 1024 2048 4096 --num-kv-heads 2
+'''
+import argparse
+import ctypes
+import json
+import logging
+import math
+import time
+import typing as t
+
+import torch
+
+from monkeypatches import ATTENTION_BACKEND_NAMES, backends
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    if "xformers" in args.backends and (backends.memory_efficient_attention is None or device.type != "cuda"):
+        LOG.warning("xFormers isn't usable here, so the xformers backend falls back to sdpa.")
+
+    results = []
+    for seq_len in args.seq_lens:
+        query_length = args.query_length or seq_len
+        query = torch.randn(args.batch_size, query_length, args.num_heads, args.head_dim, device=device, dtype=dtype)
+        key, value = (torch.randn(args.batch_size, seq_len, args.num_kv_heads, args.head_dim,
+                                  device=device, dtype=dtype) for _ in range(2))
+
+        reference = None
+        for backend in args.backends:
+            attention = eager_attention if backend == "eager" else backends.ATTENTION_BACKENDS[backend].attention
+            stats: t.Dict[str, t.Any] = dict(backend=backend, seq_len=seq_len, query_length=query_length)
+            try:
+                output, stats["latency_ms"], stats["peak_memory_mb"] = _measure(
+                    attention, query, key, value, args.repeats, device)
+            except torch.cuda.OutOfMemoryError:
+                stats["error"] = "out of memory"
+                LOG.info("%s, length %s: out of memory", backend, seq_len)
+                results.append(stats)
+                torch.cuda.empty_cache()
+                continue
+
+            if reference is None:
+                reference = output
+            stats["max_difference"] = (output.float() - reference.float()).abs().max().item()
+            del output
+            LOG.info("%s, length %s: %.2f ms, peak memory %.1f MiB, max. difference %.2g",
+                     backend, seq_len, stats["latency_ms"], stats["peak_memory_mb"], stats["max_difference"])
+            results.append(stats)
+
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def eager_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    '''Same math as HF's LLaMA attention: `repeat_kv`, then softmax over the full (causal) score matrix.'''
+    bsz, query_length, num_heads, head_dim = query.shape
+    key_length = key.shape[1]
+    groups = num_heads // key.shape[2]
+    query, key, value = (x.transpose(1, 2) for x in (query, key, value))
+    key, value = (x.repeat_interleave(groups, dim=1) for x in (key, value))
+
+    scores = query @ key.transpose(2, 3) / math.sqrt(head_dim)
+    causal_mask = torch.ones(query_length, key_length, dtype=torch.bool, device=query.device) \
+        .tril(diagonal=key_length - query_length)
+    scores = scores.masked_fill(~causal_mask, torch.finfo(scores.dtype).min)
+    probabilities = torch.nn.functional.softmax(scores, dim=-1, dtype=torch.float32).to(query.dtype)
+    return (probabilities @ value).transpose(1, 2)
+
+
+def _measure(
+    attention: t.Callable[..., torch.Tensor],
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    repeats: int,
+    device: torch.device,
+) -> t.Tuple[torch.Tensor, float, float]:
+    '''Returns the output, mean latency (ms) and peak memory (MiB) of `attention`.'''
+    with torch.no_grad():
+        # Warmup.
+        output = attention(query, key, value)
+        del output
+        _synchronize(device)
+
+        if device.type == "cuda":
+            memory_before = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            _release_free_memory()
+            _reset_peak_rss()
+            memory_before = _read_proc_status_kb("VmRSS") * 1024
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            output = attention(query, key, value)
+        _synchronize(device)
+        latency_ms = 1000 * (time.perf_counter() - start) / repeats
+
+        if device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(device) - memory_before
+        else:
+            peak_memory = _read_proc_status_kb("VmHWM") * 1024 - memory_before
+    return output, latency_ms, max(peak_memory, 0) / 2**20
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _release_free_memory() -> None:
+    '''
+    Hands memory freed by earlier runs back to the OS. Otherwise glibc keeps
+    it around for reuse, and later runs wouldn't show up in the peak RSS.
+    '''
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _reset_peak_rss() -> None:
+    '''Resets this process' peak RSS (`VmHWM`), if the kernel lets us.'''
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        LOG.warning("Couldn't reset the peak RSS, so CPU peak memory numbers are cumulative.")
+
+
+def _read_proc_status_kb(key: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(f"{key}:"):
+                return int(line.split()[1])
+    raise KeyError(key)
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Attention latency and peak memory per backend and sequence length.")
+    parser.add_argument("--backends", nargs="+", choices=ATTENTION_BACKEND_NAMES, default=list(ATTENTION_BACKEND_NAMES))
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[256, 512, 1024, 2048])
+    parser.add_argument("--query-length", type=int, default=None,
+                        help="Queries on top of the keys, e.g. 1 for decoding. Defaults to the sequence length.")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-kv-heads", type=int, default=None, help="Defaults to --num-heads.")
+    parser.add_argument("--head-dim", type=int, default=64)
+    parser.add_argument("--dtype", choices=["float32", "float16", "bfloat16"], default="float32")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.num_kv_heads is None:
+        args.num_kv_heads = args.num_heads
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+'''
+Throughput benchmark for the whole data pipeline as the trainer runs it:
+`MmappedArrowDataset` + `DataCollatorForMmapedDataset` behind a
+`torch.utils.data.DataLoader`, on CPU, so the data side can be measured (and
+regressions tracked) without a GPU run.
+
+Every combination of `--num-workers`, `--batch-sizes` and `--pin-memory` is
+run over the same file, either a synthetic one with the given size and length
+distribution or an existing tokenized file (`--file`). Results are printed
+(and optionally written to `--output`) as JSON.
+
+Example: python training/benchmark_dataloader.py --mode sft --num-rows 65536 \
+    --length-distribution lognormal --num-workers 0 2 4 --batch-sizes 4 16 --output dataloader.json
+'''
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+import types
+import typing as t
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from benchmark_dataset import _read_proc_status_kb, write_synthetic_sft_file, write_synthetic_uft_file
+from dataset import DataCollatorForMmapedDataset, MmappedArrowDataset, _as_numpy
+from sampler import LengthGroupedBatchSampler, ShuffledBatchSampler
+
+LOG = logging.getLogger(__name__)
+
+RSS_KEYS = ("VmRSS", "RssAnon", "RssFile")
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        filepath = args.file
+        if filepath is None:
+            filepath = os.path.join(tmp_dir, f"{args.mode}.arrow")
+            write_synthetic_file(args, filepath)
+        report = run_benchmarks(args, filepath)
+
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(output)
+        LOG.info("Wrote results to %s", args.output)
+    print(output)
+
+
+def run_benchmarks(args: argparse.Namespace, filepath: str) -> t.Dict[str, t.Any]:
+    sft = args.mode == "sft"
+    dataset = MmappedArrowDataset(filepath, sft=sft)
+    lengths = dataset.row_lengths()
+    LOG.info("Benchmarking %s: %s rows, %.1f MiB, mean length %.1f",
+             filepath, len(dataset), os.path.getsize(filepath) / 2**20, lengths.mean())
+
+    # Only the padding token is looked up by the collator.
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+    collator = _InstrumentedCollator(DataCollatorForMmapedDataset(tokenizer, sft=sft))
+
+    results = []
+    for num_workers, batch_size, pin_memory in itertools.product(args.num_workers, args.batch_sizes, args.pin_memory):
+        result = benchmark_dataloader(args, dataset, lengths, collator,
+                                      num_workers=num_workers, batch_size=batch_size, pin_memory=pin_memory)
+        LOG.info("num_workers=%s, batch_size=%s, pin_memory=%s: %.0f samples/s, %.0f tokens/s, "
+                 "padding ratio %.3f, batch latency p50 %.2f ms / p99 %.2f ms",
+                 num_workers, batch_size, pin_memory, result["samples_per_s"], result["tokens_per_s"],
+                 result["padding_ratio"], result["batch_latency_ms"]["p50"], result["batch_latency_ms"]["p99"])
+        results.append(result)
+
+    return dict(
+        dataset=dict(
+            file=args.file,
+            mode=args.mode,
+            num_rows=len(dataset),
+            file_size_bytes=os.path.getsize(filepath),
+            num_tokens=int(lengths.sum()),
+            mean_length=float(lengths.mean()),
+            max_length=int(lengths.max()),
+            length_distribution=None if args.file is not None else args.length_distribution,
+        ),
+        environment=dict(
+            python=platform.python_version(),
+            torch=torch.__version__,
+            cpu_count=os.cpu_count(),
+        ),
+        sampler=args.sampler,
+        seed=args.seed,
+        results=results,
+    )
+
+
+def benchmark_dataloader(
+    args: argparse.Namespace,
+    dataset: MmappedArrowDataset,
+    lengths: np.ndarray,
+    collator: "_InstrumentedCollator",
+    num_workers: int,
+    batch_size: int,
+    pin_memory: bool,
+) -> t.Dict[str, t.Any]:
+    '''
+    Runs through up to `args.max_batches` batches and measures how long the
+    training loop would have waited on each. The time until the first batch
+    (worker startup included) is reported separately and not counted towards
+    throughput or latency, and neither are the `args.warmup_batches` after it.
+    '''
+    if args.sampler == "length-grouped":
+        batch_sampler = LengthGroupedBatchSampler(lengths, batch_size, seed=args.seed)
+    else:
+        batch_sampler = ShuffledBatchSampler(len(dataset), batch_size, drop_last=True, seed=args.seed)
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collator,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=args.prefetch_factor if num_workers > 0 else None,
+        persistent_workers=False,
+    )
+
+    main_rss_before = _read_proc_status_kb(RSS_KEYS)
+    worker_rss: t.Dict[int, t.Dict[str, int]] = {}
+    latencies: t.List[float] = []
+    num_samples = num_real_tokens = num_padded_tokens = 0
+
+    start = time.perf_counter()
+    last = start
+    startup = None
+    iterator = iter(dataloader)
+    for batch_idx in range(args.max_batches + args.warmup_batches + 1):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        now = time.perf_counter()
+        worker_rss[int(batch["worker_id"])] = {key: int(value) for key, value in zip(RSS_KEYS, batch["rss_growth_kb"])}
+
+        if batch_idx == 0:
+            startup = now - start
+        elif batch_idx > args.warmup_batches:
+            latencies.append(now - last)
+            num_samples += batch["input_ids"].shape[0]
+            num_real_tokens += int(batch["num_real_tokens"])
+            num_padded_tokens += batch["input_ids"].numel()
+        last = now
+    del iterator
+
+    if not latencies:
+        raise ValueError(f"Only got {batch_idx} batches, which isn't more than the {args.warmup_batches} "
+                         "warmup batches. Use a bigger dataset or fewer warmup batches.")
+    elapsed = sum(latencies)
+    latencies_ms = 1000 * np.array(latencies)
+
+    main_rss_after = _read_proc_status_kb(RSS_KEYS)
+    if num_workers == 0:
+        # Everything happened in the main process, which is also what the collator measured.
+        worker_rss = {}
+    return dict(
+        num_workers=num_workers,
+        batch_size=batch_size,
+        pin_memory=pin_memory,
+        num_batches=len(latencies),
+        startup_s=startup,
+        samples_per_s=num_samples / elapsed,
+        tokens_per_s=num_real_tokens / elapsed,
+        padded_tokens_per_s=num_padded_tokens / elapsed,
+        # Fraction of the tokens the model sees that are only padding.
+        padding_ratio=1 - num_real_tokens / num_padded_tokens,
+        batch_latency_ms=dict(
+            mean=float(latencies_ms.mean()),
+            p50=float(np.percentile(latencies_ms, 50)),
+            p99=float(np.percentile(latencies_ms, 99)),
+            max=float(latencies_ms.max()),
+        ),
+        main_rss_growth_kb={key: main_rss_after[key] - main_rss_before[key] for key in RSS_KEYS},
+        worker_rss_growth_kb={str(worker_id): rss for worker_id, rss in sorted(worker_rss.items())},
+    )
+
+
+class _InstrumentedCollator:
+    '''
+    Wraps the real collator, and additionally puts into every batch the
+    amount of non-padding tokens in it, which worker made it and how much
+    that worker's RSS has grown since it collated its first batch.
+    '''
+    def __init__(self, collator: DataCollatorForMmapedDataset) -> None:
+        self.collator = collator
+        # Per-process, since every worker gets its own copy of this object.
+        self._rss_baseline: t.Optional[t.Tuple[int, t.Dict[str, int]]] = None
+
+    def __call__(self, instances) -> dict:
+        batch = self.collator(instances)
+
+        rss = _read_proc_status_kb(RSS_KEYS)
+        if self._rss_baseline is None or self._rss_baseline[0] != os.getpid():
+            self._rss_baseline = (os.getpid(), rss)
+        baseline = self._rss_baseline[1]
+
+        worker_info = torch.utils.data.get_worker_info()
+        batch["num_real_tokens"] = torch.tensor(sum(len(_as_numpy(instance["input_ids"])) for instance in instances))
+        batch["worker_id"] = torch.tensor(worker_info.id if worker_info is not None else -1)
+        batch["rss_growth_kb"] = torch.tensor([rss[key] - baseline[key] for key in RSS_KEYS])
+        return batch
+
+
+def write_synthetic_file(args: argparse.Namespace, filepath: str) -> None:
+    rng = np.random.default_rng(args.seed)
+    lengths = sample_lengths(args.length_distribution, args.num_rows, args.min_length, args.max_length, rng)
+    if args.mode == "sft":
+        write_synthetic_sft_file(filepath, args.num_rows, args.max_length, vocab_size=args.vocab_size,
+                                 seed=args.seed, compact=True, lengths=lengths)
+    else:
+        write_synthetic_uft_file(filepath, args.num_rows, args.max_length, vocab_size=args.vocab_size,
+                                 seed=args.seed, fixed_width=True, lengths=lengths)
+    LOG.info("Wrote %s synthetic %s rows (%s lengths, mean %.1f tokens) to %s",
+             args.num_rows, args.mode, args.length_distribution, lengths.mean(), filepath)
+
+
+def sample_lengths(
+    distribution: str,
+    num_rows: int,
+    min_length: int,
+    max_length: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    '''
+    Row lengths between `min_length` and `max_length`:
+
+    - `fixed`: all `max_length` (UFT chunks are like this, except for the last one per file)
+    - `uniform`: uniformly distributed
+    - `lognormal`: long-tailed, with a median at a quarter of `max_length`,
+      which is closer to what instruction data usually looks like
+    '''
+    if distribution == "fixed":
+        return np.full(num_rows, max_length)
+    if distribution == "uniform":
+        return rng.integers(min_length, max_length + 1, size=num_rows)
+    if distribution == "lognormal":
+        lengths = rng.lognormal(mean=np.log(max_length / 4), sigma=0.75, size=num_rows)
+        return np.clip(lengths.astype(np.int64), min_length, max_length)
+    raise ValueError(f"Unknown length distribution: {distribution}")
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Dataloader throughput benchmark.")
+    parser.add_argument("--mode", choices=("sft", "uft"), default="sft")
+    parser.add_argument("--file", default=None, help="Use an existing tokenized file instead of a synthetic one.")
+    parser.add_argument("--tmp-dir", default=None, help="Where to write the synthetic Arrow file.")
+    parser.add_argument("--output", default=None, help="Also write the JSON results to this file.")
+    parser.add_argument("--seed", type=int, default=42)
+
+    synthetic = parser.add_argument_group("synthetic data")
+    synthetic.add_argument("--num-rows", type=int, default=16384)
+    synthetic.add_argument("--min-length", type=int, default=16)
+    synthetic.add_argument("--max-length", type=int, default=2048)
+    synthetic.add_argument("--length-distribution", choices=("fixed", "uniform", "lognormal"), default="uniform")
+    synthetic.add_argument("--vocab-size", type=int, default=32000)
+
+    loader = parser.add_argument_group("dataloader")
+    loader.add_argument("--num-workers", type=int, nargs="+", default=[0, 2, 4])
+    loader.add_argument("--batch-sizes", type=int, nargs="+", default=[8])
+    loader.add_argument("--pin-memory", choices=("true", "false", "both"), default="false",
+                        help="Pinning only does something when there's an accelerator.")
+    loader.add_argument("--prefetch-factor", type=int, default=2)
+    loader.add_argument("--sampler", choices=("shuffled", "length-grouped"), default="shuffled")
+    loader.add_argument("--max-batches", type=int, default=512)
+    loader.add_argument("--warmup-batches", type=int, default=8)
+
+    args = parser.parse_args()
+    args.pin_memory = {"true": [True], "false": [False], "both": [False, True]}[args.pin_memory]
+    return args
+
+
+if __name__ == "__main__":
+    main()
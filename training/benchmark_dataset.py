@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmarks for the dataset/collator stack. Builds synthetic Arrow files
+in the same layout as the tokenization scripts so nothing has to be
+downloaded or tokenized beforehand.
+
+Example: python training/benchmark_dataset.py collate --seq-len 2048 --batch-size 8
+'''
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import types
+import typing as t
+
+import numpy as np
+import pyarrow as pa
+import torch
+
+from dataset import IGNORE_INDEX, DataCollatorForMmapedDataset, MmappedArrowDataset, _as_numpy
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        args.func(args, tmp_dir)
+
+
+def benchmark_collate(args: argparse.Namespace, tmp_dir: str) -> None:
+    '''Compares the list-based and the zero-copy collation paths.'''
+    # Only the padding token is looked up by the collator.
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+
+    for sft in (True, False):
+        mode = "sft" if sft else "uft"
+        filepath = os.path.join(tmp_dir, f"{mode}.arrow")
+        if sft:
+            write_synthetic_sft_file(filepath, args.num_rows, args.seq_len, seed=args.seed)
+        else:
+            write_synthetic_uft_file(filepath, args.num_rows, args.seq_len, seed=args.seed)
+
+        dataset = MmappedArrowDataset(filepath, sft=sft)
+        rng = np.random.default_rng(args.seed)
+        batches = [[dataset[int(idx)] for idx in rng.integers(len(dataset), size=args.batch_size)]
+                   for _ in range(args.iterations)]
+
+        results = {}
+        for zero_copy in (False, True):
+            collator = DataCollatorForMmapedDataset(tokenizer, sft=sft, zero_copy=zero_copy)
+            start = time.perf_counter()
+            outputs = [collator(batch) for batch in batches]
+            elapsed = time.perf_counter() - start
+            results[zero_copy] = outputs
+            num_tokens = sum(int(o["input_ids"].numel()) for o in outputs)
+            LOG.info("%s, zero_copy=%s: %.2f ms/batch, %.0f tokens/s",
+                     mode, zero_copy, 1000 * elapsed / len(batches), num_tokens / elapsed)
+
+        for reference, candidate in zip(results[False], results[True]):
+            for key in ("input_ids", "labels"):
+                assert torch.equal(reference[key], candidate[key]), \
+                    f"Zero-copy collation produced a different `{key}` tensor."
+        LOG.info("%s: both collation paths produced identical batches.", mode)
+
+
+def benchmark_load(args: argparse.Namespace, tmp_dir: str) -> None:
+    '''
+    Startup time, per-item latency and per-worker RSS of the lazy dataset vs.
+    the old behavior of reading the whole file into a Table upfront. Pass
+    `--file` to measure on a real (e.g. multi-GB) tokenized file.
+    '''
+    sft = args.mode == "sft"
+    filepath = args.file
+    if filepath is None:
+        filepath = os.path.join(tmp_dir, f"{args.mode}.arrow")
+        if sft:
+            write_synthetic_sft_file(filepath, args.num_rows, args.seq_len, seed=args.seed)
+        else:
+            write_synthetic_uft_file(filepath, args.num_rows, args.seq_len, seed=args.seed)
+    LOG.info("Benchmarking %s (%.1f MiB)", filepath, os.path.getsize(filepath) / 2**20)
+
+    for name, dataset_cls in (("read_all", _ReadAllArrowDataset), ("lazy", MmappedArrowDataset)):
+        start = time.perf_counter()
+        dataset = dataset_cls(filepath, sft=sft)
+        startup = time.perf_counter() - start
+
+        rng = np.random.default_rng(args.seed)
+        indices = rng.integers(len(dataset), size=args.items_per_worker)
+        latencies = np.empty(len(indices))
+        for i, idx in enumerate(indices):
+            start = time.perf_counter()
+            # Actually touch the data, otherwise nothing gets paged in.
+            _touch(dataset[int(idx)])
+            latencies[i] = time.perf_counter() - start
+
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(args.num_workers) as pool:
+            worker_rss = pool.starmap(_rss_growth_after_reading, [
+                (dataset, args.items_per_worker, args.seed + worker) for worker in range(args.num_workers)
+            ])
+
+        LOG.info("%s: startup %.1f ms, item latency p50 %.1f us / p99 %.1f us",
+                 name, 1000 * startup,
+                 1e6 * np.percentile(latencies, 50), 1e6 * np.percentile(latencies, 99))
+        for worker, rss in enumerate(worker_rss):
+            LOG.info("%s: worker %s RSS grew by %.1f MiB (anonymous %.1f MiB, file-backed %.1f MiB)",
+                     name, worker, rss["VmRSS"] / 1024, rss["RssAnon"] / 1024, rss["RssFile"] / 1024)
+        del dataset
+
+
+def benchmark_layout(args: argparse.Namespace, tmp_dir: str) -> None:
+    '''
+    File size, startup time, per-item latency and sequential read throughput of
+    the original UFT layout (one int64 record batch per chunk) vs. the
+    fixed-width one.
+    '''
+    for fixed_width in (False, True):
+        name = "fixed-width" if fixed_width else "batch per chunk"
+        filepath = os.path.join(tmp_dir, f"uft-{'fixed' if fixed_width else 'chunked'}.arrow")
+        write_synthetic_uft_file(filepath, args.num_rows, args.seq_len, vocab_size=args.vocab_size,
+                                 seed=args.seed, fixed_width=fixed_width)
+
+        start = time.perf_counter()
+        dataset = MmappedArrowDataset(filepath, sft=False)
+        startup = time.perf_counter() - start
+
+        rng = np.random.default_rng(args.seed)
+        indices = rng.integers(len(dataset), size=args.num_items)
+        latencies = np.empty(len(indices))
+        for i, idx in enumerate(indices):
+            start = time.perf_counter()
+            _touch(dataset[int(idx)])
+            latencies[i] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        num_tokens = sum(len(_as_numpy(dataset[idx]["input_ids"])) for idx in range(len(dataset)))
+        sequential = time.perf_counter() - start
+
+        LOG.info("%s: %.1f MiB on disk, startup %.1f ms, item latency p50 %.1f us / p99 %.1f us, "
+                 "sequential read %.0f tokens/s",
+                 name, os.path.getsize(filepath) / 2**20, 1000 * startup,
+                 1e6 * np.percentile(latencies, 50), 1e6 * np.percentile(latencies, 99),
+                 num_tokens / sequential)
+        del dataset
+
+
+def benchmark_sft_layout(args: argparse.Namespace, tmp_dir: str) -> None:
+    '''
+    File size and read throughput (dataset + collator, so rebuilding labels is
+    included) of the original SFT layout vs. the compact one.
+    '''
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+    collator = DataCollatorForMmapedDataset(tokenizer, sft=True)
+    results = {}
+    for compact in (False, True):
+        name = "compact" if compact else "full"
+        filepath = os.path.join(tmp_dir, f"sft-{name}.arrow")
+        write_synthetic_sft_file(filepath, args.num_rows, args.seq_len, vocab_size=args.vocab_size,
+                                 seed=args.seed, compact=compact)
+        dataset = MmappedArrowDataset(filepath, sft=True)
+
+        rng = np.random.default_rng(args.seed)
+        batches = [rng.integers(len(dataset), size=args.batch_size) for _ in range(args.iterations)]
+        start = time.perf_counter()
+        outputs = [collator([dataset[int(idx)] for idx in batch]) for batch in batches]
+        elapsed = time.perf_counter() - start
+        results[compact] = outputs
+
+        num_tokens = sum(int(dataset.row_lengths()[batch].sum()) for batch in batches)
+        LOG.info("%s: %.1f MiB on disk, %.0f samples/s, %.0f tokens/s",
+                 name, os.path.getsize(filepath) / 2**20,
+                 args.batch_size * len(batches) / elapsed, num_tokens / elapsed)
+
+    for reference, candidate in zip(results[False], results[True]):
+        for key in ("input_ids", "labels"):
+            assert torch.equal(reference[key], candidate[key]), \
+                f"The compact layout produced a different `{key}` tensor."
+    LOG.info("Both layouts produced identical batches.")
+
+
+class _ReadAllArrowDataset(MmappedArrowDataset):
+    '''The previous implementation, which called `read_all()` upfront. Only kept around for comparison.'''
+    def __init__(self, filepath: str, sft: bool = True) -> None:
+        source = pa.memory_map(filepath, "r")
+        reader = pa.ipc.RecordBatchFileReader(source)
+        self.table = reader.read_all()
+        self.sft = sft
+
+    def __len__(self) -> int:
+        if self.sft:
+            return len(self.table)
+        return self.table["input_ids"].num_chunks
+
+    def __getitem__(self, idx) -> dict:
+        if self.sft:
+            return dict(input_ids=self.table["input_ids"][idx], labels=self.table["labels"][idx])
+        return dict(input_ids=self.table["input_ids"].chunk(idx))
+
+
+def _touch(item: dict) -> int:
+    return sum(int(value.as_py()) if isinstance(value, pa.Int32Scalar) else int(_as_numpy(value)[-1])
+               for value in item.values())
+
+
+def _rss_growth_after_reading(dataset: MmappedArrowDataset, num_items: int, seed: int) -> t.Dict[str, int]:
+    '''
+    How much a (forked) worker's RSS grows while reading `num_items` random
+    items. Anything inherited from the parent is left out, since it's shared.
+    '''
+    keys = ("VmRSS", "RssAnon", "RssFile")
+    before = _read_proc_status_kb(keys)
+    rng = np.random.default_rng(seed)
+    for idx in rng.integers(len(dataset), size=num_items):
+        _touch(dataset[int(idx)])
+    after = _read_proc_status_kb(keys)
+    return {key: after[key] - before[key] for key in keys}
+
+
+def _read_proc_status_kb(keys: t.Iterable[str]) -> t.Dict[str, int]:
+    '''Reads memory stats (in KiB) for the current process from /proc/self/status.'''
+    stats = {}
+    with open("/proc/self/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in keys:
+                stats[key] = int(value.split()[0])
+    return stats
+
+
+def write_synthetic_sft_file(
+    filepath: str,
+    num_rows: int,
+    max_length: int,
+    vocab_size: int = 32000,
+    seed: int = 42,
+    compact: bool = False,
+    lengths: t.Optional[np.ndarray] = None,
+) -> None:
+    '''
+    Writes an SFT-style file with random prompt/response splits and lengths
+    (uniform between 16 and `max_length` tokens, unless `lengths` is given).
+    With `compact`, it's written in the compact layout instead: token IDs in
+    the smallest dtype that fits `vocab_size`, and prompt lengths instead of
+    labels.
+    '''
+    rng = np.random.default_rng(seed)
+    if lengths is None:
+        lengths = rng.integers(16, max_length + 1, size=num_rows)
+    prompt_lengths = (lengths * rng.uniform(0.1, 0.9, size=num_rows)).astype(np.int64)
+
+    if compact:
+        # NOTE: Mirrors `compact_sft_schema` in ./preparation/arrow_formats.py.
+        token_type = pa.uint16() if vocab_size <= 2**16 else pa.int32()
+        input_ids = pa.ListArray.from_arrays(
+            pa.array(np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)),
+            pa.array(rng.integers(vocab_size, size=int(lengths.sum())), type=token_type))
+        table = pa.table({"input_ids": input_ids, "prompt_length": pa.array(prompt_lengths, type=pa.int32())})
+        with pa.OSFile(filepath, 'wb') as sink:
+            with pa.RecordBatchFileWriter(sink, table.schema) as writer:
+                writer.write_table(table)
+        return
+
+    input_ids, labels = [], []
+    for length, prompt_length in zip(lengths, prompt_lengths):
+        tokens = rng.integers(vocab_size, size=length)
+        input_ids.append(tokens)
+        labels.append(np.concatenate([np.full(prompt_length, IGNORE_INDEX), tokens[prompt_length:]]))
+
+    table = pa.table({"input_ids": input_ids, "labels": labels})
+    with pa.OSFile(filepath, 'wb') as sink:
+        with pa.RecordBatchFileWriter(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_synthetic_uft_file(
+    filepath: str,
+    num_rows: int,
+    max_length: int,
+    vocab_size: int = 32000,
+    seed: int = 42,
+    fixed_width: bool = False,
+    rows_per_batch: int = 1024,
+    lengths: t.Optional[np.ndarray] = None,
+) -> None:
+    '''
+    Writes a UFT-style file: either one record batch per `max_length` chunk, or
+    (with `fixed_width`) chunks as rows of a fixed-size list column in the
+    smallest dtype that fits `vocab_size`. Chunks are full unless `lengths` is
+    given.
+    '''
+    if lengths is None:
+        lengths = np.full(num_rows, max_length)
+    rng = np.random.default_rng(seed)
+    if fixed_width:
+        # NOTE: Mirrors `FixedLengthChunkWriter` in ./preparation/arrow_formats.py.
+        token_type = pa.uint16() if vocab_size <= 2**16 else pa.int32()
+        schema = pa.schema([
+            pa.field("input_ids", pa.list_(token_type, max_length)),
+            pa.field("length", pa.int32()),
+        ])
+        with pa.OSFile(filepath, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema=schema) as writer:
+                for start in range(0, num_rows, rows_per_batch):
+                    num_batch_rows = min(rows_per_batch, num_rows - start)
+                    tokens = pa.array(rng.integers(vocab_size, size=num_batch_rows * max_length), type=token_type)
+                    batch_lengths = pa.array(lengths[start:start + num_batch_rows].astype(np.int32))
+                    writer.write(pa.record_batch(
+                        [pa.FixedSizeListArray.from_arrays(tokens, max_length), batch_lengths], schema=schema))
+        return
+
+    schema = pa.schema([pa.field('input_ids', pa.int64())])
+    with pa.OSFile(filepath, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema=schema) as writer:
+            for length in lengths:
+                chunk = pa.array(rng.integers(vocab_size, size=length))
+                writer.write(pa.record_batch([chunk], schema=schema))
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Dataset/collator micro-benchmarks.")
+    parser.add_argument("--tmp-dir", default=None, help="Where to write the synthetic Arrow files.")
+    parser.add_argument("--seed", type=int, default=42)
+    subparsers = parser.add_subparsers(required=True)
+
+    collate = subparsers.add_parser("collate", help="List-based vs. zero-copy collation.")
+    collate.add_argument("--num-rows", type=int, default=1024)
+    collate.add_argument("--seq-len", type=int, default=2048)
+    collate.add_argument("--batch-size", type=int, default=8)
+    collate.add_argument("--iterations", type=int, default=64)
+    collate.set_defaults(func=benchmark_collate)
+
+    load = subparsers.add_parser("load", help="Startup time, item latency and worker RSS of the dataset.")
+    load.add_argument("--mode", choices=("sft", "uft"), default="sft")
+    load.add_argument("--file", default=None, help="Use an existing tokenized file instead of a synthetic one.")
+    load.add_argument("--num-rows", type=int, default=16384)
+    load.add_argument("--seq-len", type=int, default=2048)
+    load.add_argument("--num-workers", type=int, default=4)
+    load.add_argument("--items-per-worker", type=int, default=2048)
+    load.set_defaults(func=benchmark_load)
+
+    layout = subparsers.add_parser("layout", help="Original vs. fixed-width UFT layout.")
+    layout.add_argument("--num-rows", type=int, default=16384)
+    layout.add_argument("--seq-len", type=int, default=2048)
+    layout.add_argument("--vocab-size", type=int, default=32000)
+    layout.add_argument("--num-items", type=int, default=4096)
+    layout.set_defaults(func=benchmark_layout)
+
+    sft_layout = subparsers.add_parser("sft-layout", help="Original vs. compact SFT layout.")
+    sft_layout.add_argument("--num-rows", type=int, default=16384)
+    sft_layout.add_argument("--seq-len", type=int, default=2048)
+    sft_layout.add_argument("--vocab-size", type=int, default=32000)
+    sft_layout.add_argument("--batch-size", type=int, default=8)
+    sft_layout.add_argument("--iterations", type=int, default=256)
+    sft_layout.set_defaults(func=benchmark_sft_layout)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
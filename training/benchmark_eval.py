@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''
+Evaluation throughput of tiny, randomly initialized GPT-NeoX and GPT-J models
+with the xFormers monkeypatches applied, at increasing eval batch sizes.
+
+Batches are made the same way as during training (padded by
+`DataCollatorForMmapedDataset`, with the loss computed from `labels`). Before
+timing anything, batched results of the patched models are checked against
+the unpatched models going through the examples one at a time, both for a
+forward pass with a (right) padding mask and for greedy generation with left
+padding.
+
+Example: python training/benchmark_eval.py --batch-sizes 1 4 16 --num-examples 256
+'''
+import argparse
+import logging
+import time
+import types
+import typing as t
+
+import numpy as np
+import torch
+import transformers
+
+from dataset import DataCollatorForMmapedDataset
+from monkeypatches import apply_xformers_monkeypatches
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    models = {
+        "gpt-neox": transformers.AutoModelForCausalLM.from_config(transformers.GPTNeoXConfig(
+            vocab_size=args.vocab_size, hidden_size=args.hidden_size, intermediate_size=4 * args.hidden_size,
+            num_hidden_layers=args.num_layers, num_attention_heads=args.num_heads,
+            max_position_embeddings=2 * args.max_length)).eval(),
+        "gpt-j": transformers.AutoModelForCausalLM.from_config(transformers.GPTJConfig(
+            vocab_size=args.vocab_size, n_embd=args.hidden_size, n_layer=args.num_layers, n_head=args.num_heads,
+            rotary_dim=args.hidden_size // args.num_heads // 2, n_positions=2 * args.max_length)).eval(),
+    }
+    examples = [rng.integers(1, args.vocab_size, size=length)
+                for length in rng.integers(args.min_length, args.max_length + 1, size=args.num_examples)]
+
+    # Unpatched references, one example at a time.
+    check_examples = examples[:args.check_batch_size]
+    references = {name: _reference_outputs(model, check_examples, args.max_new_tokens)
+                  for name, model in models.items()}
+
+    apply_xformers_monkeypatches()
+    for name, model in models.items():
+        _check_batched_outputs(name, model, check_examples, references[name], args.max_new_tokens, args.atol)
+
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+    collator = DataCollatorForMmapedDataset(tokenizer, sft=False)
+    for name, model in models.items():
+        for batch_size in args.batch_sizes:
+            batches = [collator([dict(input_ids=example) for example in examples[start:start + batch_size]])
+                       for start in range(0, len(examples), batch_size)]
+            with torch.no_grad():
+                # Warmup.
+                model(**batches[0])
+                start = time.perf_counter()
+                for batch in batches:
+                    model(**batch)
+                elapsed = time.perf_counter() - start
+
+            num_tokens = sum(len(example) for example in examples)
+            num_padded_tokens = sum(batch["input_ids"].numel() for batch in batches)
+            LOG.info("%s, eval batch size %s: %.1f examples/s, %.0f tokens/s (%.1f%% padding)",
+                     name, batch_size, len(examples) / elapsed, num_tokens / elapsed,
+                     100 * (1 - num_tokens / num_padded_tokens))
+
+
+def _reference_outputs(
+    model: transformers.PreTrainedModel,
+    examples: t.List[np.ndarray],
+    max_new_tokens: int,
+) -> t.Tuple[t.List[torch.Tensor], t.List[torch.Tensor]]:
+    logits, generations = [], []
+    with torch.no_grad():
+        for example in examples:
+            input_ids = torch.from_numpy(example)[None]
+            logits.append(model(input_ids=input_ids).logits[0])
+            generations.append(model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                              pad_token_id=0)[0, len(example):])
+    return logits, generations
+
+
+def _check_batched_outputs(
+    name: str,
+    model: transformers.PreTrainedModel,
+    examples: t.List[np.ndarray],
+    references: t.Tuple[t.List[torch.Tensor], t.List[torch.Tensor]],
+    max_new_tokens: int,
+    atol: float,
+) -> None:
+    reference_logits, reference_generations = references
+    max_length = max(len(example) for example in examples)
+    with torch.no_grad():
+        input_ids, attention_mask = _pad(examples, max_length, left=False)
+        logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+        for idx, example in enumerate(examples):
+            difference = (logits[idx, :len(example)] - reference_logits[idx]).abs().max().item()
+            assert difference <= atol, f"{name}: batched logits are off by up to {difference}."
+
+        input_ids, attention_mask = _pad(examples, max_length, left=True)
+        generations = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens,
+                                     do_sample=False, pad_token_id=0)[:, max_length:]
+        for generation, reference in zip(generations, reference_generations):
+            assert torch.equal(generation, reference), f"{name}: batched generation differs."
+    LOG.info("%s: batched forward passes and generation match unbatched, unpatched ones.", name)
+
+
+def _pad(examples: t.List[np.ndarray], length: int, left: bool) -> t.Tuple[torch.Tensor, torch.Tensor]:
+    input_ids = torch.zeros(len(examples), length, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for idx, example in enumerate(examples):
+        positions = slice(length - len(example), length) if left else slice(0, len(example))
+        input_ids[idx, positions] = torch.from_numpy(example)
+        attention_mask[idx, positions] = 1
+    return input_ids, attention_mask
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Batched evaluation throughput of the patched GPT-NeoX/GPT-J.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--num-examples", type=int, default=128)
+    parser.add_argument("--min-length", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=1024)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--check-batch-size", type=int, default=4, help="Examples to check batched outputs on.")
+    parser.add_argument("--max-new-tokens", type=int, default=8)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
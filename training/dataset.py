@@ -1,4 +1,13 @@
+import bisect
+import collections
+import hashlib
+import json
+import os
+import typing as t
+
+import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 
 from torch.utils.data import Dataset
@@ -8,38 +17,473 @@ from transformers.tokenization_utils import PreTrainedTokenizer
 IGNORE_INDEX = -100
 
 class MmappedArrowDataset(Dataset):
-    '''Memory-mapped PyArrow dataset.'''
-    def __init__(self, filepath: str, sft: bool = True) -> None:
-        source = pa.memory_map(filepath, "r")
-        reader = pa.ipc.RecordBatchFileReader(source)
-        self.table = reader.read_all()
+    '''
+    Memory-mapped PyArrow dataset.
+
+    Record batches are only read when an item inside of them is requested, and
+    only an index of where each batch starts is kept around. The file is
+    (re-)opened lazily in every process that uses the dataset, so dataloader
+    workers share the OS page cache instead of each holding their own copy of
+    the data.
+
+    If `pack_to_length` is given, SFT rows are bin-packed on the fly into rows
+    of at most that many tokens (see `pack_sequences`). Files that were already
+    packed at tokenization time are detected through their `seq_lens` column.
+
+    SFT files in the compact layout store `prompt_length` (or, when packed,
+    `prompt_lengths`) instead of a `labels` column. Those rows are returned as
+    they are, and the collator rebuilds the labels.
+
+    UFT files come in two layouts: the original one, where every record batch
+    is a single chunk, and the fixed-width one, where chunks are rows of a
+    fixed-size list column which get sliced out of each record batch without
+    any copies.
+    '''
+    def __init__(self, filepath: str, sft: bool = True, pack_to_length: t.Optional[int] = None) -> None:
+        self.filepath = filepath
         self.sft = sft
+        self._reader: t.Optional[pa.ipc.RecordBatchFileReader] = None
+        self._reader_pid: t.Optional[int] = None
+        self._cached_batch_idx: t.Optional[int] = None
+        self._cached_columns: t.Dict[str, pa.Array] = {}
+        self._fixed_width_views: t.Dict[int, t.Dict[str, np.ndarray]] = {}
+
+        reader = self._get_reader()
+        self.column_names: t.List[str] = reader.schema.names
+        self.num_batches: int = reader.num_record_batches
+        self.prepacked = sft and "seq_lens" in self.column_names
+        self.compact = sft and "labels" not in self.column_names
+        self.fixed_width = not sft and pa.types.is_fixed_size_list(reader.schema.field("input_ids").type)
+
+        # batch_offsets[i] is the index of the first row in the i-th record
+        # batch. In the original UFT layout every record batch is a single item,
+        # so no index is needed.
+        self.batch_offsets: t.Optional[np.ndarray] = None
+        if sft or self.fixed_width:
+            rows_per_batch = [reader.get_batch(i).num_rows for i in range(self.num_batches)]
+            self.batch_offsets = np.concatenate([[0], np.cumsum(rows_per_batch, dtype=np.int64)])
+            # Plain ints, since bisecting these is faster than a NumPy call for a single lookup.
+            self._batch_starts: t.List[int] = self.batch_offsets[:-1].tolist()
+
+        # Row lengths etc. written at tokenization time, if they're there and
+        # still match the file.
+        self.index = load_dataset_index(filepath)
+        if self.index is not None and len(self.index.lengths) != self._num_rows():
+            self.index = None
+
+        self.bins: t.Optional[t.List[t.List[int]]] = None
+        if pack_to_length is not None:
+            assert sft, "Packing is only supported for SFT data."
+            assert not self.prepacked, f"{filepath} was already packed at tokenization time."
+            self.bins = pack_sequences(self.row_lengths(), pack_to_length)
 
     def __len__(self) -> int:
-        if self.sft:
-            return len(self.table)
-        else:
-            return self.table["input_ids"].num_chunks
+        if self.bins is not None:
+            return len(self.bins)
+        return self._num_rows()
 
     def __getitem__(self, idx) -> dict:
+        if self.bins is not None:
+            return self._get_packed_item(self.bins[idx])
         if self.sft:
+            columns, row = self._locate_row(idx)
+            item = dict(input_ids=columns["input_ids"][row])
+            if self.compact:
+                label_columns = ("seq_lens", "prompt_lengths") if self.prepacked else ("prompt_length",)
+            else:
+                label_columns = ("labels", "seq_lens") if self.prepacked else ("labels",)
+            for name in label_columns:
+                item[name] = columns[name][row]
+            return item
+        elif self.fixed_width:
+            columns, row = self._locate_row(idx)
             return dict(
-                input_ids=self.table["input_ids"][idx],
-                labels=self.table["labels"][idx]
+                input_ids=columns["input_ids"][row, :columns["length"][row]]
             )
         else:
             return dict(
-                input_ids=self.table["input_ids"].chunk(idx)
+                input_ids=self._get_columns(idx)["input_ids"]
             )
 
+    def __getstate__(self) -> dict:
+        # Memory-mapped files can't be pickled (e.g. when sending the dataset
+        # over to spawned dataloader workers), so they get re-opened instead.
+        state = self.__dict__.copy()
+        state.update(_reader=None, _reader_pid=None, _cached_batch_idx=None, _cached_columns={},
+                     _fixed_width_views={})
+        return state
+
+    def check_tokenizer(self, tokenizer: PreTrainedTokenizer) -> None:
+        '''Raises a `ValueError` if the file's index says it was tokenized with a different tokenizer.'''
+        if self.index is not None:
+            self.index.check_tokenizer(tokenizer)
+
+    def close(self) -> None:
+        '''Drops the memory-mapped file. It gets re-opened if the dataset is read from again.'''
+        self._reader, self._reader_pid = None, None
+        self._cached_batch_idx, self._cached_columns = None, {}
+        self._fixed_width_views = {}
+
+    @property
+    def packed(self) -> bool:
+        return self.prepacked or self.bins is not None
+
+    def row_lengths(self) -> np.ndarray:
+        '''
+        Token count of every (unpacked) row. Comes from the index when there is
+        one, and is otherwise read from the Arrow offsets without materializing
+        any rows.
+        '''
+        if self.index is not None:
+            return self.index.lengths.astype(np.int64)
+        reader = self._get_reader()
+        if self.num_batches == 0:
+            # E.g. an empty shard of a sharded dataset.
+            return np.empty(0, dtype=np.int64)
+        if self.sft:
+            return np.concatenate([
+                pc.list_value_length(reader.get_batch(i).column("input_ids")).to_numpy()
+                for i in range(self.num_batches)
+            ])
+        if self.fixed_width:
+            return np.concatenate([
+                reader.get_batch(i).column("length").to_numpy()
+                for i in range(self.num_batches)
+            ]).astype(np.int64)
+        return np.array([reader.get_batch(i).num_rows for i in range(self.num_batches)])
+
+    def item_lengths(self) -> np.ndarray:
+        '''Token count of every item returned by `__getitem__` (i.e. of packed rows, if packing).'''
+        lengths = self.row_lengths()
+        if self.bins is None:
+            return lengths
+        return np.array([lengths[row_indices].sum() for row_indices in self.bins])
+
+    def _num_rows(self) -> int:
+        if self.batch_offsets is not None:
+            return int(self.batch_offsets[-1])
+        return self.num_batches
+
+    def _get_reader(self) -> pa.ipc.RecordBatchFileReader:
+        # Checking the PID catches forked dataloader workers, which must not
+        # share the parent's file handle.
+        if self._reader is None or self._reader_pid != os.getpid():
+            source = pa.memory_map(self.filepath, "r")
+            self._reader = pa.ipc.RecordBatchFileReader(source)
+            self._reader_pid = os.getpid()
+            self._cached_batch_idx, self._cached_columns = None, {}
+            self._fixed_width_views = {}
+        return self._reader
+
+    def _get_columns(self, batch_idx: int) -> t.Dict[str, pa.Array]:
+        '''
+        Returns the columns of a record batch. The last batch is cached, since
+        rows are often read in runs.
+
+        In the fixed-width UFT layout, columns are returned as NumPy views
+        instead, with `input_ids` as a 2-D array. These views are kept around
+        for every batch, since they only point into the memory-mapped file.
+        '''
+        reader = self._get_reader()
+        if self.fixed_width:
+            if batch_idx not in self._fixed_width_views:
+                batch = reader.get_batch(batch_idx)
+                input_ids = batch.column("input_ids")
+                self._fixed_width_views[batch_idx] = dict(
+                    input_ids=_as_numpy(input_ids.flatten()).reshape(len(input_ids), input_ids.type.list_size),
+                    length=_as_numpy(batch.column("length")),
+                )
+            return self._fixed_width_views[batch_idx]
+
+        if batch_idx != self._cached_batch_idx:
+            batch = reader.get_batch(batch_idx)
+            self._cached_columns = dict(zip(self.column_names, batch.columns))
+            self._cached_batch_idx = batch_idx
+        return self._cached_columns
+
+    def _locate_row(self, idx: int) -> t.Tuple[t.Dict[str, pa.Array], int]:
+        '''Resolves a global row index into its record batch's columns and the row within it, with a binary search.'''
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < self.batch_offsets[-1]:
+            raise IndexError(f"Row {idx} is out of range for {self.filepath}.")
+        batch_idx = bisect.bisect_right(self._batch_starts, idx) - 1
+        return self._get_columns(batch_idx), int(idx) - self._batch_starts[batch_idx]
+
+    def _get_packed_item(self, row_indices: t.List[int]) -> dict:
+        rows = [self._locate_row(idx) for idx in row_indices]
+        input_ids = [_as_numpy(columns["input_ids"][row]) for columns, row in rows]
+        seq_lens = np.array([len(x) for x in input_ids])
+        if self.compact:
+            return dict(
+                input_ids=np.concatenate(input_ids),
+                seq_lens=seq_lens,
+                prompt_lengths=np.array([columns["prompt_length"][row].as_py() for columns, row in rows]),
+            )
+
+        labels = [_as_numpy(columns["labels"][row]) for columns, row in rows]
+        return dict(
+            input_ids=np.concatenate(input_ids),
+            labels=_concatenate_labels(labels, seq_lens),
+            seq_lens=seq_lens,
+        )
+
+class ShardedArrowDataset(Dataset):
+    '''
+    Several Arrow files (shards) in the same layout, read as one dataset.
+
+    Shards are given either as a directory, in which case every `*.arrow` file
+    in it is used, or as a JSON manifest like:
+
+        {"shards": [
+            "part-00000.arrow",
+            {"path": "part-00001.arrow", "weight": 2.0, "num_rows": 123456}
+        ]}
+
+    Relative paths are resolved against the manifest's directory. A shard's
+    `weight` scales how many of its rows show up per epoch: whole multiples
+    repeat the shard, and fractions take evenly spaced rows from it. Giving
+    `num_rows` (or having an index file next to the shard) spares opening the
+    shard just to count its rows.
+
+    Shards are only opened once they're read from (or right away, when
+    packing, which needs their row lengths), and at most `max_open_shards` of
+    them are kept open at a time per process. Items are located with a binary
+    search over where each shard starts.
+    '''
+    def __init__(
+        self,
+        path: str,
+        sft: bool = True,
+        pack_to_length: t.Optional[int] = None,
+        max_open_shards: int = 64,
+    ) -> None:
+        self.path = path
+        self.sft = sft
+        self.pack_to_length = pack_to_length
+        self.max_open_shards = max_open_shards
+        self._open_shards: t.OrderedDict[int, MmappedArrowDataset] = collections.OrderedDict()
+
+        self.shard_paths, self.weights, num_rows = _read_shard_list(path)
+        assert len(self.shard_paths) > 0, f"No shards found in {path}."
+        self._shards: t.List[t.Optional[MmappedArrowDataset]] = [None] * len(self.shard_paths)
+
+        # Number of rows of every shard (or of packed rows, when packing).
+        self.shard_num_rows = np.empty(len(self.shard_paths), dtype=np.int64)
+        for shard_idx, shard_num_rows in enumerate(num_rows):
+            if pack_to_length is not None:
+                shard_num_rows = len(self._get_shard(shard_idx))
+            elif shard_num_rows is None:
+                index = load_dataset_index(self.shard_paths[shard_idx])
+                if index is not None:
+                    shard_num_rows = len(index.lengths)
+                else:
+                    shard_num_rows = count_rows(self.shard_paths[shard_idx], sft=sft)
+            self.shard_num_rows[shard_idx] = shard_num_rows
+
+        # How many items each shard contributes after weighting, and where they
+        # start in the global index.
+        self.shard_num_items = np.round(self.shard_num_rows * self.weights).astype(np.int64)
+        self.shard_offsets = np.concatenate([[0], np.cumsum(self.shard_num_items)])
+        self._shard_starts: t.List[int] = self.shard_offsets[:-1].tolist()
+
+    def __len__(self) -> int:
+        return int(self.shard_offsets[-1])
+
+    def __getitem__(self, idx) -> dict:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Item {idx} is out of range for {self.path}.")
+        # Shards which end up with no items share their start with the next
+        # shard, and bisecting to the right skips over them.
+        shard_idx = bisect.bisect_right(self._shard_starts, idx) - 1
+        position = int(idx) - self._shard_starts[shard_idx]
+        row = int(_weighted_rows(position, int(self.shard_num_rows[shard_idx]), int(self.shard_num_items[shard_idx])))
+        return self._get_shard(shard_idx)[row]
+
+    @property
+    def packed(self) -> bool:
+        return self._get_shard(0).packed
+
+    def check_tokenizer(self, tokenizer: PreTrainedTokenizer) -> None:
+        '''Checks every shard's index against `tokenizer`, without opening the shards themselves.'''
+        for shard_path in self.shard_paths:
+            index = load_dataset_index(shard_path)
+            if index is not None:
+                index.check_tokenizer(tokenizer)
+
+    def row_lengths(self) -> np.ndarray:
+        '''Token count of every (unpacked) row of every shard, weighted the same way as the items.'''
+        return self._concatenate_per_shard(lambda shard: shard.row_lengths(), self._unpacked_row_counts())
+
+    def item_lengths(self) -> np.ndarray:
+        '''Token count of every item returned by `__getitem__`.'''
+        return self._concatenate_per_shard(lambda shard: shard.item_lengths(), self.shard_num_rows)
+
+    def _unpacked_row_counts(self) -> np.ndarray:
+        if self.pack_to_length is None:
+            return self.shard_num_rows
+        return np.array([len(self._get_shard(idx).row_lengths()) for idx in range(len(self.shard_paths))])
+
+    def _concatenate_per_shard(self, fn: t.Callable[[MmappedArrowDataset], np.ndarray],
+                               num_rows: np.ndarray) -> np.ndarray:
+        per_shard = []
+        for shard_idx in range(len(self.shard_paths)):
+            num_items = int(np.round(num_rows[shard_idx] * self.weights[shard_idx]))
+            if num_items == 0:
+                continue
+            rows = _weighted_rows(np.arange(num_items), int(num_rows[shard_idx]), num_items)
+            per_shard.append(fn(self._get_shard(shard_idx))[rows])
+        return np.concatenate(per_shard) if per_shard else np.empty(0, dtype=np.int64)
+
+    def _get_shard(self, shard_idx: int) -> MmappedArrowDataset:
+        '''Returns a shard, opening it if needed and closing the least recently used one if too many are open.'''
+        shard = self._shards[shard_idx]
+        if shard is None:
+            shard = MmappedArrowDataset(self.shard_paths[shard_idx], sft=self.sft, pack_to_length=self.pack_to_length)
+            self._shards[shard_idx] = shard
+
+        self._open_shards[shard_idx] = shard
+        self._open_shards.move_to_end(shard_idx)
+        while len(self._open_shards) > self.max_open_shards:
+            _, least_recently_used = self._open_shards.popitem(last=False)
+            least_recently_used.close()
+        return shard
+
+
+class DatasetIndex:
+    '''
+    Sidecar index of an Arrow file (`<file>.idx`), written at tokenization
+    time: the length of every row, how many of its tokens are prompt tokens,
+    and some totals and a length histogram in `metadata`. The arrays are
+    memory-mapped, so loading it is quick even for huge datasets.
+
+    MAINTENANCE: Written by ``./preparation/dataset_index.py``. Make sure
+    to keep both sides in sync.
+    '''
+    def __init__(self, index_path: str) -> None:
+        self.index_path = index_path
+        with pa.memory_map(index_path, "r") as source:
+            table = pa.ipc.RecordBatchFileReader(source).read_all()
+        self.metadata: t.Dict[str, t.Any] = json.loads(table.schema.metadata[b"dataset_index"])
+        self.lengths = _as_numpy(table.column("length").combine_chunks())
+        self.prompt_tokens = _as_numpy(table.column("prompt_tokens").combine_chunks())
+
+    def check_tokenizer(self, tokenizer: PreTrainedTokenizer) -> None:
+        if vocab_fingerprint(tokenizer) != self.metadata["tokenizer_fingerprint"]:
+            raise ValueError(
+                f"{self.index_path} says its dataset was tokenized with a different tokenizer "
+                f"(vocabulary of {self.metadata['vocab_size']:,} tokens) than the one used for "
+                f"training ({len(tokenizer):,} tokens). Check --add_special_tokens and the model path.")
+
+
+def load_dataset_index(arrow_file: str) -> t.Optional[DatasetIndex]:
+    '''Loads the index of an Arrow file, unless it doesn't have one or the file changed since it was written.'''
+    index_path = f"{arrow_file}.idx"
+    if not os.path.isfile(index_path):
+        return None
+    index = DatasetIndex(index_path)
+    if index.metadata["arrow_file_size"] != os.path.getsize(arrow_file):
+        return None
+    return index
+
+
+def vocab_fingerprint(tokenizer: PreTrainedTokenizer) -> str:
+    '''
+    Hash of a tokenizer's vocabulary (added tokens included) and special
+    tokens, to check against the one a dataset's index was written with.
+
+    MAINTENANCE: This is copy-pasted from ``./preparation/dataset_index.py``
+    (not to be confused with the shard cache's `tokenizer_fingerprint`
+    there, which hashes more). Keep both implementations in sync.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_arrow_dataset(
+    path: str,
+    sft: bool = True,
+    pack_to_length: t.Optional[int] = None,
+) -> t.Union[MmappedArrowDataset, ShardedArrowDataset]:
+    '''Loads a single Arrow file, or a directory/JSON manifest of Arrow shards.'''
+    if os.path.isdir(path) or path.endswith(".json"):
+        return ShardedArrowDataset(path, sft=sft, pack_to_length=pack_to_length)
+    return MmappedArrowDataset(path, sft=sft, pack_to_length=pack_to_length)
+
+
+def count_rows(filepath: str, sft: bool = True) -> int:
+    '''Number of items in an Arrow file, without keeping it open.'''
+    with pa.memory_map(filepath, "r") as source:
+        reader = pa.ipc.RecordBatchFileReader(source)
+        if not sft and not pa.types.is_fixed_size_list(reader.schema.field("input_ids").type):
+            # Original UFT layout: one chunk per record batch.
+            return reader.num_record_batches
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+def _read_shard_list(path: str) -> t.Tuple[t.List[str], np.ndarray, t.List[t.Optional[int]]]:
+    '''Returns the paths, weights and (if known) row counts of the shards in a directory or manifest.'''
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".arrow"))
+        return paths, np.ones(len(paths)), [None] * len(paths)
+
+    with open(path, "r") as file:
+        manifest = json.load(file)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    paths, weights, num_rows = [], [], []
+    for entry in manifest["shards"]:
+        if isinstance(entry, str):
+            entry = dict(path=entry)
+        assert entry.get("weight", 1.0) >= 0, f"Shard {entry['path']} has a negative weight."
+        paths.append(os.path.join(base_dir, entry["path"]))
+        weights.append(entry.get("weight", 1.0))
+        num_rows.append(entry.get("num_rows"))
+    return paths, np.array(weights, dtype=np.float64), num_rows
+
+
+def _weighted_rows(positions, num_rows: int, num_items: int):
+    '''
+    Maps positions within a shard's `num_items` weighted items to its rows: the
+    first whole multiples of `num_rows` cycle through all rows, and the rest
+    are spread evenly over the shard.
+    '''
+    repeated = num_items // num_rows * num_rows
+    remainder = max(num_items - repeated, 1)
+    return np.where(positions < repeated, positions % num_rows, (positions - repeated) * num_rows // remainder)
+
+
 class DataCollatorForMmapedDataset():
-    def __init__(self, tokenizer: PreTrainedTokenizer, sft: bool = True) -> None:
+    '''
+    Pads a batch of rows into `input_ids`/`labels` tensors. With `unpadded`,
+    the rows are concatenated into a single row instead (see
+    `_collate_unpadded`).
+    '''
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        sft: bool = True,
+        zero_copy: bool = True,
+        unpadded: bool = False,
+    ) -> None:
         self.tokenizer = tokenizer
         self.sft = sft
+        self.zero_copy = zero_copy
+        self.unpadded = unpadded
         self.pad_token_id: int = self.tokenizer.pad_token_id \
             if self.tokenizer.pad_token_id else self.tokenizer.eos_token_id # type: ignore
 
     def __call__(self, instances) -> dict:
+        if self.unpadded:
+            return self._collate_unpadded(instances)
+
+        # Only rows in the original layouts can go through the list-based path.
+        if self.zero_copy or _needs_zero_copy_path(instances[0]):
+            return self._collate_zero_copy(instances)
+
         if self.sft:
             input_ids = [
                 torch.tensor(instance["input_ids"].as_py())
@@ -89,6 +533,82 @@ class DataCollatorForMmapedDataset():
             # attention_mask=labels.ne(IGNORE_INDEX),
         )
     
+    def _collate_zero_copy(self, instances) -> dict:
+        '''
+        Same output as the list-based path above, but never goes through Python
+        ints: each row is viewed as a NumPy array straight on top of the Arrow
+        buffers and copied into a single preallocated, already padded array.
+        '''
+        rows = [_as_numpy(instance["input_ids"]) for instance in instances]
+        padded_length = _round_up_to_multiple_of_8(max(len(x) for x in rows))
+        padded_input_ids = _pad_into_array(rows, padded_length, self.pad_token_id)
+        input_ids = torch.from_numpy(padded_input_ids)
+
+        if self.sft:
+            # Compact SFT rows don't store labels, so those get rebuilt from the prompt lengths.
+            if "labels" in instances[0]:
+                labels = _pad_into_array([_as_numpy(instance["labels"]) for instance in instances],
+                                         padded_length, IGNORE_INDEX)
+            elif "prompt_length" in instances[0]:
+                labels = _rebuild_labels(padded_input_ids,
+                                         np.array([len(row) for row in rows]),
+                                         np.array([instance["prompt_length"].as_py() for instance in instances]))
+            else:
+                labels = _pad_into_array([_rebuild_packed_labels(row, instance) for row, instance in zip(rows, instances)],
+                                         padded_length, IGNORE_INDEX)
+            labels = torch.from_numpy(labels)
+        else:
+            # In UFT, labels are the same as the input_ids
+            labels = input_ids
+
+        batch = dict(
+            input_ids=input_ids,
+            labels=labels,
+        )
+        if "seq_lens" in instances[0]:
+            seq_lens = [_as_numpy(instance["seq_lens"]) for instance in instances]
+            batch.update(_build_packing_metadata(seq_lens, padded_length))
+        return batch
+
+    def _collate_unpadded(self, instances) -> dict:
+        '''
+        Concatenates all of the batch's rows into a single row (of shape
+        `[1, total tokens]`, rounded up to a multiple of 8) instead of padding
+        every one of them to the longest, along with the same `seq_lens` and
+        `position_ids` as for packed rows. The patched attention then keeps
+        examples from attending to each other, so the amount of attention
+        compute only depends on the real tokens.
+        '''
+        rows = [_as_numpy(instance["input_ids"]) for instance in instances]
+        labels = []
+        for row, instance in zip(rows, instances):
+            if not self.sft:
+                row_labels = row.astype(np.int64)
+            elif "labels" in instance:
+                row_labels = _as_numpy(instance["labels"]).astype(np.int64)
+            elif "prompt_length" in instance:
+                row_labels = _rebuild_labels(row[None].astype(np.int64), np.array([len(row)]),
+                                             np.array([instance["prompt_length"].as_py()]))[0]
+            else:
+                row_labels = _rebuild_packed_labels(row, instance)
+            labels.append(row_labels)
+
+        # Packed rows already hold several examples each.
+        seq_lens = np.concatenate([
+            _as_numpy(instance["seq_lens"]) if "seq_lens" in instance else np.array([len(row)])
+            for row, instance in zip(rows, instances)
+        ])
+        padded_length = _round_up_to_multiple_of_8(sum(len(row) for row in rows))
+        input_ids = _pad_into_array([np.concatenate(rows)], padded_length, self.pad_token_id)
+        labels = _pad_into_array([_concatenate_labels(labels, np.array([len(row) for row in rows]))],
+                                 padded_length, IGNORE_INDEX)
+
+        return dict(
+            input_ids=torch.from_numpy(input_ids),
+            labels=torch.from_numpy(labels),
+            **_build_packing_metadata([seq_lens], padded_length),
+        )
+
     def _create_fake_padding_tensor(self, sequences: torch.Tensor) -> torch.Tensor:
         '''Makes a fake 'padding tensor' that has a length of a multiple of 8 to a sequence of tensors.'''
         # https://stackoverflow.com/questions/72540912/find-the-biggest-of-two-pytorch-tensor-on-size
@@ -104,3 +624,133 @@ class DataCollatorForMmapedDataset():
 
         fake_tensor = torch.ones((next_multiple), dtype=sequences[0].dtype)
         return fake_tensor
+
+
+def _needs_zero_copy_path(instance: dict) -> bool:
+    '''Whether a row is packed, already a NumPy array or in the compact SFT layout.'''
+    return "seq_lens" in instance \
+        or "prompt_length" in instance \
+        or isinstance(instance["input_ids"], np.ndarray)
+
+
+def _rebuild_labels(padded_input_ids: np.ndarray, lengths: np.ndarray, prompt_lengths: np.ndarray) -> np.ndarray:
+    '''
+    Rebuilds the labels of a batch of rows in the compact SFT layout:
+    IGNORE_INDEX for the prompt tokens and the padding, and a copy of the
+    response tokens in between.
+
+    MAINTENANCE: Needs to be kept in sync with how prompt lengths are
+    worked out in ``./preparation/arrow_formats.py``.
+    '''
+    labels = padded_input_ids.copy()
+    for idx, (length, prompt_length) in enumerate(zip(lengths.tolist(), prompt_lengths.tolist())):
+        labels[idx, :prompt_length] = IGNORE_INDEX
+        labels[idx, length:] = IGNORE_INDEX
+    return labels
+
+
+def _rebuild_packed_labels(input_ids: np.ndarray, instance: dict) -> np.ndarray:
+    '''
+    Same as `_rebuild_labels`, but for a single packed row. The first token of
+    every example in it is never trained on (see `_concatenate_labels`).
+    '''
+    labels = input_ids.astype(np.int64)
+    seq_lens = _as_numpy(instance["seq_lens"])
+    prompt_lengths = np.maximum(_as_numpy(instance["prompt_lengths"]), 1)
+    starts = np.cumsum(seq_lens) - seq_lens
+    positions = np.arange(len(labels)) - np.repeat(starts, seq_lens)
+    labels[positions < np.repeat(prompt_lengths, seq_lens)] = IGNORE_INDEX
+    return labels
+
+
+def _as_numpy(value) -> np.ndarray:
+    '''
+    Returns a read-only NumPy view over a single row without copying it.
+
+    Handles `ListScalar`s (SFT rows, which wrap a slice of the column's values
+    buffer), plain Arrow arrays (UFT chunks) and NumPy arrays (fixed-width UFT
+    rows).
+    '''
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, pa.ListScalar):
+        value = value.values
+    return value.to_numpy(zero_copy_only=True)
+
+
+def _round_up_to_multiple_of_8(length: int) -> int:
+    # NOTE(TG): Tensor cores are most efficient when dealing with tensor lengths that are multiples of 8.
+    return (length + 7) // 8 * 8
+
+
+def _pad_into_array(rows: t.List[np.ndarray], length: int, padding_value: int) -> np.ndarray:
+    '''Copies `rows` into a single right-padded int64 array of shape [len(rows), length].'''
+    out = np.full((len(rows), length), padding_value, dtype=np.int64)
+    for idx, row in enumerate(rows):
+        out[idx, :len(row)] = row
+    return out
+
+
+def pack_sequences(lengths: np.ndarray, max_length: int) -> t.List[t.List[int]]:
+    '''
+    Bin-packs rows into bins of at most `max_length` tokens (best-fit
+    decreasing) and returns the row indices that go into each bin. Rows longer
+    than `max_length` get a bin to themselves.
+
+    MAINTENANCE: This is copy-pasted into
+    ``./preparation/tokenize_data_sft.py``. Keep both implementations in sync.
+    '''
+    bins: t.List[t.List[int]] = []
+    # bins_by_free_space[n] holds the bins which have exactly `n` tokens left.
+    bins_by_free_space: t.List[t.List[int]] = [[] for _ in range(max_length + 1)]
+
+    for row_idx in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[row_idx])
+        bin_idx, free_space = None, max_length - length
+        for space in range(length, max_length + 1):
+            if bins_by_free_space[space]:
+                bin_idx, free_space = bins_by_free_space[space].pop(), space - length
+                break
+        if bin_idx is None:
+            bin_idx = len(bins)
+            bins.append([])
+
+        bins[bin_idx].append(int(row_idx))
+        if free_space > 0:
+            bins_by_free_space[free_space].append(bin_idx)
+
+    return bins
+
+
+def _concatenate_labels(labels: t.List[np.ndarray], seq_lens: np.ndarray) -> np.ndarray:
+    '''
+    Concatenates the labels of packed examples. The first token of each example
+    is never trained on, so the last token of the previous example in the row
+    doesn't learn to predict it.
+    '''
+    packed_labels = np.concatenate(labels)
+    packed_labels[np.cumsum(seq_lens) - seq_lens] = IGNORE_INDEX
+    return packed_labels
+
+
+def _build_packing_metadata(seq_lens: t.List[np.ndarray], padded_length: int) -> dict:
+    '''
+    Builds position IDs which restart at every packed example, and the
+    flattened per-example lengths for the whole batch which the xFormers
+    monkeypatches use to build a block-diagonal causal mask. Row padding is
+    treated as an example of its own.
+    '''
+    position_ids = np.empty((len(seq_lens), padded_length), dtype=np.int64)
+    flat_seq_lens: t.List[int] = []
+    for idx, row_seq_lens in enumerate(seq_lens):
+        num_padding = padded_length - int(row_seq_lens.sum())
+        if num_padding > 0:
+            row_seq_lens = np.append(row_seq_lens, num_padding)
+        starts = np.cumsum(row_seq_lens) - row_seq_lens
+        position_ids[idx] = np.arange(padded_length) - np.repeat(starts, row_seq_lens)
+        flat_seq_lens.extend(row_seq_lens.tolist())
+
+    return dict(
+        position_ids=torch.from_numpy(position_ids),
+        seq_lens=flat_seq_lens,
+    )
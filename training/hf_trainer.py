@@ -10,8 +10,11 @@ import transformers
 import wandb
 from accelerate import Accelerator
 from peft import PeftModel
-from dataset import DataCollatorForMmapedDataset, MmappedArrowDataset
+from dataset import DataCollatorForMmapedDataset, load_arrow_dataset
 from profiling import ProfilerCallback, build_profiler_configuration
+from sampler import (DataLoaderStateCallback, LengthGroupedBatchSampler, ResumableBatchSampler, ResumableDataLoader,
+                     ShuffledBatchSampler, load_dataloader_state, patch_skip_first_batches)
+from streaming_dataset import StreamingArrowDataset, StreamingDataLoader
 
 import logging
 from transformers import logging as hf_logging
@@ -59,13 +62,43 @@ class ModelArguments:
         default=True)
     model_name_or_path: t.Optional[str] = field(
         default="EleutherAI/pythia-70m-deduped")
-    use_xformers: bool = field(default=False, metadata={"help": "Use xFormers' memory_efficient_attention"})
+    attention_backend: str = field(
+        default="eager",
+        metadata={"help": "Attention implementation: eager (HF's own), sdpa (PyTorch's scaled_dot_product_attention), "
+                          "xformers (xFormers' memory_efficient_attention) or chunked (pure PyTorch, low memory, "
+                          "for CPUs). Anything but eager is only supported for LLaMA, GPT-J and NeoX models.",
+                  "choices": ["eager", "sdpa", "xformers", "chunked"]})
+    use_xformers: bool = field(default=False, metadata={"help": "Same as --attention_backend xformers."})
 
 
 @dataclass
 class DataArguments:
-    train_file: str = field(metadata={"help": "Path to the training set."})
-    eval_file: str = field(metadata={"help": "Path to the evaluation set."})
+    train_file: str = field(metadata={"help": "Path to the training set: an Arrow file, or a directory or JSON manifest of Arrow shards."})
+    eval_file: str = field(metadata={"help": "Path to the evaluation set: an Arrow file, or a directory or JSON manifest of Arrow shards."})
+    zero_copy_collation: bool = field(
+        metadata={"help": "Collate batches from NumPy views over the Arrow buffers instead of Python lists."},
+        default=True)
+    pack_to_length: t.Optional[int] = field(
+        metadata={"help": "Bin-pack SFT examples into rows of at most this many tokens. Requires an --attention_backend other than eager."},
+        default=None)
+    unpadded: bool = field(
+        metadata={"help": "Concatenate each batch's examples into a single row instead of padding them, so attention "
+                          "only costs as much as the real tokens. Requires an --attention_backend other than eager."},
+        default=False)
+    max_tokens_per_batch: t.Optional[int] = field(
+        metadata={"help": "Build length-grouped training batches of up to this many (padded) tokens instead of a fixed batch size. "
+                          "Examples are sorted by length over the whole dataset, so every epoch has the same amount of batches."},
+        default=None)
+    streaming: bool = field(
+        metadata={"help": "Read the training set sequentially in shuffled blocks instead of one random row at a time. "
+                          "For datasets which don't fit into the page cache."},
+        default=False)
+    streaming_block_size: int = field(
+        metadata={"help": "When --streaming, how many consecutive rows make up a block."},
+        default=1024)
+    shuffle_buffer_size: int = field(
+        metadata={"help": "When --streaming, how many rows are read in before shuffling them."},
+        default=16384)
 
 
 @dataclass
@@ -140,10 +173,15 @@ def main() -> None:
         use_fast=True,
     )
 
-    # xFormers optimizations.
+    # Attention backend (xFormers etc.).
     if model_args.use_xformers:
-        from monkeypatches import apply_xformers_monkeypatches
-        apply_xformers_monkeypatches()
+        assert model_args.attention_backend in ("eager", "xformers"), \
+            "--use_xformers conflicts with --attention_backend."
+        model_args.attention_backend = "xformers"
+    if model_args.attention_backend != "eager":
+        from monkeypatches import apply_attention_backend
+        model_type = transformers.AutoConfig.from_pretrained(model_args.model_name_or_path).model_type
+        apply_attention_backend(model_args.attention_backend, model_type)
 
     if other_args.model_load_delay_per_rank is not None:
         # When working with constrained system memory, loading the model at the
@@ -171,7 +209,7 @@ def main() -> None:
 
     if other_args.add_special_tokens is not None:
         # MAINTENANCE(11b): Big fat warning: the snippet below is copy-pasted
-        # into ``./preparation/tokenize_data_{sft,uft}.py``. Make sure to always keep both
+        # into ``./preparation/parallel_tokenization.py``. Make sure to always keep both
         # implementations in sync.
         special_token_contents = other_args.add_special_tokens.split(",")
         special_tokens = [
@@ -220,24 +258,91 @@ def main() -> None:
     # Dataset setup.
     logger.info('*** Load Training data ***')
     logger.info(f'Train file: {data_args.train_file}')
-    train_dataset = MmappedArrowDataset(data_args.train_file, sft=not other_args.uft)
+    if data_args.streaming:
+        assert data_args.pack_to_length is None and data_args.max_tokens_per_batch is None \
+            and not training_args.group_by_length, \
+            "--streaming can't be combined with packing or length grouping."
+        train_dataset = StreamingArrowDataset(
+            data_args.train_file,
+            sft=not other_args.uft,
+            batch_size=training_args.per_device_train_batch_size,
+            num_workers=training_args.dataloader_num_workers,
+            block_size=data_args.streaming_block_size,
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+            seed=training_args.data_seed if training_args.data_seed is not None else training_args.seed,
+            num_replicas=training_args.world_size,
+            rank=training_args.process_index,
+        )
+    else:
+        train_dataset = load_arrow_dataset(data_args.train_file, sft=not other_args.uft,
+                                           pack_to_length=data_args.pack_to_length)
     logger.info(f'Train size: {len(train_dataset)} data item')
     
     logger.info('*** Load Eval data ***')
     logger.info(f'Eval file: {data_args.eval_file}')
-    eval_dataset = MmappedArrowDataset(data_args.eval_file, sft=not other_args.uft)
+    eval_dataset = load_arrow_dataset(data_args.eval_file, sft=not other_args.uft,
+                                      pack_to_length=data_args.pack_to_length)
     logger.info(f'Eval size: {len(eval_dataset)} data item')
 
-    data_collator = DataCollatorForMmapedDataset(tokenizer=tokenizer, sft=not other_args.uft)
+    for dataset in (train_dataset, eval_dataset):
+        dataset.check_tokenizer(tokenizer)
+    index = getattr(train_dataset, "index", None)
+    if index is not None:
+        logger.info(f'Train tokens: {index.metadata["num_tokens"]:,} '
+                    f'({index.metadata["num_prompt_tokens"]:,} prompt, '
+                    f'{index.metadata["num_response_tokens"]:,} response), '
+                    f'longest row: {index.metadata["max_length"]:,}')
+
+    if train_dataset.packed or eval_dataset.packed or data_args.unpadded:
+        # Without the patched attention, packed (or concatenated) examples
+        # would attend to each other.
+        assert model_args.attention_backend != "eager", \
+            "Packed datasets and --unpadded require an --attention_backend other than eager."
+        from monkeypatches.varlen import register_seq_lens_hook
+        register_seq_lens_hook(model)
+
+    data_collator = DataCollatorForMmapedDataset(tokenizer=tokenizer,
+                                                 sft=not other_args.uft,
+                                                 zero_copy=data_args.zero_copy_collation,
+                                                 unpadded=data_args.unpadded)
+
+    train_batch_sampler = None
+    if training_args.group_by_length or data_args.max_tokens_per_batch is not None:
+        logger.info('Grouping training batches by length')
+        train_batch_sampler = LengthGroupedBatchSampler(
+            train_dataset.item_lengths(),
+            batch_size=training_args.per_device_train_batch_size,
+            max_tokens=data_args.max_tokens_per_batch,
+            drop_last=training_args.dataloader_drop_last,
+            seed=training_args.data_seed if training_args.data_seed is not None else training_args.seed,
+            num_replicas=training_args.world_size,
+            rank=training_args.process_index,
+        )
+        logger.info(f'Padding efficiency (real tokens / padded tokens): {train_batch_sampler.padding_efficiency():.2%}')
+    elif not data_args.streaming:
+        # Same as the HF Trainer's default shuffling, but resumable mid-epoch.
+        train_batch_sampler = ShuffledBatchSampler(
+            len(train_dataset),
+            batch_size=training_args.per_device_train_batch_size,
+            drop_last=training_args.dataloader_drop_last,
+            seed=training_args.data_seed if training_args.data_seed is not None else training_args.seed,
+            num_replicas=training_args.world_size,
+            rank=training_args.process_index,
+        )
+
+    callbacks = [DataLoaderStateCallback]
+    if lora_args.use_lora:
+        callbacks.append(SavePeftModelCallback)
 
-    trainer = transformers.Trainer(
+    trainer = MmappedArrowTrainer(
         model=model,
         tokenizer=tokenizer,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         data_collator=data_collator,
         args=training_args,
-        callbacks=[SavePeftModelCallback] if lora_args.use_lora else None,
+        callbacks=callbacks,
+        train_batch_sampler=train_batch_sampler,
     )
 
     try:
@@ -247,6 +352,20 @@ def main() -> None:
             list(pathlib.Path(
                 training_args.output_dir).glob("checkpoint-*"))) > 0
 
+        if resume_from_checkpoint:
+            # The HF Trainer still works out where it stopped, but the training
+            # dataloader jumps straight there instead of going through (and
+            # collating) every batch up to it (see `patch_skip_first_batches`).
+            # That only lands in the right place with the same batches as before,
+            # which `load_state_dict` checks.
+            checkpoint_dir = transformers.trainer_utils.get_last_checkpoint(training_args.output_dir)
+            dataloader_state = load_dataloader_state(checkpoint_dir)
+            if dataloader_state is not None:
+                logger.info(f'Resuming at epoch {dataloader_state["epoch"]}, '
+                            f'after {dataloader_state["batches_consumed"]} batches')
+                resumable = train_dataset if data_args.streaming else train_batch_sampler
+                resumable.load_state_dict(dataloader_state)
+
         if other_args.enable_profiler:
             profiler_args = build_profiler_configuration()
             with torch.profiler.profile(**profiler_args) as profiler:
@@ -298,6 +417,42 @@ def main() -> None:
         logger.info(f'Model saved to "{training_args.output_dir}/merged". Please use this directory to access the trained model.')
 
 
+class MmappedArrowTrainer(transformers.Trainer):
+    '''
+    HF Trainer which can take a custom batch sampler for the training set, or a
+    `StreamingArrowDataset` as the training set. Either way, the training
+    dataloader can resume mid-epoch without replaying it.
+
+    Both are expected to already be sharded across ranks, so the dataloader is
+    not handed to Accelerate (which would shard it once more).
+    '''
+
+    def __init__(self, *args, train_batch_sampler: t.Optional[ResumableBatchSampler] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        patch_skip_first_batches()
+
+    def get_train_dataloader(self) -> torch.utils.data.DataLoader:
+        if isinstance(self.train_dataset, StreamingArrowDataset):
+            # Also already sharded across ranks.
+            return StreamingDataLoader(
+                self.train_dataset,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+
+        return ResumableDataLoader(
+            self.train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+
 class SavePeftModelCallback(transformers.TrainerCallback):
     '''
     At some point, PEFT stopped saving just the adapter and instead started
@@ -1,17 +1,82 @@
+import functools
+import typing as t
+
 import transformers
+from packaging.specifiers import SpecifierSet
+from transformers import logging as hf_logging
+
+from monkeypatches import backends
+from monkeypatches.backends import ATTENTION_BACKENDS, set_attention_backend
 from monkeypatches.xformers_gpt import (gpt2_wrapped_scaled_dot_product,
                                         gpt_merge_heads)
 from monkeypatches.xformers_llama import llama_attention_forward
 
+logger = hf_logging.get_logger()
 
-def apply_xformers_monkeypatches() -> None:
-    # LLaMA
+# "eager" leaves HF's own attention implementations alone.
+ATTENTION_BACKEND_NAMES = ("eager", *ATTENTION_BACKENDS)
+
+# The transformers versions whose attention modules the patches below are
+# written against. From 4.36 on, LLaMA passes its KV cache around as `Cache`
+# objects instead of tuples of tensors. Keep in sync with requirements.txt.
+SUPPORTED_TRANSFORMERS_VERSIONS = ">=4.31,<4.36"
+
+
+def _patch_llama() -> None:
     transformers.models.llama.modeling_llama.LlamaAttention.forward = llama_attention_forward
 
-    # GPT-J
+
+def _patch_gptj() -> None:
     transformers.models.gptj.modeling_gptj.GPTJAttention._attn = gpt2_wrapped_scaled_dot_product
     transformers.models.gptj.modeling_gptj.GPTJAttention._merge_heads = gpt_merge_heads
 
-    # NeoX
+
+def _patch_gpt_neox() -> None:
     transformers.models.gpt_neox.modeling_gpt_neox.GPTNeoXAttention._attn = gpt2_wrapped_scaled_dot_product
     transformers.models.gpt_neox.modeling_gpt_neox.GPTNeoXAttention._merge_heads = gpt_merge_heads
+
+
+# Per model family (as in `config.model_type`), what routes its attention
+# through the selected backend.
+MODEL_ADAPTERS: t.Dict[str, t.Callable[[], None]] = {
+    "llama": _patch_llama,
+    "gptj": _patch_gptj,
+    "gpt_neox": _patch_gpt_neox,
+}
+
+
+def apply_attention_backend(backend: str, model_type: t.Optional[str] = None) -> None:
+    '''
+    Patches the attention of every supported model family, or only the one
+    of `model_type`, to go through `backend` (see ./backends.py).
+    '''
+    if backend == "eager":
+        return
+    if model_type is not None and model_type not in MODEL_ADAPTERS:
+        raise ValueError(f"No attention backends for {model_type!r} models, only for {', '.join(MODEL_ADAPTERS)}.")
+
+    check_transformers_version()
+    set_attention_backend(backend)
+    if backend == "xformers" and backends.memory_efficient_attention is None:
+        _warn_xformers_unavailable()
+    for family, patch in MODEL_ADAPTERS.items():
+        if model_type is None or model_type == family:
+            patch()
+
+
+def check_transformers_version() -> None:
+    '''Raises if the installed transformers isn't one the patches work with.'''
+    if not SpecifierSet(SUPPORTED_TRANSFORMERS_VERSIONS).contains(transformers.__version__):
+        raise RuntimeError(f"The attention patches need transformers{SUPPORTED_TRANSFORMERS_VERSIONS}, "
+                           f"but {transformers.__version__} is installed. Use `--attention_backend eager`, "
+                           "or install a supported version (see requirements.txt).")
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_xformers_unavailable() -> None:
+    logger.warning("xFormers can't be imported, so the xformers attention backend falls back to PyTorch's SDPA "
+                   "(and to the reference implementation in ./varlen.py for packed and unpadded batches).")
+
+
+def apply_xformers_monkeypatches() -> None:
+    apply_attention_backend("xformers")
@@ -0,0 +1,243 @@
+import math
+import typing as t
+from dataclasses import dataclass
+
+import torch
+
+try:
+    from xformers.ops import LowerTriangularMask, memory_efficient_attention
+except ImportError:
+    # The xFormers backend falls back to PyTorch's SDPA (or, for unpadded
+    # and packed batches, to the reference implementation in ./varlen.py),
+    # e.g. to test things on CPU.
+    LowerTriangularMask = memory_efficient_attention = None
+try:
+    from xformers.ops.fmha.attn_bias import LowerTriangularFromBottomRightMask
+except ImportError:
+    # Older xFormers. Only needed for several new tokens on top of a cache.
+    LowerTriangularFromBottomRightMask = None
+
+from monkeypatches.gqa import group_heads_for_xformers, grouped_scaled_dot_product_attention
+from monkeypatches.varlen import get_block_diagonal_causal_mask, reference_varlen_attention
+
+# Queries and keys per block of the chunked backend.
+ATTENTION_CHUNK_SIZE = 128
+
+
+@dataclass(frozen=True)
+class AttentionBackend:
+    '''
+    Attention kernels the model family adapters (./xformers_llama.py,
+    ./xformers_gpt.py) go through. All of them take `[bsz, len, num heads,
+    head dim]` queries and keys/values, which may have fewer heads than the
+    queries (GQA/MQA), and return the output in the queries' layout.
+
+    - `attention(query, key, value, attn_bias=None)`: causal attention, where
+      the queries are the last positions of the keys. `attn_bias`, if given,
+      is an additive `[bsz, 1, query length, key length]` bias which already
+      includes the causal mask (e.g. for batches with padding).
+    - `varlen_attention(query, key, value, seq_lens)`: causal attention over
+      a batch flattened into a single row (`[1, total tokens, ...]`) of
+      concatenated examples of `seq_lens` tokens, which don't attend to each
+      other.
+    '''
+    attention: t.Callable[..., torch.Tensor]
+    varlen_attention: t.Callable[[torch.Tensor, torch.Tensor, torch.Tensor, t.List[int]], torch.Tensor]
+
+
+def sdpa_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_bias: t.Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    '''
+    PyTorch's `scaled_dot_product_attention`.
+
+    NOTE: HF's attention mask used to be checked to tell the causal case
+    from the decoding one, but reading it forces a device sync in every layer.
+    The shapes tell us just as well: a single query can see every key, and
+    otherwise the mask is causal.
+    '''
+    query_length, key_length = query.shape[1], key.shape[1]
+    attn_mask = attn_bias
+    if attn_mask is None and 1 < query_length < key_length:
+        attn_mask = torch.ones(query_length, key_length, dtype=torch.bool, device=query.device) \
+            .tril(diagonal=key_length - query_length)
+    return grouped_scaled_dot_product_attention(
+        query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2),
+        attn_mask=attn_mask, is_causal=attn_bias is None and 1 < query_length == key_length,
+    ).transpose(1, 2)
+
+
+def xformers_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_bias: t.Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    '''
+    xFormers' `memory_efficient_attention`. Explicit biases, and anything
+    xFormers isn't installed (or recent enough) for, go through SDPA instead.
+    '''
+    query_length, key_length = query.shape[1], key.shape[1]
+    if memory_efficient_attention is None or attn_bias is not None or (
+            query_length not in (1, key_length) and LowerTriangularFromBottomRightMask is None):
+        return sdpa_attention(query, key, value, attn_bias)
+
+    if query_length == 1:
+        xformers_bias = None
+    elif query_length == key_length:
+        xformers_bias = LowerTriangularMask()
+    else:
+        # E.g. a prompt fed in on top of an existing cache.
+        xformers_bias = LowerTriangularFromBottomRightMask()
+    return memory_efficient_attention(*group_heads_for_xformers(query, key, value), attn_bias=xformers_bias) \
+        .reshape(query.shape)
+
+
+def xformers_varlen_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    seq_lens: t.List[int],
+) -> torch.Tensor:
+    '''xFormers' block-diagonal kernel on GPU, `reference_varlen_attention` otherwise.'''
+    if memory_efficient_attention is None or not query.is_cuda:
+        return reference_varlen_attention(query, key, value, seq_lens)
+    attn_bias = get_block_diagonal_causal_mask()
+    return memory_efficient_attention(*group_heads_for_xformers(query, key, value), attn_bias=attn_bias) \
+        .reshape(query.shape)
+
+
+def chunked_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_bias: t.Optional[torch.Tensor] = None,
+    chunk_size: int = ATTENTION_CHUNK_SIZE,
+) -> torch.Tensor:
+    '''
+    Pure PyTorch, flash-style attention for when there's neither a GPU nor
+    a fused kernel: goes through the queries and keys in blocks of
+    `chunk_size` and keeps a running softmax, so only `chunk_size x
+    chunk_size` scores per head exist at any time instead of the full
+    `query length x key length` matrix. Key blocks which are entirely in the
+    future of a query block are skipped.
+    '''
+    bsz, query_length, num_heads, head_dim = query.shape
+    key_length, num_kv_heads = key.shape[1], key.shape[2]
+    groups = num_heads // num_kv_heads
+    # The last query is at position `key_length - 1`, as there may be cached
+    # keys in front of the queries.
+    offset = key_length - query_length
+
+    # Query heads are grouped by the key/value head they share, so keys and
+    # values broadcast over them instead of being repeated.
+    queries = query.transpose(1, 2).reshape(bsz, num_kv_heads, groups, query_length, head_dim).float() \
+        * (1 / math.sqrt(head_dim))
+    keys = key.transpose(1, 2)[:, :, None].float()
+    values = value.transpose(1, 2)[:, :, None].float()
+    output = torch.empty_like(queries)
+
+    for query_start in range(0, query_length, chunk_size):
+        query_end = min(query_start + chunk_size, query_length)
+        query_chunk = queries[..., query_start:query_end, :]
+        key_end = key_length if attn_bias is not None else offset + query_end
+
+        accumulator = torch.zeros_like(query_chunk)
+        row_max = query_chunk.new_full((*query_chunk.shape[:-1], 1), -math.inf)
+        row_sum = torch.zeros_like(row_max)
+        for key_start in range(0, key_end, chunk_size):
+            key_stop = min(key_start + chunk_size, key_end)
+            scores = query_chunk @ keys[..., key_start:key_stop, :].transpose(-1, -2)
+            if attn_bias is not None:
+                scores += attn_bias[:, None, :, query_start:query_end, key_start:key_stop]
+            elif key_stop > offset + query_start + 1:
+                # Block on the diagonal.
+                query_positions = torch.arange(offset + query_start, offset + query_end, device=query.device)
+                key_positions = torch.arange(key_start, key_stop, device=query.device)
+                scores.masked_fill_(key_positions[None, :] > query_positions[:, None], -math.inf)
+
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            probabilities = torch.exp(scores - new_max)
+            correction = torch.exp(row_max - new_max)
+            row_sum = row_sum * correction + probabilities.sum(dim=-1, keepdim=True)
+            accumulator = accumulator * correction + probabilities @ values[..., key_start:key_stop, :]
+            row_max = new_max
+        output[..., query_start:query_end, :] = accumulator / row_sum
+
+    return output.reshape(bsz, num_heads, query_length, head_dim).transpose(1, 2).to(query.dtype)
+
+
+def chunked_varlen_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    seq_lens: t.List[int],
+) -> torch.Tensor:
+    return reference_varlen_attention(query, key, value, seq_lens, attention_fn=chunked_attention)
+
+
+# "eager" isn't in here, since it means leaving HF's own attention alone.
+ATTENTION_BACKENDS: t.Dict[str, AttentionBackend] = {
+    "sdpa": AttentionBackend(attention=sdpa_attention, varlen_attention=reference_varlen_attention),
+    "xformers": AttentionBackend(attention=xformers_attention, varlen_attention=xformers_varlen_attention),
+    "chunked": AttentionBackend(attention=chunked_attention, varlen_attention=chunked_varlen_attention),
+}
+
+_BACKEND: AttentionBackend = ATTENTION_BACKENDS["xformers"]
+
+# `(attention mask, shapes etc., bias)` of the last `get_causal_padding_bias` call.
+_BIAS_CACHE: t.Optional[t.Tuple[t.Optional[torch.Tensor], tuple, torch.Tensor]] = None
+
+
+def set_attention_backend(name: str) -> None:
+    '''Selects the backend all patched attention layers go through from now on.'''
+    global _BACKEND
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {name!r}, expected one of {', '.join(ATTENTION_BACKENDS)}.")
+    _BACKEND = ATTENTION_BACKENDS[name]
+
+
+def get_attention_backend() -> AttentionBackend:
+    return _BACKEND
+
+
+def get_causal_padding_bias(
+    attention_mask: t.Optional[torch.Tensor],
+    query_length: int,
+    key_length: int,
+    dtype: torch.dtype,
+    device: torch.device,
+) -> t.Optional[torch.Tensor]:
+    '''
+    Additive attention bias of shape `[bsz, 1, query_length, key_length]`,
+    which combines the causal mask with HF's (already additive) padding mask.
+
+    HF's mask can also be LLaMA's `[bsz, 1, query_length, key_length]` one,
+    which already is causal. Every layer gets the same `attention_mask`
+    tensor, so the bias is only built by the first one and reused by the
+    rest, instead of every layer building it again.
+    '''
+    global _BIAS_CACHE
+    cache_key = (query_length, key_length, dtype, device)
+    if _BIAS_CACHE is not None and _BIAS_CACHE[0] is attention_mask and _BIAS_CACHE[1] == cache_key:
+        return _BIAS_CACHE[2]
+
+    mask_value = torch.finfo(dtype).min
+    # The last query is at position `key_length - 1`, as there may be cached
+    # keys in front of the queries.
+    causal_mask = torch.ones(query_length, key_length, dtype=torch.bool, device=device) \
+        .tril(diagonal=key_length - query_length)
+    attn_bias = torch.zeros(query_length, key_length, dtype=dtype, device=device) \
+        .masked_fill(~causal_mask, mask_value)[None, None]
+    if attention_mask is not None:
+        # Clamped, since adding up two masked out values overflows to -inf,
+        # which turns fully masked out rows (left padding) into NaNs.
+        attn_bias = (attn_bias + attention_mask.to(dtype)).clamp(min=mask_value)
+
+    # Keeps `attention_mask` alive, so the identity check above can't be
+    # fooled by a new tensor that happens to be at the same address.
+    _BIAS_CACHE = (attention_mask, cache_key, attn_bias)
+    return attn_bias
@@ -0,0 +1,74 @@
+import typing as t
+
+import torch
+
+# PyTorch's SDPA can attend with fewer key/value heads than query heads by
+# itself since 2.5.
+_SDPA_HAS_GQA = tuple(int(x) for x in torch.__version__.split("+")[0].split(".")[:2]) >= (2, 5)
+
+
+def group_heads_for_xformers(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+) -> t.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    '''
+    Turns `[bsz, len, num heads, head dim]` queries and keys/values with fewer
+    heads into xFormers' 5-D `[bsz, len, num kv heads, heads per kv head, head
+    dim]` layout, in which the keys and values are only expanded (stride 0)
+    over the heads sharing them instead of being copied for every one of them.
+
+    Inputs with as many key/value heads as query heads are returned as-is.
+    Either way, the attention output can be reshaped back to
+    `[bsz, len, num heads, head dim]`.
+    '''
+    num_heads, num_kv_heads = query.shape[2], key.shape[2]
+    if num_heads == num_kv_heads:
+        return query, key, value
+
+    bsz, query_length, _, head_dim = query.shape
+    groups = num_heads // num_kv_heads
+    # Query head `h` uses key/value head `h // groups`, same as HF's `repeat_kv`.
+    query = query.reshape(bsz, query_length, num_kv_heads, groups, head_dim)
+    key = key[:, :, :, None].expand(-1, -1, -1, groups, -1)
+    value = value[:, :, :, None].expand(-1, -1, -1, groups, -1)
+    return query, key, value
+
+
+def grouped_scaled_dot_product_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_mask: t.Optional[torch.Tensor] = None,
+    is_causal: bool = False,
+) -> torch.Tensor:
+    '''
+    `torch.nn.functional.scaled_dot_product_attention` over `[bsz, num heads,
+    len, head dim]` queries and keys/values which may have fewer heads (GQA
+    and MQA), without repeating the keys and values for every query head.
+
+    `attn_mask`, if given, has to be `[query length, key length]` or
+    `[bsz, 1, query length, key length]`.
+
+    NOTE: Older PyTorch versions can't do this natively, so there the
+    query heads sharing a key/value head get folded into the query length
+    instead: attention is computed per query anyway, so that's the same thing
+    as long as the causal mask gets repeated along.
+    '''
+    num_heads, num_kv_heads = query.shape[1], key.shape[1]
+    if num_heads == num_kv_heads:
+        return torch.nn.functional.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, is_causal=is_causal)
+    if _SDPA_HAS_GQA:
+        return torch.nn.functional.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, is_causal=is_causal, enable_gqa=True)
+
+    bsz, _, query_length, head_dim = query.shape
+    groups = num_heads // num_kv_heads
+    if is_causal:
+        attn_mask = torch.ones(query_length, key.shape[2], dtype=torch.bool, device=query.device).tril()
+    if attn_mask is not None:
+        attn_mask = attn_mask.repeat(*(1,) * (attn_mask.dim() - 2), groups, 1)
+    output = torch.nn.functional.scaled_dot_product_attention(
+        query.reshape(bsz, num_kv_heads, groups * query_length, head_dim), key, value, attn_mask=attn_mask)
+    return output.view(bsz, num_heads, query_length, head_dim)
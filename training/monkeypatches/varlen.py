@@ -0,0 +1,84 @@
+import typing as t
+
+import torch
+
+try:
+    from xformers.ops.fmha.attn_bias import BlockDiagonalCausalMask
+except ImportError:
+    # Only `reference_varlen_attention` below works without xFormers.
+    BlockDiagonalCausalMask = None
+
+from monkeypatches.gqa import grouped_scaled_dot_product_attention
+
+# Per-example sequence lengths for the current forward pass, flattened across
+# the batch. Set by the model's forward pre-hook and read by the patched
+# attention functions, since HF models don't let us pass arbitrary kwargs all
+# the way down to the attention modules.
+_SEQ_LENS: t.Optional[t.List[int]] = None
+_ATTN_BIAS: t.Optional["BlockDiagonalCausalMask"] = None
+
+
+def register_seq_lens_hook(model: torch.nn.Module) -> None:
+    '''
+    Makes `model` accept a `seq_lens` kwarg (as emitted by the collator for
+    packed and unpadded batches) and stashes it for the patched attention
+    functions.
+
+    NOTE: Register this on the outermost model (i.e. after wrapping it
+    with PEFT), since PEFT calls the inner model's `forward` directly and
+    would skip any hooks on it.
+    '''
+    model.register_forward_pre_hook(_consume_seq_lens, with_kwargs=True)
+
+
+def get_seq_lens() -> t.Optional[t.List[int]]:
+    '''Per-example lengths of the current batch, or None if it's neither packed nor unpadded.'''
+    return _SEQ_LENS
+
+
+def get_block_diagonal_causal_mask() -> t.Optional["BlockDiagonalCausalMask"]:
+    '''
+    Returns the attention bias for the current packed batch, or None if the
+    batch is not packed. The bias is built once and shared by all layers.
+    '''
+    global _ATTN_BIAS
+    if _SEQ_LENS is None:
+        return None
+    if _ATTN_BIAS is None:
+        _ATTN_BIAS = BlockDiagonalCausalMask.from_seqlens(_SEQ_LENS)
+    return _ATTN_BIAS
+
+
+def reference_varlen_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    seq_lens: t.List[int],
+    attention_fn: t.Optional[t.Callable[[torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor]] = None,
+) -> torch.Tensor:
+    '''
+    Pure PyTorch version of xFormers' block-diagonal causal attention, which
+    also runs on CPU: plain causal attention over every example on its own.
+    Same layout as xFormers, `[1, total tokens, num heads, head dim]`, and
+    keys/values may have fewer heads than the queries (GQA/MQA).
+
+    Every example goes through PyTorch's SDPA, or through `attention_fn` (one
+    of the backends' `attention`) if given.
+    '''
+    if attention_fn is not None:
+        return torch.cat([attention_fn(q, k, v) for q, k, v in zip(
+            *(x.split(seq_lens, dim=1) for x in (query, key, value)))], dim=1)
+
+    outputs = []
+    for q, k, v in zip(*(x.transpose(1, 2).split(seq_lens, dim=2) for x in (query, key, value))):
+        outputs.append(grouped_scaled_dot_product_attention(q, k, v, is_causal=True))
+    return torch.cat(outputs, dim=2).transpose(1, 2).contiguous()
+
+
+def _consume_seq_lens(_module, args, kwargs):
+    global _SEQ_LENS, _ATTN_BIAS
+    # Not cleared after the forward pass on purpose: gradient checkpointing
+    # re-runs the attention layers during the backward pass.
+    _SEQ_LENS = kwargs.pop("seq_lens", None)
+    _ATTN_BIAS = None
+    return args, kwargs
@@ -1,7 +1,9 @@
 import typing as t
 
 import torch
-from xformers.ops import LowerTriangularMask, memory_efficient_attention
+
+from monkeypatches.backends import get_attention_backend, get_causal_padding_bias
+from monkeypatches.varlen import get_seq_lens
 
 
 def gpt2_wrapped_scaled_dot_product(
@@ -15,9 +17,6 @@ def gpt2_wrapped_scaled_dot_product(
     assert head_mask is None
     batch_size = query.shape[0]
 
-    mask_value = torch.finfo(value.dtype).min
-    mask_value = torch.full([], mask_value, dtype=value.dtype)
-
     # in gpt-neo-x and gpt-j the query and keys are always in fp32
     # thus we need to cast them to the value dtype
     self.downcast_qk = True
@@ -34,36 +33,24 @@ def gpt2_wrapped_scaled_dot_product(
     key = key.permute(0, 2, 1, 3).contiguous()
     value = value.permute(0, 2, 1, 3).contiguous()
 
-    dropout_p = self.dropout_prob_attn if self.training else 0.0
-    if batch_size == 1 or self.training:
-        if query.shape[2] > 1:
-            sdpa_result = memory_efficient_attention(query, key, value, attn_bias=LowerTriangularMask())
-            # sdpa_result = torch.nn.functional.scaled_dot_product_attention(
-            #     query, key, value, attn_mask=None, dropout_p=dropout_p, is_causal=True
-            # )
-        else:
-            sdpa_result = memory_efficient_attention(query, key, value, attn_bias=None)
-            # sdpa_result = torch.nn.functional.scaled_dot_product_attention(
-            #     query, key, value, attn_mask=None, dropout_p=dropout_p, is_causal=False
-            # )
+    backend = get_attention_backend()
+    if get_seq_lens() is not None:
+        # Packed or unpadded batch: flatten it into a single sequence in which
+        # no example attends to any other.
+        _, query_length, num_heads, head_dim = query.shape
+        sdpa_result = backend.varlen_attention(
+            query.reshape(1, batch_size * query_length, num_heads, head_dim),
+            key.reshape(1, batch_size * query_length, num_heads, head_dim),
+            value.reshape(1, batch_size * query_length, num_heads, head_dim),
+            get_seq_lens(),
+        ).reshape(batch_size, query_length, num_heads, head_dim)
+    elif batch_size == 1 or self.training or attention_mask is None:
+        sdpa_result = backend.attention(query, key, value)
     else:
-        assert False, "xformers inference with bsz > 1 not implemented"
-        query_length, key_length = query.size(-2), key.size(-2)
-
-        # causal_mask is always [True, ..., True] otherwise, so executing this
-        # is unnecessary
-        if query_length > 1:
-            causal_mask = self.bias[:, :, key_length - query_length : key_length, :key_length].to(torch.bool)
-
-            causal_mask = torch.where(causal_mask, 0, mask_value)
-
-            # torch.Tensor.expand does no memory copy
-            causal_mask = causal_mask.expand(batch_size, -1, -1, -1)
-            attention_mask = causal_mask + attention_mask
-
-        sdpa_result = torch.nn.functional.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=dropout_p, is_causal=False
-        )
+        # Batched inference: padding has to be masked out as well, so this
+        # goes through an explicit bias.
+        attn_bias = get_causal_padding_bias(attention_mask, query.shape[1], key.shape[1], value.dtype, query.device)
+        sdpa_result = backend.attention(query, key, value, attn_bias=attn_bias)
 
     # in gpt-neo-x and gpt-j the query and keys are always in fp32
     # thus we need to cast them to the value dtype
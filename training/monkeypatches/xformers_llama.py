@@ -2,7 +2,12 @@ import typing as t
 
 import torch
 import transformers
-from xformers.ops import memory_efficient_attention
+
+from monkeypatches.backends import get_attention_backend, get_causal_padding_bias
+from monkeypatches.varlen import get_seq_lens
+
+# The KV cache grows by this many positions at a time.
+KV_CACHE_CHUNK_SIZE = 256
 
 
 def llama_attention_forward(
@@ -13,13 +18,20 @@ def llama_attention_forward(
     past_key_value: t.Optional[t.Tuple[torch.Tensor]] = None,
     output_attentions: bool = False,
     use_cache: bool = False,
+    # `padding_mask` on transformers 4.34 and 4.35. The padding is already
+    # in `attention_mask`, which is all this needs.
+    **_kwargs,
 ) -> t.Tuple[torch.Tensor, t.Optional[torch.Tensor], t.Optional[t.Tuple[torch.Tensor]]]:
-    assert not output_attentions, "xformers cannot be used when output_attentions = True"
+    assert not output_attentions, "the patched attention cannot be used when output_attentions = True"
     bsz, q_len, _ = hidden_states.size()
+    # Fewer than `num_heads` with grouped-query/multi-query attention (e.g.
+    # LLaMA-2-70B). Only that many are projected, cached and handed to the
+    # attention kernels, which share them between query heads themselves.
+    num_kv_heads = getattr(self, "num_key_value_heads", self.num_heads)
 
     query_states = self.q_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-    key_states = self.k_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
-    value_states = self.v_proj(hidden_states).view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+    key_states = self.k_proj(hidden_states).view(bsz, q_len, num_kv_heads, self.head_dim).transpose(1, 2)
+    value_states = self.v_proj(hidden_states).view(bsz, q_len, num_kv_heads, self.head_dim).transpose(1, 2)
 
     kv_seq_len = key_states.shape[-2]
     if past_key_value is not None:
@@ -28,29 +40,34 @@ def llama_attention_forward(
     query_states, key_states = transformers.models.llama.modeling_llama.apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
     # [bsz, nh, t, hd]
 
-    if past_key_value is not None:
-        # reuse k, v, self_attention
-        key_states = torch.cat([past_key_value[0], key_states], dim=2)
-        value_states = torch.cat([past_key_value[1], value_states], dim=2)
-
+    key_states, value_states = _update_kv_cache(self, past_key_value, key_states, value_states, use_cache)
     past_key_value = (key_states, value_states) if use_cache else None
 
-    dtype = query_states.dtype
-
     query_states = query_states.transpose(1, 2)
     key_states = key_states.transpose(1, 2)
     value_states = value_states.transpose(1, 2)
 
-    # This is a nasty hack. We know attention_mask in transformers is either
-    # LowerTriangular or all Zeros. We therefore check if one element in the
-    # upper triangular portion is zero. If it is, then the mask is all zeros.
-    if attention_mask is None or attention_mask[0, 0, 0, 1] == 0:
+    backend = get_attention_backend()
+    if get_seq_lens() is not None:
+        # Packed or unpadded batch: flatten it into a single sequence in which
+        # no example attends to any other.
+        attn_output = backend.varlen_attention(
+            query_states.reshape(1, bsz * q_len, self.num_heads, self.head_dim),
+            key_states.reshape(1, bsz * q_len, num_kv_heads, self.head_dim),
+            value_states.reshape(1, bsz * q_len, num_kv_heads, self.head_dim),
+            get_seq_lens())
+    elif bsz == 1 or self.training or attention_mask is None:
         # input and output should be of form (bsz, q_len, num_heads, head_dim)
-        attn_output = memory_efficient_attention(query_states, key_states, value_states, attn_bias=None)
+        # NOTE: Padding isn't masked out here. Training batches are padded on
+        # the right, which only affects the padded positions.
+        attn_output = backend.attention(query_states, key_states, value_states)
     else:
-        # input and output should be of form (bsz, q_len, num_heads, head_dim)
-        from xformers.ops import LowerTriangularMask
-        attn_output = memory_efficient_attention(query_states, key_states, value_states, attn_bias=LowerTriangularMask())
+        # Batched inference, possibly left padded (e.g. for generation):
+        # padding has to be masked out as well, so this goes through an
+        # explicit bias.
+        attn_bias = get_causal_padding_bias(
+            attention_mask, q_len, key_states.shape[1], value_states.dtype, query_states.device)
+        attn_output = backend.attention(query_states, key_states, value_states, attn_bias=attn_bias)
     attn_weights = None
 
     attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
@@ -58,3 +75,66 @@ def llama_attention_forward(
     attn_output = self.o_proj(attn_output)
 
     return attn_output, attn_weights, past_key_value
+
+
+def _update_kv_cache(
+    self,
+    past_key_value: t.Optional[t.Tuple[torch.Tensor, torch.Tensor]],
+    key_states: torch.Tensor,
+    value_states: torch.Tensor,
+    use_cache: bool,
+) -> t.Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Appends this step's keys and values (`[bsz, num kv heads, len, head
+    dim]`) to the cache and returns all of them so far.
+
+    Instead of concatenating the cache with the new keys and values on every
+    decoding step, which copies the whole cache every token, they are written
+    into a buffer which has room for `KV_CACHE_CHUNK_SIZE` more positions and
+    is only reallocated once it fills up. What's returned (and handed back
+    to HF as `past_key_value`) are views into that buffer, so HF still sees
+    tensors of the right length.
+
+    The buffer is only written to when the next step continues from the very
+    latest views into it, so anything else (reordered beams, going back to an
+    older cache) gets a fresh buffer instead of overwriting keys and values
+    that might still be in use. With gradients enabled, this does the plain
+    concatenation, since autograd doesn't allow writing into the buffer.
+    '''
+    if past_key_value is None:
+        # Not decoding (anymore), so let go of the last buffer.
+        self._kv_cache = None
+    if not use_cache or torch.is_grad_enabled():
+        if past_key_value is not None:
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        return key_states, value_states
+
+    past_length = past_key_value[0].shape[2] if past_key_value is not None else 0
+    length = past_length + key_states.shape[2]
+
+    cache = getattr(self, "_kv_cache", None)
+    reusable = cache is not None and cache[2] == past_length \
+        and _is_prefix_view(past_key_value[0], cache[0]) and _is_prefix_view(past_key_value[1], cache[1])
+    if not reusable or cache[0].shape[2] < length:
+        capacity = (length // KV_CACHE_CHUNK_SIZE + 1) * KV_CACHE_CHUNK_SIZE
+        bsz, num_heads, _, head_dim = key_states.shape
+        key_buffer = key_states.new_empty(bsz, num_heads, capacity, head_dim)
+        value_buffer = value_states.new_empty(bsz, num_heads, capacity, head_dim)
+        if past_key_value is not None:
+            key_buffer[:, :, :past_length] = past_key_value[0]
+            value_buffer[:, :, :past_length] = past_key_value[1]
+    else:
+        key_buffer, value_buffer, _ = cache
+
+    key_buffer[:, :, past_length:length] = key_states
+    value_buffer[:, :, past_length:length] = value_states
+    self._kv_cache = (key_buffer, value_buffer, length)
+    return key_buffer[:, :, :length], value_buffer[:, :, :length]
+
+
+def _is_prefix_view(tensor: torch.Tensor, buffer: torch.Tensor) -> bool:
+    '''Whether `tensor` is `buffer[:, :, :n]` for some `n`.'''
+    return tensor.data_ptr() == buffer.data_ptr() \
+        and tensor.shape[:2] == buffer.shape[:2] and tensor.shape[3] == buffer.shape[3] \
+        and tensor.stride() == buffer.stride()
@@ -0,0 +1,329 @@
+import abc
+import functools
+import json
+import os
+import typing as t
+
+import numpy as np
+import transformers
+from torch.utils.data import DataLoader, Sampler
+from transformers import logging as hf_logging
+
+logger = hf_logging.get_logger()
+
+STATE_FILE_NAME = "dataloader_state.json"
+
+
+class ResumableBatchSampler(Sampler, abc.ABC):
+    '''
+    Base class for batch samplers whose batches only depend on `seed` and the
+    epoch. The same batches are built on every rank and each rank takes every
+    `num_replicas`-th one.
+
+    Since the batches can always be rebuilt, resuming mid-epoch only needs the
+    epoch and how many batches were already consumed, and the sampler jumps
+    straight past those (see `skip_batches`) instead of the dataloader having
+    to load and collate them only to throw them away.
+    '''
+    def __init__(self, seed: int = 42, num_replicas: int = 1, rank: int = 0) -> None:
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        self._cached_epoch: t.Optional[int] = None
+        self._cached_batches: t.List[np.ndarray] = []
+        # Batches of the current epoch the trainer already went through, when resuming.
+        self._batches_to_skip = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self._batches_for_this_rank())
+
+    def __iter__(self) -> t.Iterator[t.List[int]]:
+        for batch in self._batches_for_this_rank()[self.batches_to_skip():]:
+            yield batch.tolist()
+
+    def skip_batches(self, num_batches: int) -> None:
+        '''Makes the next pass over the current epoch start after its first `num_batches` batches.'''
+        self._batches_to_skip = num_batches
+
+    def batches_to_skip(self) -> int:
+        return self._batches_to_skip
+
+    def finish_resuming(self) -> None:
+        self._batches_to_skip = 0
+
+    def state_dict(self, batches_consumed: int) -> t.Dict[str, t.Any]:
+        return dict(epoch=self.epoch, batches_consumed=batches_consumed, **self._layout())
+
+    def load_state_dict(self, state: t.Dict[str, t.Any]) -> None:
+        '''
+        Checks that `state` was saved with the same batches, so that skipping
+        the ones the trainer already went through lands where it left off.
+        '''
+        # The amount of batches is compared at the epoch `state` was saved in.
+        self.set_epoch(state["epoch"])
+        layout = {key: state[key] for key in self._layout()}
+        if layout != self._layout():
+            raise ValueError(
+                f"Can't resume from {layout}, since it doesn't match the current settings ({self._layout()}). "
+                "Resume with the same dataset, batch size, seed and world size.")
+
+    def _layout(self) -> t.Dict[str, t.Any]:
+        '''Everything that determines which batches a rank gets.'''
+        return dict(seed=self.seed, num_replicas=self.num_replicas, num_batches=len(self))
+
+    def _batches_for_this_rank(self) -> t.List[np.ndarray]:
+        if self._cached_epoch != self.epoch:
+            batches = self._build_batches()
+
+            # Wrap around so that every rank gets the same amount of batches.
+            num_batches_per_rank = -(-len(batches) // self.num_replicas)
+            num_missing = num_batches_per_rank * self.num_replicas - len(batches)
+            batches += batches[:num_missing]
+
+            self._cached_batches = batches[self.rank::self.num_replicas]
+            self._cached_epoch = self.epoch
+        return self._cached_batches
+
+    @abc.abstractmethod
+    def _build_batches(self) -> t.List[np.ndarray]:
+        '''All batches of the current epoch, for every rank.'''
+
+
+class ShuffledBatchSampler(ResumableBatchSampler):
+    '''Batches of `batch_size` randomly shuffled examples.'''
+    def __init__(
+        self,
+        num_items: int,
+        batch_size: int,
+        drop_last: bool = False,
+        seed: int = 42,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        super().__init__(seed=seed, num_replicas=num_replicas, rank=rank)
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def _build_batches(self) -> t.List[np.ndarray]:
+        indices = np.random.default_rng([self.seed, self.epoch]).permutation(self.num_items)
+        num_batches = len(indices) // self.batch_size if self.drop_last else -(-len(indices) // self.batch_size)
+        return [indices[i * self.batch_size:(i + 1) * self.batch_size] for i in range(num_batches)]
+
+
+class LengthGroupedBatchSampler(ResumableBatchSampler):
+    '''
+    Batch sampler which groups examples of similar length together to cut down
+    on padding.
+
+    Every epoch, indices are shuffled and split into "megabatches" of
+    `megabatch_multiplier` batches of `batch_size` examples, which are then
+    sorted by length and cut into batches. The batch order is then shuffled
+    again, so training doesn't go through the data from longest to shortest.
+
+    With `max_tokens`, batches instead hold as many examples as fit into
+    `max_tokens` tokens after padding. How many batches that makes would
+    depend on how the examples happen to fall into megabatches, but the HF
+    Trainer works out the LR schedule and where to resume from with the
+    length of the first epoch. So here, the whole dataset is sorted by padded
+    length instead, and examples are only shuffled among those with the same
+    padded length: every epoch gets the same batch sizes, filled differently.
+
+    With `drop_last`, a last batch which came up short is left out.
+
+    Resumable mid-epoch, see `ResumableBatchSampler`.
+    '''
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        batch_size: int,
+        max_tokens: t.Optional[int] = None,
+        drop_last: bool = False,
+        seed: int = 42,
+        num_replicas: int = 1,
+        rank: int = 0,
+        megabatch_multiplier: int = 50,
+    ) -> None:
+        super().__init__(seed=seed, num_replicas=num_replicas, rank=rank)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.drop_last = drop_last
+        self.megabatch_multiplier = megabatch_multiplier
+
+    def __iter__(self) -> t.Iterator[t.List[int]]:
+        batches = self._batches_for_this_rank()
+        real_tokens, padded_tokens = self._count_tokens(batches)
+        logger.info(
+            f"Length-grouped sampler, epoch {self.epoch}: {len(batches)} batches, "
+            f"padding efficiency (real tokens / padded tokens) of {real_tokens / padded_tokens:.2%}")
+
+        yield from super().__iter__()
+
+    def padding_efficiency(self) -> float:
+        '''Real tokens / padded tokens for this rank's batches in the current epoch.'''
+        real_tokens, padded_tokens = self._count_tokens(self._batches_for_this_rank())
+        return real_tokens / padded_tokens
+
+    def _build_batches(self) -> t.List[np.ndarray]:
+        rng = np.random.default_rng([self.seed, self.epoch])
+        indices = rng.permutation(len(self.lengths))
+
+        batches: t.List[np.ndarray] = []
+        if self.max_tokens is None:
+            megabatch_size = self.batch_size * self.megabatch_multiplier
+            for start in range(0, len(indices), megabatch_size):
+                megabatch = indices[start:start + megabatch_size]
+                megabatch = megabatch[np.argsort(-self.lengths[megabatch], kind="stable")]
+                batches += [megabatch[i:i + self.batch_size] for i in range(0, len(megabatch), self.batch_size)]
+        else:
+            # Stable, so examples of the same padded length stay shuffled.
+            indices = indices[np.argsort(-_padded_length(self.lengths[indices]), kind="stable")]
+            batches = self._split_by_token_budget(indices)
+        if self.drop_last and batches and len(batches[-1]) < self._capacity(batches[-1][0]):
+            batches.pop()
+
+        order = rng.permutation(len(batches))
+        batches = [batches[idx] for idx in order]
+        if not batches:
+            return batches
+
+        # Put the batch with the most (padded) tokens first, so that if we're
+        # going to run out of memory we find out right away.
+        biggest = int(np.argmax([_padded_length(self.lengths[b].max()) * len(b) for b in batches]))
+        batches[0], batches[biggest] = batches[biggest], batches[0]
+
+        return batches
+
+    def _split_by_token_budget(self, sorted_indices: np.ndarray) -> t.List[np.ndarray]:
+        '''Greedily cuts indices sorted by decreasing length into batches of at most `max_tokens` padded tokens.'''
+        batches = []
+        start = 0
+        while start < len(sorted_indices):
+            # Sorted by decreasing length, so the first example sets the padded length.
+            batch_size = self._capacity(sorted_indices[start])
+            batches.append(sorted_indices[start:start + batch_size])
+            start += batch_size
+        return batches
+
+    def _capacity(self, longest: int) -> int:
+        '''How many examples fit into a batch whose longest example is the `longest`-th one.'''
+        if self.max_tokens is None:
+            return self.batch_size
+        return max(1, self.max_tokens // _padded_length(self.lengths[longest]))
+
+    def _count_tokens(self, batches: t.List[np.ndarray]) -> t.Tuple[int, int]:
+        real_tokens = sum(int(self.lengths[batch].sum()) for batch in batches)
+        padded_tokens = sum(_padded_length(self.lengths[batch].max()) * len(batch) for batch in batches)
+        return real_tokens, padded_tokens
+
+
+class ResumableDataLoader(DataLoader):
+    '''
+    DataLoader which keeps track of the epoch and how many of its batches were
+    consumed, so where it's at can be saved into checkpoints (see
+    `DataLoaderStateCallback`). The actual shuffling and resuming is done by
+    `resumable`, which by default is the batch sampler.
+
+    The epoch is whatever the HF Trainer last passed to `set_epoch`, or else
+    the number of passes over the dataloader so far: older Trainers don't call
+    `set_epoch`, but instead go through the dataloader once for every epoch
+    that's already done when resuming. Either way, it follows the Trainer's
+    own count, which `state.epoch` (only updated on optimizer steps) doesn't.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.epoch = 0
+        self.batches_consumed = 0
+        # Set by `patch_skip_first_batches`, for the next pass.
+        self._batches_to_skip = 0
+
+    @property
+    def resumable(self):
+        return self.batch_sampler
+
+    def __iter__(self):
+        self.resumable.set_epoch(self.epoch)
+        self.epoch += 1
+        self.resumable.skip_batches(self._batches_to_skip)
+        self.batches_consumed = self._batches_to_skip
+        self._batches_to_skip = 0
+
+        for batch in super().__iter__():
+            # By now, the sampler (or the workers' copies of the dataset) has
+            # already picked up where to resume from.
+            self.resumable.finish_resuming()
+            self.batches_consumed += 1
+            yield batch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self.resumable.set_epoch(epoch)
+
+    def skip_batches(self, num_batches: int) -> None:
+        '''Makes the next pass start after the first `num_batches` batches of its epoch.'''
+        self._batches_to_skip = num_batches
+
+    def state_dict(self) -> t.Dict[str, t.Any]:
+        return self.resumable.state_dict(self.batches_consumed)
+
+
+class DataLoaderStateCallback(transformers.TrainerCallback):
+    '''Saves where a `ResumableDataLoader` is at into every checkpoint, see `load_dataloader_state`.'''
+
+    def on_save(
+        self,
+        args: transformers.TrainingArguments,
+        state: transformers.TrainerState,
+        control: transformers.TrainerControl,
+        **kwargs,
+    ):
+        train_dataloader = kwargs.get("train_dataloader")
+        # Ranks consume batches in lockstep, so one copy of the state is enough.
+        if isinstance(train_dataloader, ResumableDataLoader) and state.is_world_process_zero:
+            checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(os.path.join(checkpoint_dir, STATE_FILE_NAME), "w") as file:
+                json.dump(train_dataloader.state_dict(), file)
+        return control
+
+
+def patch_skip_first_batches() -> None:
+    '''
+    When resuming mid-epoch, the HF Trainer skips the batches it already
+    trained on by going through them with Accelerate's `skip_first_batches`.
+    A `ResumableDataLoader` is told to jump past those instead, and handed
+    back as is. Everything else about the resumed epoch (step count, gradient
+    accumulation boundaries, `state.epoch`) is still left to the Trainer.
+    '''
+    skip_first_batches = transformers.trainer.skip_first_batches
+    if getattr(skip_first_batches, "handles_resumable_dataloaders", False):
+        return
+
+    @functools.wraps(skip_first_batches)
+    def wrapper(dataloader, num_batches=0):
+        if not isinstance(dataloader, ResumableDataLoader):
+            return skip_first_batches(dataloader, num_batches)
+        dataloader.skip_batches(num_batches)
+        return dataloader
+
+    wrapper.handles_resumable_dataloaders = True
+    transformers.trainer.skip_first_batches = wrapper
+
+
+def load_dataloader_state(checkpoint_dir: str) -> t.Optional[t.Dict[str, t.Any]]:
+    path = os.path.join(checkpoint_dir, STATE_FILE_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _padded_length(length: t.Union[int, np.ndarray]) -> t.Union[int, np.ndarray]:
+    # Needs to match the collator, which pads up to a multiple of 8.
+    return (length + 7) // 8 * 8
@@ -0,0 +1,197 @@
+import typing as t
+
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import IterableDataset
+
+from dataset import MmappedArrowDataset, ShardedArrowDataset, load_arrow_dataset
+from sampler import ResumableDataLoader
+
+
+class StreamingArrowDataset(IterableDataset):
+    '''
+    Reads an Arrow dataset (a single file, or a directory/manifest of shards)
+    front to back in large blocks instead of one random row at a time, for
+    datasets that are too big to fit into the page cache.
+
+    Every epoch, the rows are cut into blocks of `block_size` consecutive rows
+    and the blocks are shuffled. Each consumer (every dataloader worker on
+    every rank) takes every n-th block. A consumer reads its blocks
+    `shuffle_buffer_size` rows' worth at a time, in order, into a buffer, and
+    yields the buffer's rows in a random order. Everything is derived from
+    `seed`, the epoch, the consumer and the buffer's position in the stream, so
+    any position can be jumped to directly (see `skip_batches`).
+
+    Every consumer yields the same amount of rows per epoch: a whole number of
+    batches, so ranks stay in lockstep. This drops at most about a block's
+    worth of rows per consumer and epoch.
+    '''
+    def __init__(
+        self,
+        path: str,
+        sft: bool = False,
+        batch_size: int = 1,
+        num_workers: int = 0,
+        block_size: int = 1024,
+        shuffle_buffer_size: int = 16384,
+        seed: int = 42,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        self.dataset: t.Union[MmappedArrowDataset, ShardedArrowDataset] = load_arrow_dataset(path, sft=sft)
+        assert not self.dataset.packed, "Streaming doesn't support packed datasets."
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.block_size = block_size
+        self.blocks_per_buffer = max(1, shuffle_buffer_size // block_size)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        self.num_consumers = self.num_replicas * self.num_workers
+        self.num_blocks = -(-len(self.dataset) // block_size)
+        assert self.num_blocks >= self.num_consumers, \
+            f"{path} only has {self.num_blocks} blocks of {block_size} rows for {self.num_consumers} consumers."
+
+        # Every consumer gets at least this many blocks, one of which might be
+        # the (shorter) last block of the dataset.
+        last_block_size = len(self.dataset) - (self.num_blocks - 1) * block_size
+        min_rows = (self.num_blocks // self.num_consumers) * block_size - (block_size - last_block_size)
+        self.rows_per_consumer = min_rows // batch_size * batch_size
+        assert self.rows_per_consumer > 0, "Not enough rows for a single batch per consumer."
+
+        # Batches of the current epoch the trainer already went through, when resuming.
+        self._batches_to_skip = 0
+
+    def __len__(self) -> int:
+        '''Rows yielded on this rank per epoch.'''
+        return self.num_workers * self.rows_per_consumer
+
+    def __iter__(self) -> t.Iterator[dict]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        assert num_workers == self.num_workers, \
+            f"Dataset was set up for {self.num_workers} dataloader workers, but got {num_workers}."
+
+        consumer = self.rank * self.num_workers + worker_id
+        # Batches come out of the workers round-robin, so worker `w` made every
+        # `num_workers`-th batch, starting from the `w`-th one.
+        batches_consumed = self.batches_to_skip()
+        batches_from_this_worker = batches_consumed // num_workers + int(worker_id < batches_consumed % num_workers)
+        skip = min(batches_from_this_worker * self.batch_size, self.rows_per_consumer)
+
+        yield from self._iter_rows(consumer, skip)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def skip_batches(self, num_batches: int) -> None:
+        '''
+        Makes the next pass over the current epoch start right after its first
+        `num_batches` batches, without reading them. The remaining batches are
+        exactly the ones that weren't consumed yet, although the order in which
+        they come out of the workers can be rotated.
+        '''
+        self._batches_to_skip = num_batches
+
+    def batches_to_skip(self) -> int:
+        return self._batches_to_skip
+
+    def finish_resuming(self) -> None:
+        self._batches_to_skip = 0
+
+    @property
+    def packed(self) -> bool:
+        return False
+
+    def check_tokenizer(self, tokenizer: transformers.PreTrainedTokenizer) -> None:
+        self.dataset.check_tokenizer(tokenizer)
+
+    def state_dict(self, batches_consumed: int) -> t.Dict[str, t.Any]:
+        return dict(
+            epoch=self.epoch,
+            batches_consumed=batches_consumed,
+            **self._layout(),
+        )
+
+    def load_state_dict(self, state: t.Dict[str, t.Any]) -> None:
+        '''
+        Checks that `state` was saved with the same settings, so that skipping
+        the batches the trainer already went through lands where it left off.
+        '''
+        layout = {key: state[key] for key in self._layout()}
+        if layout != self._layout():
+            raise ValueError(
+                f"Can't resume streaming from {layout}, since it doesn't match the current settings "
+                f"({self._layout()}). Resume with the same dataset, batch size, number of dataloader "
+                "workers, world size and streaming settings.")
+
+    def _layout(self) -> t.Dict[str, t.Any]:
+        '''Everything that determines which rows go where.'''
+        return dict(
+            num_rows=len(self.dataset),
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            num_replicas=self.num_replicas,
+            block_size=self.block_size,
+            blocks_per_buffer=self.blocks_per_buffer,
+            seed=self.seed,
+        )
+
+    def _iter_rows(self, consumer: int, skip: int) -> t.Iterator[dict]:
+        block_order = np.random.default_rng([self.seed, self.epoch]).permutation(self.num_blocks)
+        blocks = block_order[consumer::self.num_consumers]
+        block_starts = blocks * self.block_size
+        block_lengths = np.minimum(block_starts + self.block_size, len(self.dataset)) - block_starts
+
+        num_buffers = -(-len(blocks) // self.blocks_per_buffer)
+        buffer_ends = np.cumsum([block_lengths[i * self.blocks_per_buffer:(i + 1) * self.blocks_per_buffer].sum()
+                                 for i in range(num_buffers)])
+
+        # Jump straight to the buffer holding the first row to yield.
+        num_yielded = skip
+        first_buffer = int(np.searchsorted(buffer_ends, skip, side="right"))
+        for buffer_idx in range(first_buffer, num_buffers):
+            if num_yielded >= self.rows_per_consumer:
+                return
+
+            buffer_blocks = slice(buffer_idx * self.blocks_per_buffer, (buffer_idx + 1) * self.blocks_per_buffer)
+            rows = np.concatenate([np.arange(start, start + length) for start, length
+                                   in zip(block_starts[buffer_blocks], block_lengths[buffer_blocks])])
+            order = np.random.default_rng([self.seed, self.epoch, consumer, buffer_idx]).permutation(len(rows))
+
+            buffer_start = int(buffer_ends[buffer_idx]) - len(rows)
+            order = order[num_yielded - buffer_start:self.rows_per_consumer - buffer_start]
+            if len(order) == 0:
+                continue
+
+            # Read the rows that are needed in file order, copying fixed-width
+            # rows out of the memory map, so reads are sequential...
+            needed = np.sort(rows[order])
+            items = {}
+            for row in needed.tolist():
+                item = self.dataset[row]
+                if isinstance(item["input_ids"], np.ndarray):
+                    item["input_ids"] = item["input_ids"].copy()
+                items[row] = item
+
+            # ...and only then shuffle them.
+            for row in rows[order].tolist():
+                yield items.pop(row)
+                num_yielded += 1
+
+
+class StreamingDataLoader(ResumableDataLoader):
+    '''`ResumableDataLoader` over a `StreamingArrowDataset`, which takes care of resuming by itself.'''
+    def __init__(self, dataset: StreamingArrowDataset, **kwargs) -> None:
+        super().__init__(dataset, batch_size=dataset.batch_size, **kwargs)
+
+    @property
+    def resumable(self) -> StreamingArrowDataset:
+        return self.dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset) // self.dataset.batch_size
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+'''
+Checks the patched LLaMA attention with grouped-query and multi-query
+attention (fewer key/value heads than query heads, as in LLaMA-2-70B) on CPU.
+
+- `kernel`: grouped attention (with PyTorch's native GQA support, and with
+  the fallback for older versions) vs. attention over keys/values repeated
+  for every query head, for prefill, chunked prefill and decoding shapes
+- `models`: tiny, randomly initialized GQA and MQA LLaMA models, patched vs.
+  unpatched: logits of a batch, of the same batch unpadded, and greedy
+  generation. Also checks that the KV cache only holds the key/value heads.
+
+Example: python training/verify_llama_gqa.py --num-heads 8 --num-kv-heads 2 1
+'''
+import argparse
+import logging
+import sys
+import types
+import typing as t
+
+import numpy as np
+import torch
+import transformers
+
+from dataset import DataCollatorForMmapedDataset
+from monkeypatches import apply_xformers_monkeypatches, check_transformers_version
+from monkeypatches import gqa, varlen
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    for num_kv_heads in args.num_kv_heads:
+        verify_kernel(args.num_heads, num_kv_heads, args.atol)
+    try:
+        check_transformers_version()
+    except RuntimeError as ex:
+        sys.exit(f"The kernel matches, but the models can't be checked: {ex}")
+    verify_models(args, rng)
+    LOG.info("Grouped-query attention matches the unpatched implementation.")
+
+
+def verify_kernel(num_heads: int, num_kv_heads: int, atol: float, head_dim: int = 16) -> None:
+    groups = num_heads // num_kv_heads
+    for query_length, key_length in ((32, 32), (8, 32), (1, 32)):
+        query = torch.randn(2, num_heads, query_length, head_dim)
+        key, value = (torch.randn(2, num_kv_heads, key_length, head_dim) for _ in range(2))
+
+        attn_mask = None
+        if query_length < key_length:
+            attn_mask = torch.ones(query_length, key_length, dtype=torch.bool).tril(diagonal=key_length - query_length)
+        is_causal = query_length == key_length
+        reference = torch.nn.functional.scaled_dot_product_attention(
+            query, key.repeat_interleave(groups, dim=1), value.repeat_interleave(groups, dim=1),
+            attn_mask=attn_mask, is_causal=is_causal)
+
+        for native in (True, False):
+            if native and not gqa._SDPA_HAS_GQA:
+                continue
+            has_gqa, gqa._SDPA_HAS_GQA = gqa._SDPA_HAS_GQA, native
+            try:
+                output = gqa.grouped_scaled_dot_product_attention(
+                    query, key, value, attn_mask=attn_mask, is_causal=is_causal)
+            finally:
+                gqa._SDPA_HAS_GQA = has_gqa
+            _assert_close(output, reference, atol,
+                          f"{num_kv_heads} kv heads, {query_length}x{key_length}, native={native}")
+
+        # The xFormers layout only expands the keys/values, without copying them.
+        _, grouped_key, _ = gqa.group_heads_for_xformers(
+            query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2))
+        assert grouped_key.stride(3) == 0 and grouped_key.data_ptr() == key.data_ptr()
+    LOG.info("kernel: grouped attention with %s key/value heads matches repeated keys/values.", num_kv_heads)
+
+
+def verify_models(args: argparse.Namespace, rng: np.random.Generator) -> None:
+    seq_lens = rng.integers(1, args.max_length + 1, size=args.batch_size).tolist()
+    examples = [rng.integers(1, args.vocab_size, size=length) for length in seq_lens]
+    input_ids = torch.zeros(len(examples), max(seq_lens), dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for idx, example in enumerate(examples):
+        input_ids[idx, :len(example)] = torch.from_numpy(example)
+        attention_mask[idx, :len(example)] = 1
+    prompt = torch.from_numpy(examples[0])[None]
+
+    models: t.Dict[int, transformers.PreTrainedModel] = {}
+    references = {}
+    for num_kv_heads in args.num_kv_heads:
+        config = transformers.LlamaConfig(
+            vocab_size=args.vocab_size, hidden_size=args.hidden_size, intermediate_size=2 * args.hidden_size,
+            num_hidden_layers=2, num_attention_heads=args.num_heads, num_key_value_heads=num_kv_heads,
+            max_position_embeddings=4 * sum(seq_lens) + args.max_new_tokens)
+        model = models[num_kv_heads] = transformers.LlamaForCausalLM(config).eval()
+        with torch.no_grad():
+            references[num_kv_heads] = (
+                model(input_ids=input_ids, attention_mask=attention_mask).logits,
+                model.generate(prompt, max_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=0),
+            )
+
+    apply_xformers_monkeypatches()
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+    unpadded_batch = DataCollatorForMmapedDataset(tokenizer, sft=False, unpadded=True)(
+        [dict(input_ids=example) for example in examples])
+    for num_kv_heads, model in models.items():
+        reference_logits, reference_generation = references[num_kv_heads]
+        name = f"llama, {args.num_heads} heads, {num_kv_heads} kv heads"
+        with torch.no_grad():
+            logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+            # Batched inference masks out padding, so even the padded
+            # positions match.
+            _assert_close(logits, reference_logits, args.atol, f"{name}, padded")
+
+            generation = model.generate(prompt, max_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=0)
+            assert torch.equal(generation, reference_generation), f"{name}: generation differs."
+            cache_shape = model.model.layers[0].self_attn._kv_cache[0].shape
+            assert cache_shape[1] == num_kv_heads, f"{name}: KV cache has {cache_shape[1]} heads."
+
+            varlen.register_seq_lens_hook(model)
+            logits = model(**{key: value for key, value in unpadded_batch.items() if key != "labels"}).logits
+            varlen._consume_seq_lens(None, (), {})
+            start = 0
+            for idx, length in enumerate(seq_lens):
+                _assert_close(logits[0, start:start + length], reference_logits[idx, :length], args.atol,
+                              f"{name}, unpadded")
+                start += length
+        LOG.info("%s: padded, unpadded and generated outputs match the unpatched model.", name)
+
+
+def _assert_close(actual: torch.Tensor, expected: torch.Tensor, atol: float, name: str) -> None:
+    difference = (actual - expected).abs().max().item()
+    assert difference <= atol, f"{name}: off by up to {difference}."
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Patched LLaMA attention with GQA/MQA vs. the unpatched one.")
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-kv-heads", type=int, nargs="+", default=[2, 1],
+                        help="Key/value heads of the models to check (1 is multi-query attention).")
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-length", type=int, default=40)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--vocab-size", type=int, default=256)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Checks the patched LLaMA attention's KV cache against the unpatched HF
+implementation on CPU, with a tiny, randomly initialized model: greedy
+decoding and beam search (whose reordered caches can't be written into, and
+so have to be copied) have to produce the same tokens and scores. So does
+greedy decoding of a left padded batch of prompts of different lengths,
+against generating for each prompt on its own.
+
+Also reports how often the cache buffer of a layer got (re)allocated, and how
+long decoding a token takes at the start vs. the end of a long generation.
+
+Example: python training/verify_llama_kv_cache.py --max-new-tokens 600
+'''
+import argparse
+import logging
+import sys
+import time
+import typing as t
+
+import torch
+import transformers
+
+from monkeypatches import apply_xformers_monkeypatches, check_transformers_version
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+    try:
+        check_transformers_version()
+    except RuntimeError as ex:
+        sys.exit(str(ex))
+    torch.manual_seed(args.seed)
+
+    config = transformers.LlamaConfig(
+        vocab_size=args.vocab_size, hidden_size=args.hidden_size, intermediate_size=2 * args.hidden_size,
+        num_hidden_layers=args.num_layers, num_attention_heads=args.num_heads,
+        max_position_embeddings=args.prompt_length + args.max_new_tokens)
+    model = transformers.LlamaForCausalLM(config).eval()
+    input_ids = torch.randint(1, args.vocab_size, (args.batch_size, args.prompt_length))
+
+    generation_configs = {
+        "greedy": dict(do_sample=False),
+        "beam search": dict(do_sample=False, num_beams=2, max_new_tokens=args.max_new_tokens // 4),
+    }
+    references = {name: _generate(model, input_ids, args, **kwargs) for name, kwargs in generation_configs.items()}
+    reference_latencies = _decode_latencies(model, input_ids, args)
+    padded_input_ids, attention_mask, prompt_lengths = _left_pad(input_ids, args.prompt_length // (2 * args.batch_size))
+    left_padded_references = [
+        _generate(model, input_ids[idx:idx + 1, :length], args, max_new_tokens=args.max_new_tokens // 4)
+        for idx, length in enumerate(prompt_lengths)]
+
+    apply_xformers_monkeypatches()
+    # Layer 0's cache buffer after every step.
+    buffers: t.List[torch.Tensor] = []
+    attention = model.model.layers[0].self_attn
+    attention.register_forward_hook(lambda module, *_: buffers.append(module._kv_cache[0]))
+
+    for name, kwargs in generation_configs.items():
+        buffers.clear()
+        output = _generate(model, input_ids, args, **kwargs)
+        assert torch.equal(output.sequences, references[name].sequences), f"{name}: patched model generated different tokens."
+        for step, (scores, reference_scores) in enumerate(zip(output.scores, references[name].scores)):
+            finite = torch.isfinite(reference_scores)
+            difference = (scores[finite] - reference_scores[finite]).abs().max().item()
+            assert difference <= args.atol, f"{name}: scores of step {step} are off by up to {difference}."
+        LOG.info("%s: %s tokens match the unpatched model, and layer 0's cache buffer was allocated %s times.",
+                 name, len(output.scores), 1 + sum(a is not b for a, b in zip(buffers, buffers[1:])))
+
+    output = _generate(model, padded_input_ids, args, attention_mask=attention_mask,
+                       max_new_tokens=args.max_new_tokens // 4)
+    for idx, (length, reference) in enumerate(zip(prompt_lengths, left_padded_references)):
+        assert torch.equal(output.sequences[idx, args.prompt_length:], reference.sequences[0, length:]), \
+            f"left padded batch: patched model generated different tokens for prompt {idx}."
+        for step, (scores, reference_scores) in enumerate(zip(output.scores, reference.scores)):
+            finite = torch.isfinite(reference_scores[0])
+            difference = (scores[idx][finite] - reference_scores[0][finite]).abs().max().item()
+            assert difference <= args.atol, \
+                f"left padded batch: scores of step {step} are off by up to {difference} for prompt {idx}."
+    LOG.info("left padded batch: %s tokens for prompts of %s tokens match generating for each on its own.",
+             len(output.scores), prompt_lengths)
+
+    latencies = _decode_latencies(model, input_ids, args)
+    for label, timings in (("unpatched", reference_latencies), ("patched", latencies)):
+        LOG.info("%s: %.2f ms/token over the first 64 tokens, %.2f ms/token over the last 64",
+                 label, 1000 * sum(timings[:64]) / 64, 1000 * sum(timings[-64:]) / 64)
+
+
+def _generate(model: transformers.PreTrainedModel, input_ids: torch.Tensor, args: argparse.Namespace, **kwargs):
+    kwargs.setdefault("max_new_tokens", args.max_new_tokens)
+    with torch.no_grad():
+        return model.generate(input_ids, pad_token_id=0, min_new_tokens=kwargs["max_new_tokens"],
+                              output_scores=True, return_dict_in_generate=True, **kwargs)
+
+
+def _left_pad(input_ids: torch.Tensor, step: int) -> t.Tuple[torch.Tensor, torch.Tensor, t.List[int]]:
+    '''Cuts the prompts down to lengths `step` apart, and left pads them back to the longest.'''
+    bsz, max_length = input_ids.shape
+    prompt_lengths = [max_length - idx * step for idx in range(bsz)]
+    padded_input_ids = torch.zeros_like(input_ids)
+    attention_mask = torch.zeros_like(input_ids)
+    for idx, length in enumerate(prompt_lengths):
+        padded_input_ids[idx, max_length - length:] = input_ids[idx, :length]
+        attention_mask[idx, max_length - length:] = 1
+    return padded_input_ids, attention_mask, prompt_lengths
+
+
+def _decode_latencies(model: transformers.PreTrainedModel, input_ids: torch.Tensor,
+                      args: argparse.Namespace) -> t.List[float]:
+    '''Wall-clock time of every greedy decoding step, with the cache.'''
+    latencies = []
+    with torch.no_grad():
+        output = model(input_ids=input_ids, use_cache=True)
+        for _ in range(args.max_new_tokens - 1):
+            next_tokens = output.logits[:, -1].argmax(dim=-1, keepdim=True)
+            start = time.perf_counter()
+            output = model(input_ids=next_tokens, past_key_values=output.past_key_values, use_cache=True)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Patched LLaMA KV cache vs. the unpatched HF implementation.")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--prompt-length", type=int, default=24)
+    parser.add_argument("--max-new-tokens", type=int, default=400)
+    parser.add_argument("--vocab-size", type=int, default=256)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+'''
+Checks that resuming mid-epoch (see ./sampler.py and ./streaming_dataset.py)
+picks up exactly where an uninterrupted run would be: the same global step and
+`state.epoch` after every optimizer step, and the same batches in the same
+order. Trains a tiny, randomly initialized LLaMA model on a synthetic UFT file
+on CPU, once straight through, and once stopped after each of `--stop-after`
+steps and resumed from the checkpoint saved there. The (shuffled) batch
+sampler, the length-grouped one with a token budget and streaming are all
+checked. With the token budget, every epoch also has to have the same amount
+of batches, which the HF Trainer's step counts rely on.
+
+By default, epochs don't hold a whole number of gradient accumulation steps,
+so every epoch ends on a partial accumulation group. Older HF Trainers
+(4.3x) carry such a group over into the next epoch, and can't resume inside
+it even without our dataloaders, so check those with e.g. `--num-rows 12
+--max-tokens 16`.
+
+Example: python training/verify_resume.py --num-rows 14 --batch-size 2 --gradient-accumulation-steps 3
+'''
+import argparse
+import logging
+import os
+import tempfile
+import types
+import typing as t
+
+import numpy as np
+import torch
+import transformers
+
+from benchmark_dataset import write_synthetic_uft_file
+from dataset import DataCollatorForMmapedDataset, load_arrow_dataset
+from sampler import (DataLoaderStateCallback, LengthGroupedBatchSampler, ResumableBatchSampler, ResumableDataLoader,
+                     ShuffledBatchSampler, load_dataloader_state, patch_skip_first_batches)
+from streaming_dataset import StreamingArrowDataset, StreamingDataLoader
+
+LOG = logging.getLogger(__name__)
+
+SAMPLERS = ("batch sampler", "token budget", "streaming")
+
+# Global step and `state.epoch` after an optimizer step, and the batches (as
+# lists of rows) that went into it.
+Record = t.Tuple[int, float, t.List[t.List[t.List[int]]]]
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    transformers.logging.set_verbosity_error()
+    args = _parse_args_from_argv()
+    LOG.info("%s gradient accumulation steps.", args.gradient_accumulation_steps)
+    check_batches_per_epoch(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, "train.arrow")
+        lengths = np.random.default_rng(args.seed).integers(2, args.max_length + 1, size=args.num_rows)
+        write_synthetic_uft_file(filepath, args.num_rows, args.max_length, vocab_size=args.vocab_size,
+                                 seed=args.seed, fixed_width=True, lengths=lengths)
+
+        for sampler in SAMPLERS:
+            if sampler == "token budget":
+                batches_per_epoch = len(_token_budget_sampler(args, lengths))
+            else:
+                batches_per_epoch = -(-args.num_rows // args.batch_size)
+            LOG.info("%s: %s batches per epoch.", sampler, batches_per_epoch)
+
+            expected = run(args, filepath, sampler, os.path.join(tmp_dir, "uninterrupted"))
+            for stop_after in args.stop_after:
+                output_dir = os.path.join(tmp_dir, f"{sampler}-{stop_after}")
+                before = run(args, filepath, sampler, output_dir, stop_after=stop_after)
+                after = run(args, filepath, sampler, output_dir, resume=True)
+                _assert_same_records(before + after, expected, f"{sampler}, stopped after step {stop_after}")
+                LOG.info("%s, stopped after step %s (epoch %s): resumed run matches the uninterrupted one.",
+                         sampler, stop_after, before[-1][1])
+
+            epoch_orders = _batch_orders_per_epoch(expected, batches_per_epoch)
+            assert len(set(epoch_orders)) == len(epoch_orders), f"{sampler}: some epochs reuse another one's order."
+            LOG.info("%s: every epoch is shuffled differently.", sampler)
+
+    LOG.info("Resuming matches training straight through.")
+
+
+def check_batches_per_epoch(args: argparse.Namespace, num_rows: int = 10000, num_epochs: int = 4) -> None:
+    '''
+    Checks that the length-grouped sampler makes the same amount of batches
+    every epoch with a token budget, and can resume from any of them, at a
+    more realistic scale than the one trained on here.
+    '''
+    lengths = np.random.default_rng(args.seed).integers(2, 2048 + 1, size=num_rows)
+    batch_sampler = LengthGroupedBatchSampler(lengths, batch_size=args.batch_size, max_tokens=8192, seed=args.seed)
+    batches_per_epoch = []
+    for epoch in range(num_epochs):
+        batch_sampler.set_epoch(epoch)
+        batches_per_epoch.append(len(batch_sampler))
+
+        # A fresh sampler (i.e. at epoch 0) has to take checkpoints from any epoch.
+        LengthGroupedBatchSampler(lengths, batch_size=args.batch_size, max_tokens=8192, seed=args.seed) \
+            .load_state_dict(batch_sampler.state_dict(batches_consumed=1))
+    assert len(set(batches_per_epoch)) == 1, \
+        f"Token budget: the amount of batches changes from epoch to epoch: {batches_per_epoch}."
+    LOG.info("Token budget: %s batches in each of %s epochs of %s rows.", batches_per_epoch[0], num_epochs, num_rows)
+
+
+def run(
+    args: argparse.Namespace,
+    filepath: str,
+    sampler: str,
+    output_dir: str,
+    stop_after: t.Optional[int] = None,
+    resume: bool = False,
+) -> t.List[Record]:
+    '''Trains from scratch (or resumes, as ./hf_trainer.py does) and returns what every optimizer step saw.'''
+    torch.manual_seed(args.seed)
+    model = transformers.AutoModelForCausalLM.from_config(transformers.LlamaConfig(
+        vocab_size=args.vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+        num_attention_heads=2, max_position_embeddings=args.max_length))
+
+    train_batch_sampler = None
+    if sampler == "streaming":
+        train_dataset = StreamingArrowDataset(filepath, batch_size=args.batch_size, block_size=2,
+                                              shuffle_buffer_size=8, seed=args.seed)
+    else:
+        train_dataset = load_arrow_dataset(filepath, sft=False)
+        if sampler == "token budget":
+            train_batch_sampler = _token_budget_sampler(args, train_dataset.item_lengths())
+        else:
+            train_batch_sampler = ShuffledBatchSampler(len(train_dataset), batch_size=args.batch_size,
+                                                       seed=args.seed)
+
+    if resume:
+        dataloader_state = load_dataloader_state(transformers.trainer_utils.get_last_checkpoint(output_dir))
+        (train_batch_sampler or train_dataset).load_state_dict(dataloader_state)
+
+    # Newer HF Trainers save the collator's tokenizer into checkpoints.
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0, save_pretrained=lambda *args, **kwargs: None)
+    recorder = _RecordingCallback()
+    callbacks = [DataLoaderStateCallback, recorder]
+    if stop_after is not None:
+        callbacks.append(_StopCallback(stop_after))
+
+    trainer = _Trainer(
+        model=model,
+        train_dataset=train_dataset,
+        data_collator=DataCollatorForMmapedDataset(tokenizer, sft=False),
+        args=transformers.TrainingArguments(
+            output_dir=output_dir,
+            per_device_train_batch_size=args.batch_size,
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
+            num_train_epochs=args.num_epochs,
+            learning_rate=1e-3,
+            seed=args.seed,
+            save_strategy="no" if stop_after is None else "steps",
+            save_steps=stop_after or 1,
+            logging_steps=1000,
+            report_to=[],
+            disable_tqdm=True,
+        ),
+        callbacks=callbacks,
+        train_batch_sampler=train_batch_sampler,
+        recorder=recorder,
+    )
+    trainer.train(resume_from_checkpoint=True if resume else None)
+    return recorder.records
+
+
+class _Trainer(transformers.Trainer):
+    '''The training dataloader setup of `MmappedArrowTrainer`, minus its dependencies, recording every batch.'''
+
+    def __init__(self, *args, train_batch_sampler: t.Optional[ResumableBatchSampler] = None,
+                 recorder: "_RecordingCallback", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        self.recorder = recorder
+        patch_skip_first_batches()
+
+    def get_train_dataloader(self) -> torch.utils.data.DataLoader:
+        if isinstance(self.train_dataset, StreamingArrowDataset):
+            return StreamingDataLoader(self.train_dataset, collate_fn=self.data_collator)
+        return ResumableDataLoader(self.train_dataset, batch_sampler=self.train_batch_sampler,
+                                   collate_fn=self.data_collator)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        self.recorder.batches.append(inputs["input_ids"].tolist())
+        return super().training_step(model, inputs, *args, **kwargs)
+
+
+class _RecordingCallback(transformers.TrainerCallback):
+    def __init__(self) -> None:
+        self.records: t.List[Record] = []
+        self.batches: t.List[t.List[t.List[int]]] = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.records.append((state.global_step, round(state.epoch, 6), self.batches))
+        self.batches = []
+        return control
+
+
+class _StopCallback(transformers.TrainerCallback):
+    def __init__(self, stop_after: int) -> None:
+        self.stop_after = stop_after
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step == self.stop_after:
+            control.should_training_stop = True
+        return control
+
+
+def _token_budget_sampler(args: argparse.Namespace, lengths: np.ndarray) -> LengthGroupedBatchSampler:
+    return LengthGroupedBatchSampler(lengths, batch_size=args.batch_size, max_tokens=args.max_tokens, seed=args.seed)
+
+
+def _assert_same_records(actual: t.List[Record], expected: t.List[Record], name: str) -> None:
+    assert len(actual) == len(expected), f"{name}: {len(actual)} optimizer steps instead of {len(expected)}."
+    for (step, epoch, batches), (expected_step, expected_epoch, expected_batches) in zip(actual, expected):
+        assert (step, epoch) == (expected_step, expected_epoch), \
+            f"{name}: global step {step} at epoch {epoch}, expected step {expected_step} at epoch {expected_epoch}."
+        assert batches == expected_batches, f"{name}: different batches in global step {step}."
+
+
+def _batch_orders_per_epoch(records: t.List[Record], batches_per_epoch: int) -> t.List[tuple]:
+    batches = [tuple(map(tuple, batch)) for _, _, step_batches in records for batch in step_batches]
+    return [tuple(batches[start:start + batches_per_epoch])
+            for start in range(0, len(batches) - batches_per_epoch + 1, batches_per_epoch)]
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Resumed vs. uninterrupted training runs.")
+    parser.add_argument("--num-rows", type=int, default=14)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=3)
+    parser.add_argument("--num-epochs", type=int, default=3)
+    parser.add_argument("--stop-after", type=int, nargs="+", default=[1, 2, 3, 4, 5],
+                        help="Optimizer steps after which to interrupt training.")
+    parser.add_argument("--max-length", type=int, default=16)
+    parser.add_argument("--max-tokens", type=int, default=32,
+                        help="Token budget per batch of the length-grouped sampler.")
+    parser.add_argument("--vocab-size", type=int, default=128)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+Checks that unpadded batches (`DataCollatorForMmapedDataset(unpadded=True)`
+going through the patched attention) give the same results as the regular
+padded ones. Runs on CPU, where the patches fall back to the pure PyTorch
+reference implementation in ./monkeypatches/varlen.py.
+
+- `kernel`: reference and chunked block-diagonal attention vs. causal
+  attention with a padding mask (and vs. xFormers' kernel, when there's a
+  GPU and xFormers)
+- `models`: logits of tiny, randomly initialized LLaMA, GPT-NeoX and GPT-J
+  models on a padded batch (unpatched) vs. the same batch unpadded (patched),
+  with every attention backend
+
+Example: python training/verify_unpadded_attention.py --batch-size 6 --max-length 48
+'''
+import argparse
+import logging
+import sys
+import types
+import typing as t
+
+import numpy as np
+import torch
+import transformers
+
+from dataset import DataCollatorForMmapedDataset
+from monkeypatches import apply_attention_backend, backends, check_transformers_version, varlen
+
+LOG = logging.getLogger(__name__)
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    args = _parse_args_from_argv()
+    torch.manual_seed(args.seed)
+
+    rng = np.random.default_rng(args.seed)
+    seq_lens = rng.integers(1, args.max_length + 1, size=args.batch_size).tolist()
+    padded_flops, unpadded_flops = len(seq_lens) * max(seq_lens) ** 2, sum(x ** 2 for x in seq_lens)
+    LOG.info("Sequence lengths %s: unpadded attention does %.1f%% of the padded attention's work.",
+             seq_lens, 100 * unpadded_flops / padded_flops)
+
+    verify_kernel(seq_lens, args.atol)
+    try:
+        check_transformers_version()
+    except RuntimeError as ex:
+        sys.exit(f"The kernel matches, but the models can't be checked: {ex}")
+    verify_models(seq_lens, args.vocab_size, args.atol, rng, args.backends)
+    LOG.info("Unpadded and padded attention match.")
+
+
+def verify_kernel(seq_lens: t.List[int], atol: float, num_heads: int = 4, head_dim: int = 16) -> None:
+    query, key, value = (torch.randn(1, sum(seq_lens), num_heads, head_dim) for _ in range(3))
+    unpadded = varlen.reference_varlen_attention(query, key, value, seq_lens)
+
+    # Padded path: one row per example, causal mask plus key padding mask.
+    max_length = max(seq_lens)
+    padded = [torch.zeros(len(seq_lens), num_heads, max_length, head_dim) for _ in range(3)]
+    for idx, (start, length) in enumerate(zip(np.cumsum([0] + seq_lens[:-1]).tolist(), seq_lens)):
+        for padded_tensor, tensor in zip(padded, (query, key, value)):
+            padded_tensor[idx, :, :length] = tensor[0, start:start + length].transpose(0, 1)
+    positions = torch.arange(max_length)
+    mask = (positions[None, :] <= positions[:, None])[None] & (positions[None, :] < torch.tensor(seq_lens)[:, None])[:, None]
+    reference = torch.nn.functional.scaled_dot_product_attention(*padded, attn_mask=mask[:, None])
+
+    for idx, (start, length) in enumerate(zip(np.cumsum([0] + seq_lens[:-1]).tolist(), seq_lens)):
+        _assert_close(unpadded[0, start:start + length], reference[idx, :, :length].transpose(0, 1), atol,
+                      "reference block-diagonal attention")
+    LOG.info("kernel: reference block-diagonal attention matches padded attention.")
+
+    chunked = backends.chunked_varlen_attention(query, key, value, seq_lens)
+    _assert_close(chunked, unpadded, atol, "chunked block-diagonal attention")
+    LOG.info("kernel: chunked block-diagonal attention matches the reference implementation.")
+
+    if backends.memory_efficient_attention is not None and torch.cuda.is_available():
+        cuda_inputs = [x.cuda().half() for x in (query, key, value)]
+        varlen._consume_seq_lens(None, (), dict(seq_lens=seq_lens))
+        xformers_output = backends.xformers_varlen_attention(*cuda_inputs, seq_lens).float().cpu()
+        _assert_close(xformers_output, unpadded, 1e-2, "xFormers block-diagonal attention")
+        LOG.info("kernel: xFormers matches the reference implementation.")
+
+
+def verify_models(seq_lens: t.List[int], vocab_size: int, atol: float, rng: np.random.Generator,
+                  backend_names: t.List[str]) -> None:
+    max_position_embeddings = 8 * sum(seq_lens)
+    configs = {
+        "llama": transformers.LlamaConfig(
+            vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+            num_attention_heads=4, max_position_embeddings=max_position_embeddings),
+        "gpt-neox": transformers.GPTNeoXConfig(
+            vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+            num_attention_heads=4, max_position_embeddings=max_position_embeddings),
+        "gpt-j": transformers.GPTJConfig(
+            vocab_size=vocab_size, n_embd=64, n_layer=2, n_head=4, rotary_dim=8,
+            n_positions=max_position_embeddings),
+    }
+    examples = [rng.integers(1, vocab_size, size=length) for length in seq_lens]
+    tokenizer = types.SimpleNamespace(pad_token_id=0, eos_token_id=0)
+    unpadded_batch = DataCollatorForMmapedDataset(tokenizer, sft=False, unpadded=True)(
+        [dict(input_ids=example) for example in examples])
+
+    # Padded references first, while the models are still unpatched.
+    models, references = {}, {}
+    for name, config in configs.items():
+        models[name] = transformers.AutoModelForCausalLM.from_config(config).eval()
+        input_ids = torch.zeros(len(examples), max(seq_lens), dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for idx, example in enumerate(examples):
+            input_ids[idx, :len(example)] = torch.from_numpy(example)
+            attention_mask[idx, :len(example)] = 1
+        with torch.no_grad():
+            references[name] = models[name](input_ids=input_ids, attention_mask=attention_mask).logits
+
+    for model in models.values():
+        varlen.register_seq_lens_hook(model)
+    for backend in backend_names:
+        apply_attention_backend(backend)
+        for name, model in models.items():
+            with torch.no_grad():
+                logits = model(**{key: value for key, value in unpadded_batch.items() if key != "labels"}).logits
+
+            start = 0
+            for idx, length in enumerate(seq_lens):
+                _assert_close(logits[0, start:start + length], references[name][idx, :length], atol,
+                              f"{name}, {backend}")
+                start += length
+            LOG.info("%s, %s backend: unpadded logits match the padded ones.", name, backend)
+
+
+def _assert_close(actual: torch.Tensor, expected: torch.Tensor, atol: float, name: str) -> None:
+    difference = (actual - expected).abs().max().item()
+    assert difference <= atol, f"{name}: off by up to {difference} from the padded path."
+
+
+def _parse_args_from_argv() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Unpadded vs. padded attention.")
+    parser.add_argument("--batch-size", type=int, default=6)
+    parser.add_argument("--max-length", type=int, default=48)
+    parser.add_argument("--vocab-size", type=int, default=256)
+    parser.add_argument("--backends", nargs="+", choices=list(backends.ATTENTION_BACKENDS),
+                        default=list(backends.ATTENTION_BACKENDS))
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()